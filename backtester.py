@@ -0,0 +1,235 @@
+import argparse
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from base_update import SYNCHRONOUS_LEVELS, PortfolioWriter, allocations_frame, deal_lines, latest_weights
+from database import read_connection
+from returns_matrix import ReturnsMatrix, refresh_snapshot
+from strategies import Strategies
+
+PROFILES = ["low_risk", "low_turnover", "high_yield_equity_only"]
+
+# État de chaque processus de calcul : matrice projetée en mémoire (lecture seule) et instance de Strategies
+_worker = {}
+
+
+def _init_worker(snapshot_dir, db_file, products):
+    """Initialise un processus de calcul sur la matrice de rendements partagée (memory-map, sans copie ni requête SQL)."""
+    matrix = ReturnsMatrix.open(snapshot_dir, n_rows=0)
+    strategies = Strategies(db_file, returns_matrix=matrix)
+    strategies._products = products
+    _worker["matrix"] = matrix
+    _worker["strategies"] = strategies
+
+
+def _run_strategy(method, date_str, args, kwargs):
+    """Exécute une stratégie sur les rendements de la matrice partagée antérieurs à date_str."""
+    _worker["matrix"].advance_to(date_str)
+    strategies = _worker["strategies"]
+    strategies.solve_stats.clear()
+    return getattr(strategies, method)(*args, **kwargs), list(strategies.solve_stats)
+
+
+class Backtester:
+    """
+    Rejoue la boucle hebdomadaire du notebook (calcul des portefeuilles tous les lundis) entièrement en mémoire.
+
+    Les rendements sont lus dans la copie projetée en mémoire de la table Returns (voir refresh_snapshot) ;
+    à chaque date, la matrice passée aux stratégies ne rend visibles que les observations antérieures à cette date
+    et n'est complétée que par les lignes de la semaine.
+    Les portefeuilles calculés sont gardés en mémoire puis écrits dans Portfolios et PortfolioWeights, avec les deals
+    correspondants dans DealLines, en une seule transaction (PortfolioWriter), à la fin du backtest ou toutes les
+    flush_every semaines.
+
+    Paramètres :
+      start, end          : bornes du calendrier hebdomadaire (lundis)
+      db_file             : chemin vers la base de données SQLite
+      target_volatility   : volatilité cible de low_risk
+      days                : fenêtre (en jours) de high_yield
+      window_size         : taille de fenêtre de linear_strategy
+      model_path          : modèle pré-entraîné de linear_strategy
+      max_deals_per_month : nombre maximal de deals low_turnover par mois
+      flush_every         : nombre de semaines entre deux écritures (None : une seule écriture à la fin)
+      write               : si False, rien n'est écrit dans la base (résultats disponibles dans self.portfolios)
+      synchronous         : niveau de durabilité des écritures (PRAGMA synchronous, voir PortfolioWriter)
+      verbose             : affiche le déroulement semaine par semaine
+      workers             : nombre de processus pour évaluer les stratégies d'une même date en parallèle
+                            (None ou 1 : évaluation séquentielle)
+      returns_snapshot    : répertoire d'une matrice de rendements écrite par ReturnsMatrix.save (par défaut,
+                            la copie de la table Returns de db_file, réexportée si elle est périmée)
+    """
+
+    def __init__(self, start, end, db_file="fund.db", target_volatility=0.10, days=14, window_size=10,
+                 model_path="model.pkl", max_deals_per_month=2, flush_every=None, write=True, verbose=False,
+                 workers=None, returns_snapshot=None, synchronous=None):
+        self.start = pd.to_datetime(start)
+        self.end = pd.to_datetime(end)
+        self.db_file = db_file
+        self.target_volatility = target_volatility
+        self.days = days
+        self.window_size = window_size
+        self.model_path = model_path
+        self.max_deals_per_month = max_deals_per_month
+        self.flush_every = flush_every
+        self.write = write
+        self.synchronous = synchronous
+        self.verbose = verbose
+        self.workers = workers
+        self.returns_snapshot = returns_snapshot or refresh_snapshot(db_file)
+
+        # Historique complet des allocations : liste de (date, profil, DataFrame des poids)
+        self.portfolios = []
+
+        self._load()
+
+    def _load(self):
+        """Projette en mémoire la matrice des rendements et charge les derniers poids connus de chaque profil."""
+        start_str = self.start.strftime("%Y-%m-%d")
+        with read_connection(self.db_file) as conn:
+            self.last_weights = {}
+            for profile in PROFILES:
+                weights = latest_weights(conn, profile, before=start_str)
+                if weights is not None:
+                    self.last_weights[profile] = weights
+
+        self.returns_matrix = ReturnsMatrix.open(self.returns_snapshot, n_rows=0)
+
+        # Matrice initiale : observations antérieures au premier lundi du calendrier
+        self._advance(start_str)
+        self.strategies = Strategies(self.db_file, returns_matrix=self.returns_matrix)
+        # Poids de référence des deals : ceux d'avant le backtest (le writer suit ensuite les poids écrits)
+        self._start_weights = dict(self.last_weights)
+        self.writer = PortfolioWriter(self.db_file, synchronous=self.synchronous,
+                                      last_weights=self.last_weights) if self.write else None
+
+    def _evaluate(self, date_str, tasks, executor):
+        """
+        Évalue les stratégies d'une date : tasks est une liste de (profil, méthode, args, kwargs).
+        En parallèle, chaque stratégie est soumise au pool et les résultats sont rassemblés dans l'ordre de tasks.
+        """
+        if executor is None:
+            return {profile: getattr(self.strategies, method)(*args, **kwargs) for profile, method, args, kwargs in tasks}
+
+        futures = [(profile, executor.submit(_run_strategy, method, date_str, args, kwargs))
+                   for profile, method, args, kwargs in tasks]
+        results = {}
+        for profile, future in futures:
+            results[profile], solve_stats = future.result()
+            self.strategies.solve_stats.extend(solve_stats)
+        return results
+
+    def _start_executor(self):
+        """Démarre le pool de processus, chacun projetant en mémoire la même matrice de rendements."""
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(self.returns_snapshot, self.db_file, self.strategies.products))
+
+    def _advance(self, date_str):
+        """Rend visibles les rendements datés d'avant date_str."""
+        self.returns_matrix.advance_to(date_str)
+
+    def _record(self, date_str, risk_profile, weight_df):
+        """
+        Enregistre en mémoire une allocation (les deals sont calculés en bloc, voir deal_lines).
+        Comme dans main.ipynb, weight_df=None (semaine low_turnover sans investissement) est transmis au writer,
+        qui efface les deals éventuels de cette date, sans ajouter de portefeuille.
+        """
+        if weight_df is not None:
+            self.last_weights[risk_profile] = weight_df
+            self.portfolios.append((date_str, risk_profile, weight_df))
+        if self.writer is not None:
+            self.writer.add(date_str, risk_profile, weight_df)
+
+    def deal_lines(self):
+        """Deals de tout le backtest au format long (date, profile, product_id, delta_weight), calculés en une seule opération."""
+        portfolios = [(profile, date_str, weight_df) for date_str, profile, weight_df in self.portfolios]
+        return deal_lines(allocations_frame(portfolios), self._start_weights)
+
+    def run(self):
+        """Déroule le calendrier hebdomadaire et renvoie la liste des allocations calculées."""
+        executor = self._start_executor() if self.workers and self.workers > 1 else None
+        try:
+            self._run(executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return self.portfolios
+
+    def _run(self, executor):
+        nb_deals = 0
+        prev_month = None
+        started = time.perf_counter()
+
+        for week, current_date in enumerate(pd.date_range(start=self.start, end=self.end, freq="W-MON"), start=1):
+            date_str = current_date.strftime("%Y-%m-%d")
+
+            # Détection d'un nouveau mois : réinitialisation du compteur de deals
+            month_year = current_date.strftime("%Y-%m")
+            if month_year != prev_month:
+                nb_deals = 0
+                prev_month = month_year
+
+            # 1. Rendements disponibles à cette date
+            if executor is None:
+                self._advance(date_str)
+
+            # 2. Calcul des portefeuilles optimaux pour chaque stratégie
+            # (pour low_turnover, le modèle n'est évalué que si un deal est encore possible ce mois-ci)
+            previous_low_risk = self.last_weights.get("low_risk", pd.Series(dtype=float))
+            tasks = [("low_risk", "low_risk", (self.target_volatility,), {"initial_weights": previous_low_risk})]
+            if nb_deals < self.max_deals_per_month:
+                tasks.append(("low_turnover", "linear_strategy", (date_str, self.window_size, self.model_path), {}))
+            tasks.append(("high_yield_equity_only", "high_yield", (self.days,), {}))
+            results = self._evaluate(date_str, tasks, executor)
+
+            # 3. Enregistrement des portefeuilles et deals
+            if results["low_risk"] is not None:
+                self._record(date_str, "low_risk", results["low_risk"])
+            elif self.verbose:
+                print("Portefeuille low_risk non généré.")
+
+            # Pour la stratégie low_turnover, on limite le nombre de deals par mois
+            if "low_turnover" in results:
+                self._record(date_str, "low_turnover", results["low_turnover"])
+                if results["low_turnover"] is not None:
+                    nb_deals += 1
+            elif self.verbose:
+                print(f"Pour low_turnover, {self.max_deals_per_month} deals ont déjà été enregistrés en {month_year}, mise à jour ignorée.")
+
+            if results["high_yield_equity_only"] is not None:
+                self._record(date_str, "high_yield_equity_only", results["high_yield_equity_only"])
+            elif self.verbose:
+                print("Portefeuille high_yield_equity_only non généré.")
+
+            if self.verbose:
+                print(f"{date_str} traité")
+
+            if self.flush_every and week % self.flush_every == 0:
+                self.flush()
+
+        self.flush()
+        if self.verbose:
+            print(f"Backtest terminé en {time.perf_counter() - started:.2f} s : {len(self.portfolios)} portefeuilles.")
+
+    def flush(self):
+        """Écrit les portefeuilles, deals et rendements matérialisés en attente dans la base, en une seule transaction."""
+        if self.writer is not None:
+            self.writer.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest hebdomadaire des trois stratégies, sans Jupyter.")
+    parser.add_argument("--start", default="2023-01-02")
+    parser.add_argument("--end", default="2024-12-12")
+    parser.add_argument("--db", default="fund.db")
+    parser.add_argument("--model", default="model.pkl")
+    parser.add_argument("--flush-every", type=int, default=None, help="nombre de semaines entre deux écritures")
+    parser.add_argument("--dry-run", action="store_true", help="n'écrit rien dans la base")
+    parser.add_argument("--workers", type=int, default=None, help="processus pour évaluer les stratégies en parallèle")
+    parser.add_argument("--synchronous", default=None, choices=SYNCHRONOUS_LEVELS,
+                        help="durabilité des écritures (PRAGMA synchronous)")
+    args = parser.parse_args()
+
+    backtester = Backtester(args.start, args.end, db_file=args.db, model_path=args.model,
+                            flush_every=args.flush_every, write=not args.dry_run, verbose=True,
+                            workers=args.workers, synchronous=args.synchronous)
+    backtester.run()
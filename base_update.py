@@ -1,12 +1,84 @@
-import sqlite3
 import json
 import pandas as pd
 from datetime import timedelta
-from io import StringIO  # Ajout de l'import StringIO
+from itertools import repeat
+from database import check_schema, connect, read_connection
+from metrics import write_portfolio_returns
+from returns_matrix import bump_data_version
+
+# Niveaux de durabilité SQLite (PRAGMA synchronous) acceptés par PortfolioWriter
+SYNCHRONOUS_LEVELS = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
+
+def insert_portfolio(cursor, risk_profile, date_str, weight_df):
+    """
+    Insère un portefeuille dans Portfolios et ses poids dans PortfolioWeights (une ligne par produit, en une seule
+    requête executemany). Renvoie le portfolio_id créé. Le commit est laissé à l'appelant.
+    """
+    cursor.execute("""INSERT INTO Portfolios (type, date_creation, produits)
+        VALUES (?, ?, NULL)""", (risk_profile, date_str))
+    portfolio_id = cursor.lastrowid
+    cursor.executemany("""INSERT INTO PortfolioWeights (portfolio_id, product_id, weight)
+        VALUES (?, ?, ?)""", zip(repeat(portfolio_id), weight_df.index.astype(int).tolist(), weight_df["weight"].tolist()))
+    return portfolio_id
+
+
+def insert_portfolios(cursor, portfolios):
+    """
+    Insère une suite de portefeuilles (profil, date, DataFrame des poids) : une ligne Portfolios par portefeuille,
+    puis les poids de tous les portefeuilles en une seule requête executemany. Renvoie les portfolio_id créés.
+    Le commit est laissé à l'appelant.
+    """
+    portfolio_ids = []
+    rows = []
+    for risk_profile, date_str, weight_df in portfolios:
+        cursor.execute("""INSERT INTO Portfolios (type, date_creation, produits)
+            VALUES (?, ?, NULL)""", (risk_profile, date_str))
+        portfolio_ids.append(cursor.lastrowid)
+        rows.extend(zip(repeat(cursor.lastrowid), weight_df.index.astype(int).tolist(), weight_df["weight"].tolist()))
+    cursor.executemany("""INSERT INTO PortfolioWeights (portfolio_id, product_id, weight)
+        VALUES (?, ?, ?)""", rows)
+    return portfolio_ids
+
+
+def allocations_frame(portfolios):
+    """
+    Met une suite de (profil, date, DataFrame des poids) au format long (profile, date, product_id, weight, allocation),
+    allocation étant la position du portefeuille dans la suite.
+    """
+    frames = [pd.DataFrame({"profile": profile, "date": date_str, "product_id": weight_df.index.astype(int),
+                            "weight": weight_df["weight"].to_numpy(dtype=float), "allocation": position})
+              for position, (profile, date_str, weight_df) in enumerate(portfolios)]
+    if not frames:
+        return pd.DataFrame(columns=["profile", "date", "product_id", "weight", "allocation"])
+    return pd.concat(frames, ignore_index=True)
+
+
+def latest_weights(conn, risk_profile, before=None):
+    """
+    Poids du dernier portefeuille enregistré pour risk_profile (créé avant la date before si elle est renseignée).
+
+    Retourne un DataFrame (index = product_id, colonne "weight"), ou None si aucun portefeuille n'a de poids.
+    """
+    date_filter = "AND p.date_creation < ?" if before is not None else ""
+    params = (risk_profile, before) if before is not None else (risk_profile,)
+    weights = pd.read_sql_query(f"""
+        SELECT product_id, weight FROM PortfolioWeights
+        WHERE portfolio_id = (
+            SELECT p.portfolio_id FROM Portfolios p
+            WHERE p.type = ? {date_filter}
+            AND EXISTS (SELECT 1 FROM PortfolioWeights w WHERE w.portfolio_id = p.portfolio_id)
+            ORDER BY p.date_creation DESC, p.portfolio_id DESC LIMIT 1)
+        ORDER BY product_id""", conn, params=params, index_col="product_id")
+    if weights.empty:
+        return None
+    weights.index.name = None
+    return weights.astype(float)
+
 
 def update_portfolio(date_str, risk_profile, weight_df, db_file="fund.db"):
     """
-    Met à jour la table Portfolios
+    Met à jour la table Portfolios (et les rendements matérialisés de la semaine du portefeuille, table PortfolioReturns)
     
     Paramètres :
       date_str     : Date de création du portefeuille
@@ -16,19 +88,77 @@ def update_portfolio(date_str, risk_profile, weight_df, db_file="fund.db"):
                       
     """
 
-    produits_json = weight_df.to_json(orient="index")
-    
-    with sqlite3.connect(db_file) as conn:
+    with connect(db_file) as conn:
+        check_schema(conn, db_file)
         cursor = conn.cursor()
-        cursor.execute("""INSERT INTO Portfolios (type, date_creation, produits)
-        VALUES (?, ?, ?)""", (risk_profile, date_str,produits_json))
+        insert_portfolio(cursor, risk_profile, date_str, weight_df)
+        write_portfolio_returns(conn, date_str, pd.to_datetime(date_str) + timedelta(days=6), [risk_profile])
         conn.commit()
 
 
+def deal_lines(allocations, previous=None):
+    """
+    Calcule en une seule opération ensembliste les lignes de deals d'une suite d'allocations, tous profils et dates confondus.
+
+    Le deal d'une allocation est la différence entre ses poids et ceux de l'allocation précédente du même profil
+    (la première allocation de chaque profil est comparée à previous[profil], ou à un portefeuille vide).
+    Si un profil a plusieurs allocations à la même date, seule la dernière de la suite est retenue
+    (comme latest_weights, qui lit le dernier portefeuille enregistré).
+
+    Paramètres :
+      allocations : poids au format long (profile, date, product_id, weight), avec éventuellement la colonne
+                    allocation (position de l'allocation dans la suite, voir allocations_frame) ; sans cette colonne,
+                    chaque couple (profil, date) est une seule allocation
+      previous    : dictionnaire {profil: DataFrame des poids (index = product_id, colonne "weight")}
+
+    Retourne un DataFrame (date, profile, product_id, delta_weight) limité aux variations non nulles.
+    """
+    columns = ["date", "profile", "product_id", "delta_weight"]
+    if allocations.empty:
+        return pd.DataFrame(columns=columns)
+
+    # Numéro de chaque allocation dans la suite de son profil (0 est réservé aux poids précédents)
+    current = allocations[["profile", "date", "product_id", "weight"]].copy()
+    if "allocation" in allocations.columns:
+        # DealLines n'a qu'une ligne par (profil, date, produit) : dernière allocation de chaque couple (profil, date)
+        allocation = allocations["allocation"]
+        current = current[allocation == allocation.groupby([current["profile"], current["date"]]).transform("max")]
+    current["seq"] = current.groupby("profile")["date"].rank(method="dense").astype(int)
+    initial = [pd.DataFrame({"profile": profile, "seq": 0, "product_id": weights.index.astype(int),
+                             "weight": weights["weight"].to_numpy(dtype=float)})
+               for profile, weights in (previous or {}).items() if profile in set(current["profile"])]
+
+    # L'allocation n devient la "précédente" de l'allocation n + 1 : une jointure externe donne toutes les variations
+    before = pd.concat([current.drop(columns="date")] + initial, ignore_index=True)
+    before["seq"] += 1
+    lines = current.merge(before, on=["profile", "seq", "product_id"], how="outer", suffixes=("", "_before"))
+    lines = lines[lines["seq"] <= lines["profile"].map(current.groupby("profile")["seq"].max())]
+    # Les produits vendus en totalité n'ont pas de ligne dans l'allocation : on reprend sa date
+    lines["date"] = lines.groupby(["profile", "seq"])["date"].transform("first")
+    lines["delta_weight"] = lines["weight"].fillna(0) - lines["weight_before"].fillna(0)
+    lines = lines[lines["delta_weight"] != 0]
+    return lines.sort_values(["profile", "date", "product_id"])[columns].reset_index(drop=True)
+
+
+def write_deal_lines(cursor, lines, deals=None):
+    """
+    Enregistre des lignes de deals (voir deal_lines) dans DealLines par executemany.
+    Les lignes déjà présentes pour les couples (profil, date) concernés sont remplacées ;
+    deals permet d'inclure des couples (profil, date) sans aucune variation. La version de DealLines
+    (table DataVersions) est incrémentée dans la même transaction ; le commit est laissé à l'appelant.
+    """
+    pairs = set(zip(lines["profile"], lines["date"])) | set(deals or [])
+    cursor.executemany("DELETE FROM DealLines WHERE profile = ? AND date = ?", sorted(pairs))
+    cursor.executemany("""INSERT INTO DealLines (date, profile, product_id, delta_weight)
+        VALUES (?, ?, ?, ?)""", zip(lines["date"].tolist(), lines["profile"].tolist(),
+                                    lines["product_id"].astype(int).tolist(), lines["delta_weight"].tolist()))
+    bump_data_version(cursor, "DealLines")
+
+
 def update_deals(date_str, risk_profile, new_weight_df=None, db_file="fund.db"):
     """
-    Met à jour la table Deals en calculant la différence entre les poids du nouveau portefeuille 
-    et ceux du dernier portefeuille enregistré pour le même profil de risque
+    Met à jour la table DealLines en calculant la différence entre les poids du nouveau portefeuille 
+    et ceux du dernier portefeuille enregistré avant date_str pour le même profil de risque
 
     Paramètres :
       date_str      : Date du deal
@@ -38,48 +168,127 @@ def update_deals(date_str, risk_profile, new_weight_df=None, db_file="fund.db"):
       db_file       : Chemin vers la base de données SQLite (défaut "fund.db")
     """
     
-    with sqlite3.connect(db_file) as conn:
-        conn.row_factory = sqlite3.Row
+    with connect(db_file) as conn:
+        check_schema(conn, db_file)
         cursor = conn.cursor()
         
         # 1. Recherche du dernier portefeuille avec le même profil de risque 
-        cursor.execute("""
-            SELECT produits 
-            FROM Portfolios 
-            WHERE type = ?
-            ORDER BY date_creation DESC
-            LIMIT 1
-        """, (risk_profile,))
-        row = cursor.fetchone()
-        if row is None:
-            old_weight_df = pd.DataFrame(columns=["weight"])
-        else:
-            old_json = row["produits"]
-            if old_json:
-                # Envelopper la chaîne JSON dans un objet StringIO
-                old_weight_df = pd.read_json(StringIO(old_json), orient="index")
-            else:
-                old_weight_df = pd.DataFrame(columns=["weight"])
+        old_weight_df = latest_weights(conn, risk_profile, before=date_str)
+        previous = {} if old_weight_df is None else {risk_profile: old_weight_df}
         
         # 2. Gestion de l'absence de nouveau portefeuille : new_weight_df est None
         if new_weight_df is None:
-            diff_json = None
+            allocations = pd.DataFrame(columns=["profile", "date", "product_id", "weight"])
         else:
-            new_weight_df = new_weight_df.copy()
             if "weight" not in new_weight_df.columns:
                 print("La DataFrame new_weight_df doit contenir une colonne 'weight'.")
                 return
-            diff_df = new_weight_df.subtract(old_weight_df, fill_value=0)
-            diff_json = diff_df.to_json(orient="index")
+            allocations = pd.DataFrame({"profile": risk_profile, "date": date_str,
+                                        "product_id": new_weight_df.index.astype(int),
+                                        "weight": new_weight_df["weight"].to_numpy(dtype=float)})
         
-        # 3. Mise à jour de la table Deals pour la date donnée, dans la colonne correspondant à risk_profile
-        cursor.execute("SELECT * FROM Deals WHERE date = ?", (date_str,))
-        existing = cursor.fetchone()
-        if existing:
-            query = f"UPDATE Deals SET \"{risk_profile}\" = ? WHERE date = ?"
-            cursor.execute(query, (diff_json, date_str))
-        else:
-            query = f"INSERT INTO Deals (date, \"{risk_profile}\") VALUES (?, ?)"
-            cursor.execute(query, (date_str, diff_json))
-            
+        # 3. Remplacement des lignes de deals du profil pour la date donnée
+        write_deal_lines(cursor, deal_lines(allocations, previous), deals=[(risk_profile, date_str)])
         conn.commit()
+
+
+class PortfolioWriter:
+    """
+    Regroupe l'écriture des portefeuilles et des deals de plusieurs dates et profils en une seule transaction.
+
+    add() garde les allocations en mémoire ; les deals sont calculés au moment de l'écriture par rapport aux derniers
+    poids connus du writer (ceux de la base avant la première date reçue pour chaque profil, puis ceux des allocations
+    déjà reçues), sans relire Portfolios ni Deals. flush() écrit Portfolios, PortfolioWeights, DealLines et
+    PortfolioReturns (executemany) puis valide une seule fois. Remplace, dans une boucle, les appels successifs
+    à update_portfolio et update_deals.
+
+    Paramètres :
+      db_file      : chemin vers la base de données SQLite
+      flush_every  : nombre de dates gardées en mémoire ; l'arrivée d'une date supplémentaire déclenche une écriture
+                     (None : écriture uniquement lors des appels à flush(), ou à la sortie d'un bloc with)
+      synchronous  : niveau de durabilité de la transaction d'écriture (PRAGMA synchronous, voir SYNCHRONOUS_LEVELS ;
+                     None : réglage de database.PRAGMAS)
+      last_weights : derniers poids connus {profil: DataFrame des poids} (par défaut, lus dans la base)
+    """
+
+    def __init__(self, db_file="fund.db", flush_every=None, synchronous=None, last_weights=None):
+        if synchronous is not None and str(synchronous).upper() not in SYNCHRONOUS_LEVELS:
+            raise ValueError(f"Niveau synchronous inconnu : {synchronous}. Niveaux possibles : {SYNCHRONOUS_LEVELS}")
+        self.db_file = db_file
+        self.flush_every = flush_every
+        self.synchronous = None if synchronous is None else str(synchronous).upper()
+        # Derniers poids connus de chaque profil (allocations en attente comprises) et poids de la dernière écriture
+        self.last_weights = {}
+        self._flushed_weights = {}
+        self._loaded = last_weights is not None
+        if last_weights is not None:
+            self.last_weights = {profile: weights for profile, weights in last_weights.items() if weights is not None}
+            self._flushed_weights = dict(self.last_weights)
+        self._known_profiles = set()
+        # Allocations en attente : liste de (profil, date, DataFrame des poids ou None si pas d'investissement)
+        self._pending = []
+        self._pending_dates = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _load_profile(self, risk_profile, date_str):
+        """Lit dans la base les poids du dernier portefeuille du profil antérieur à date_str (une fois par profil)."""
+        self._known_profiles.add(risk_profile)
+        if self._loaded:
+            return
+        with read_connection(self.db_file) as conn:
+            weights = latest_weights(conn, risk_profile, before=date_str)
+        if weights is not None:
+            self.last_weights[risk_profile] = weights
+            self._flushed_weights[risk_profile] = weights
+
+    def add(self, date_str, risk_profile, weight_df=None):
+        """
+        Ajoute l'allocation d'un profil à une date (weight_df : index = product_id, colonne "weight").
+        weight_df=None enregistre une date sans investissement : les deals éventuels de ce couple sont effacés.
+        """
+        if weight_df is not None and "weight" not in weight_df.columns:
+            print("La DataFrame weight_df doit contenir une colonne 'weight'.")
+            return
+        if self.flush_every and date_str not in self._pending_dates and len(self._pending_dates) >= self.flush_every:
+            self.flush()
+        if risk_profile not in self._known_profiles:
+            self._load_profile(risk_profile, date_str)
+
+        self._pending.append((risk_profile, date_str, weight_df))
+        self._pending_dates.add(date_str)
+        if weight_df is not None:
+            self.last_weights[risk_profile] = weight_df
+
+    def flush(self):
+        """Écrit les portefeuilles, deals et rendements matérialisés en attente dans la base, en une seule transaction."""
+        if not self._pending:
+            return
+        portfolios = [(profile, date_str, weights) for profile, date_str, weights in self._pending if weights is not None]
+        # Deals de toutes les allocations en attente, par rapport aux poids de la dernière écriture
+        lines = deal_lines(allocations_frame(portfolios), self._flushed_weights)
+
+        pragmas = {} if self.synchronous is None else {"synchronous": self.synchronous}
+        with connect(self.db_file, **pragmas) as conn:
+            cursor = conn.cursor()
+            insert_portfolios(cursor, portfolios)
+            write_deal_lines(cursor, lines, deals=[(profile, date_str) for profile, date_str, _ in self._pending])
+            if portfolios:
+                # Rendements quotidiens des semaines de détention des nouveaux portefeuilles (table PortfolioReturns)
+                dates = [pd.to_datetime(date_str) for _, date_str, _ in portfolios]
+                write_portfolio_returns(conn, min(dates), max(dates) + timedelta(days=6),
+                                        sorted({profile for profile, _, _ in portfolios}))
+            conn.commit()
+
+        for risk_profile, _, weight_df in portfolios:
+            self._flushed_weights[risk_profile] = weight_df
+        self._pending = []
+        self._pending_dates = set()
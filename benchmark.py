@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import creation_db
+import returns_matrix
+from base_update import PortfolioWriter, update_deals
+from database import close_connections, connect
+from import_data import DataImporter
+from market_data import LocalPriceStore
+from metrics import PortfolioMetrics
+from model import fit_model
+from returns_matrix import get_returns_matrix
+from strategies import Strategies
+
+try:
+    import resource
+except ImportError:  # Windows : pas de mesure de la mémoire
+    resource = None
+
+# Étapes mesurées, dans l'ordre d'exécution (les suivantes dépendent des données écrites par les précédentes)
+STAGES = ["fill_returns", "fill_returns_week", "write_portfolios", "fit_model", "load_returns_matrix",
+          "low_risk", "linear_strategy", "high_yield", "portfolio_metrics", "update_deals"]
+
+# Répartition des catégories des produits synthétiques (proche de celle de dicoo.full_categories_dict)
+CATEGORIES = {"Equity": 0.76, "Commodities": 0.19, "Bond": 0.05}
+
+PROFILES = ["low_risk", "low_turnover", "high_yield_equity_only"]
+
+
+def synthetic_products(n_products, seed=0):
+    """Produits synthétiques (ticker, category) : tickers SYN00001... et catégories tirées selon CATEGORIES."""
+    rng = np.random.default_rng(seed)
+    categories = rng.choice(list(CATEGORIES), size=n_products, p=list(CATEGORIES.values()))
+    # Au moins un produit de chaque catégorie, pour que toutes les stratégies aient des actifs éligibles
+    categories[:len(CATEGORIES)] = list(CATEGORIES)
+    return pd.DataFrame({"ticker": [f"SYN{i:05d}" for i in range(1, n_products + 1)], "category": categories})
+
+
+def synthetic_closes(tickers, years, end="2024-12-27", seed=0):
+    """
+    Cours de clôture synthétiques (marche aléatoire log-normale, volatilité propre à chaque produit)
+    sur 'years' années de séances ouvrées se terminant à end. DataFrame large : index = dates, colonnes = tickers.
+    """
+    rng = np.random.default_rng(seed + 1)
+    dates = pd.bdate_range(end=end, periods=int(round(252 * years)) + 10, name="Date")
+    volatility = rng.uniform(0.05, 0.40, size=len(tickers)) / np.sqrt(252)
+    drift = rng.normal(0.05, 0.05, size=len(tickers)) / 252
+    log_returns = rng.standard_normal((len(dates), len(tickers))) * volatility + drift
+    closes = 100 * np.exp(np.cumsum(log_returns, axis=0))
+    return pd.DataFrame(closes, index=dates, columns=list(tickers))
+
+
+def synthetic_portfolios(product_ids, mondays, portfolio_size=30, seed=0):
+    """
+    Allocations synthétiques hebdomadaires des trois profils : liste de (date, profil, DataFrame des poids)
+    sur portfolio_size produits tirés au hasard, poids positifs de somme 1.
+    """
+    rng = np.random.default_rng(seed + 2)
+    size = min(portfolio_size, len(product_ids))
+    portfolios = []
+    for monday in mondays:
+        for profile in PROFILES:
+            ids = np.sort(rng.choice(product_ids, size=size, replace=False))
+            portfolios.append((monday, profile, pd.DataFrame({"weight": rng.dirichlet(np.ones(size))}, index=ids)))
+    return portfolios
+
+
+def _max_rss_mb():
+    """Pic de mémoire résidente du processus (en Mio), None si la mesure n'est pas disponible."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sous macOS, en Kio sous Linux
+    return round(peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10, 1)
+
+
+def _git_commit():
+    """Commit courant du dépôt (None hors d'un dépôt git)."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _Recorder:
+    """Chronomètre les étapes d'un point d'échelle et accumule un enregistrement par étape."""
+
+    def __init__(self, context, stages, output=None):
+        self.context = context
+        self.stages = stages
+        self.output = output
+        self.records = []
+
+    def run(self, stage, func, repeat=1, rows=None, required=False):
+        """
+        Exécute func (repeat fois pour une étape rejouable, meilleur temps retenu) et renvoie son dernier résultat.
+        Une étape non sélectionnée n'est pas exécutée, sauf si les étapes suivantes en ont besoin (required).
+        """
+        if stage not in self.stages:
+            return func() if required else None
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - started)
+        record = {**self.context, "stage": stage, "seconds": round(best, 6), "repeat": repeat,
+                  "rows": rows(result) if rows is not None else None, "max_rss_mb": _max_rss_mb()}
+        self.records.append(record)
+        print(f"{stage:<22} {self.context['n_products']:>7} produits {self.context['years']:>5} ans  {best:10.4f} s")
+        if self.output is not None:
+            self.output.write(json.dumps(record) + "\n")
+            self.output.flush()
+        return result
+
+
+def _setup_database(db_file, products):
+    """Crée les tables dans db_file et y enregistre les produits synthétiques."""
+    previous = creation_db.db_file
+    creation_db.db_file = db_file
+    try:
+        creation_db.create_tables()
+    finally:
+        creation_db.db_file = previous
+    with connect(db_file) as conn:
+        conn.executemany("INSERT INTO Products (ticker, category) VALUES (?, ?)",
+                         products[["ticker", "category"]].itertuples(index=False, name=None))
+        conn.commit()
+        return pd.read_sql_query("SELECT product_id FROM Products ORDER BY product_id", conn)["product_id"].to_numpy()
+
+
+def run_scale(n_products, years, work_dir, stages=STAGES, repeat=3, seed=0, portfolio_size=30, output=None,
+              context=None):
+    """
+    Génère une base synthétique de n_products produits sur 'years' années dans work_dir et chronomètre chaque étape.
+
+    Les rendements sont importés par DataImporter.fill_returns depuis un LocalPriceStore (historique complet
+    moins la dernière semaine, puis la dernière semaine) ; les portefeuilles hebdomadaires des trois profils sont écrits
+    par PortfolioWriter. Les étapes rejouables (modèle, stratégies, métriques, deals) sont exécutées repeat fois.
+
+    Retourne la liste des enregistrements (un dictionnaire par étape).
+    """
+    recorder = _Recorder({**(context or {}), "n_products": n_products, "years": years}, stages, output)
+    db_file = os.path.join(work_dir, "bench.db")
+
+    products = synthetic_products(n_products, seed)
+    product_ids = _setup_database(db_file, products)
+    closes = synthetic_closes(products["ticker"], years, seed=seed)
+    store = LocalPriceStore(os.path.join(work_dir, "prices"), format="npz")
+    store.write(closes)
+
+    dates = closes.index
+    first, last_week, end = (date.strftime("%Y-%m-%d") for date in (dates[0], dates[-5], dates[-1] + pd.Timedelta(days=1)))
+    importer = DataImporter(db_file, provider=store)
+    recorder.run("fill_returns", lambda: importer.fill_returns(first, last_week), required=True)
+    recorder.run("fill_returns_week", lambda: importer.fill_returns(last_week, end), required=True)
+
+    # Portefeuilles hebdomadaires à partir de la date où 252 rendements sont disponibles
+    mondays = [date.strftime("%Y-%m-%d") for date in pd.date_range(dates[min(257, len(dates) - 1)], dates[-1], freq="W-MON")]
+    portfolios = synthetic_portfolios(product_ids, mondays, portfolio_size, seed)
+
+    def write_portfolios():
+        with PortfolioWriter(db_file, last_weights={}) as writer:
+            for date_str, profile, weights in portfolios:
+                writer.add(date_str, profile, weights)
+    recorder.run("write_portfolios", write_portfolios, rows=lambda _: len(portfolios), required=True)
+
+    model_path = os.path.join(work_dir, "model.pkl")
+    recorder.run("fit_model", lambda: fit_model(first, end, db_file=db_file, model_path=model_path),
+                 required="linear_strategy" in stages)
+    # Chargement à froid : la matrice partagée, déjà chargée par les écritures précédentes, est d'abord oubliée
+    def load_matrix():
+        returns_matrix._shared_matrices.pop(os.path.abspath(db_file), None)
+        return get_returns_matrix(db_file)
+    recorder.run("load_returns_matrix", load_matrix, rows=lambda matrix: int(np.isfinite(matrix.values).sum()),
+                 required=True)
+
+    target_date = (dates[-1] + pd.Timedelta(days=3)).strftime("%Y-%m-%d")
+    strategies = Strategies(db_file)
+    results = {
+        "low_risk": recorder.run("low_risk", lambda: strategies.low_risk(), repeat),
+        "low_turnover": recorder.run("linear_strategy",
+                                     lambda: strategies.linear_strategy(target_date, model_path=model_path), repeat),
+        "high_yield_equity_only": recorder.run("high_yield", lambda: strategies.high_yield(), repeat),
+    }
+
+    recorder.run("portfolio_metrics", lambda: [PortfolioMetrics(profile, db_file) for profile in PROFILES], repeat)
+
+    def deals():
+        for profile, weights in results.items():
+            update_deals(target_date, profile, weights, db_file=db_file)
+    recorder.run("update_deals", deals, repeat)
+
+    # Libération de la matrice partagée et des connexions de cette base avant de passer à l'échelle suivante
+    returns_matrix._shared_matrices.pop(os.path.abspath(db_file), None)
+    close_connections()
+    return recorder.records
+
+
+def run_benchmark(products=(100,), years=(1,), stages=STAGES, repeat=3, seed=0, portfolio_size=30, output=None):
+    """
+    Exécute run_scale pour chaque combinaison (nombre de produits, nombre d'années), chacune dans un répertoire
+    temporaire supprimé ensuite, et renvoie un DataFrame avec une ligne par (échelle, étape).
+
+    output : fichier ouvert où écrire chaque enregistrement en JSON (une ligne par étape, au fil de l'eau)
+    """
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Étapes inconnues : {sorted(unknown)}. Étapes possibles : {STAGES}")
+    context = {"run_at": datetime.now().isoformat(timespec="seconds"), "commit": _git_commit(),
+               "python": platform.python_version(), "seed": seed}
+    records = []
+    for n_products in products:
+        for n_years in years:
+            work_dir = tempfile.mkdtemp(prefix="bench_")
+            try:
+                records.extend(run_scale(n_products, n_years, work_dir, stages, repeat, seed, portfolio_size,
+                                         output, context))
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    return pd.DataFrame(records)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Banc d'essai de la chaîne complète sur des données synthétiques.")
+    parser.add_argument("--products", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--years", type=float, nargs="+", default=[1, 5])
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--repeat", type=int, default=3, help="exécutions des étapes rejouables (meilleur temps retenu)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--portfolio-size", type=int, default=30, help="nombre de produits des portefeuilles synthétiques")
+    parser.add_argument("--output", default=None, help="fichier JSON Lines où ajouter les résultats")
+    args = parser.parse_args()
+
+    output = open(args.output, "a") if args.output else None
+    try:
+        results = run_benchmark(args.products, args.years, args.stages, args.repeat, args.seed, args.portfolio_size,
+                                output)
+    finally:
+        if output is not None:
+            output.close()
+    print(results.pivot_table(index="stage", columns=["n_products", "years"], values="seconds", sort=False).to_string())
@@ -0,0 +1,151 @@
+import numpy as np
+from sklearn.covariance import ledoit_wolf_shrinkage
+
+# Estimateurs de shrinkage disponibles (en plus d'une intensité fixe entre 0 et 1)
+SHRINKAGE_METHODS = ["oas", "ledoit_wolf"]
+
+
+class RollingCovariance:
+    """
+    Matrice de covariance des 'window' dernières observations de chaque produit, tenue à jour de façon incrémentale.
+
+    Le moteur garde la fenêtre courante (tampon circulaire window x produits) et les sommes, décalées par la moyenne
+    de la dernière reconstruction, des rendements et de leurs produits croisés. À chaque appel, seules les lignes
+    ajoutées à la matrice depuis la synchronisation précédente (DataImporter.fill_returns, advance_to du backtest)
+    sont traitées : la plus ancienne observation sort de la fenêtre, la nouvelle y entre, pour un coût O(k x n²)
+    pour k nouvelles lignes et n produits au lieu de O(window x n²).
+
+    La mise à jour incrémentale suppose que toutes les fenêtres glissent ensemble. Le moteur recalcule
+    entièrement la fenêtre (last_observations) lorsque ce n'est pas le cas :
+      - une nouvelle ligne n'a une observation que pour une partie des produits suivis ;
+      - un produit atteint window observations ;
+      - des lignes déjà vues ont changé (voir ReturnsMatrix.history_version) ;
+      - rebuild_every lignes ont été ajoutées depuis la dernière reconstruction (limite la dérive numérique).
+
+    Paramètres :
+      returns_matrix : matrice des rendements (ReturnsMatrix) suivie par le moteur
+      window         : nombre d'observations par produit
+      rebuild_every  : nombre de lignes ajoutées entre deux reconstructions complètes (par défaut window)
+    """
+
+    def __init__(self, returns_matrix, window=252, rebuild_every=None):
+        self.returns_matrix = returns_matrix
+        self.window = window
+        self.rebuild_every = rebuild_every or window
+        self.product_ids = np.array([], dtype=np.int64)
+        self._cols = np.array([], dtype=np.int64)
+        self._block = np.empty((window, 0))
+        self._head = 0
+        self._shift = np.array([])
+        self._sum = np.array([])
+        self._cross = np.empty((0, 0))
+        self._synced_rows = None
+        self._synced_history = None
+        self._since_rebuild = 0
+        # Nombre de reconstructions complètes et de lignes traitées de façon incrémentale
+        self.stats = {"rebuilds": 0, "incremental_rows": 0}
+
+    def _rebuild(self):
+        """Recalcule la fenêtre et les sommes à partir de la matrice des rendements."""
+        matrix = self.returns_matrix
+        product_ids, block = matrix.last_observations(self.window)
+        self.product_ids = product_ids
+        self._cols = matrix._columns(product_ids)
+        self._block = np.array(block, dtype=float)
+        self._head = 0
+        self._shift = self._block.mean(axis=0) if len(product_ids) else np.array([])
+        centered = self._block - self._shift
+        self._sum = centered.sum(axis=0)
+        self._cross = centered.T @ centered
+        self._synced_rows = len(matrix)
+        self._synced_history = matrix.history_version
+        self._since_rebuild = 0
+        self.stats["rebuilds"] += 1
+
+    def update(self):
+        """Synchronise la fenêtre avec les lignes ajoutées à la matrice des rendements depuis le dernier appel."""
+        matrix = self.returns_matrix
+        n_rows = len(matrix)
+        if (self._synced_rows is None or matrix.history_version != self._synced_history
+                or n_rows < self._synced_rows):
+            self._rebuild()
+            return
+        if n_rows == self._synced_rows:
+            return
+
+        # Un produit qui atteint window observations entre dans la fenêtre : reconstruction
+        if int((matrix._counts >= self.window).sum()) != len(self.product_ids):
+            self._rebuild()
+            return
+
+        new = matrix.values[self._synced_rows:n_rows, self._cols]
+        observed = ~np.isnan(new)
+        shifted = observed.any(axis=1)
+        k = int(shifted.sum())
+        if not observed[shifted].all() or k >= self.window or self._since_rebuild + k > self.rebuild_every:
+            self._rebuild()
+            return
+
+        if k:
+            new = new[shifted]
+            slots = (self._head + np.arange(k)) % self.window
+            removed = self._block[slots] - self._shift
+            added = new - self._shift
+            self._sum += added.sum(axis=0) - removed.sum(axis=0)
+            self._cross += added.T @ added - removed.T @ removed
+            self._block[slots] = new
+            self._head = (self._head + k) % self.window
+            self._since_rebuild += k
+            self.stats["incremental_rows"] += k
+        self._synced_rows = n_rows
+
+    def observations(self):
+        """Fenêtre courante (window x produits), triée chronologiquement, colonnes triées par product_id."""
+        self.update()
+        return np.roll(self._block, -self._head, axis=0)
+
+    def covariance(self, shrinkage=None):
+        """
+        Renvoie un couple (product_ids, matrice de covariance des rendements quotidiens) de la fenêtre courante.
+
+        shrinkage : None (covariance empirique, identique à DataFrame.cov), intensité fixe entre 0 et 1,
+                    "oas" (Oracle Approximating Shrinkage, calculé à partir de la seule covariance)
+                    ou "ledoit_wolf" (intensité de Ledoit-Wolf, calculée sur la fenêtre : O(window x n²)).
+                    La covariance est rétrécie vers mu x I, mu étant la variance moyenne.
+        """
+        self.update()
+        n = len(self.product_ids)
+        if n == 0:
+            return self.product_ids, np.empty((0, 0))
+
+        cov = (self._cross - np.outer(self._sum, self._sum) / self.window) / (self.window - 1)
+        # Symétrie exacte malgré les arrondis des mises à jour successives
+        cov = (cov + cov.T) / 2
+        if shrinkage is None:
+            return self.product_ids, cov
+
+        if shrinkage == "oas":
+            intensity = _oas_shrinkage(cov * (self.window - 1) / self.window, self.window)
+        elif shrinkage == "ledoit_wolf":
+            intensity = ledoit_wolf_shrinkage(self.observations())
+        elif isinstance(shrinkage, str):
+            raise ValueError(f"Shrinkage inconnu : {shrinkage}. Méthodes possibles : {SHRINKAGE_METHODS}")
+        else:
+            intensity = float(shrinkage)
+            if not 0 <= intensity <= 1:
+                raise ValueError(f"L'intensité du shrinkage doit être comprise entre 0 et 1 : {shrinkage}")
+
+        mu = np.trace(cov) / n
+        shrunk = (1 - intensity) * cov
+        shrunk.flat[::n + 1] += intensity * mu
+        return self.product_ids, shrunk
+
+
+def _oas_shrinkage(emp_cov, n_samples):
+    """Intensité Oracle Approximating Shrinkage (Chen et al., 2010) d'une covariance empirique (normalisée par n_samples)."""
+    n_features = emp_cov.shape[0]
+    mu = np.trace(emp_cov) / n_features
+    alpha = np.mean(emp_cov ** 2)
+    num = alpha + mu ** 2
+    den = (n_samples + 1.0) * (alpha - mu ** 2 / n_features)
+    return 1.0 if den == 0 else min(num / den, 1.0)
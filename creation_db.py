@@ -3,7 +3,15 @@ from faker import Faker
 import sqlite3
 import json
 import random
+import shutil
+import sys
+from database import (DATA_VERSIONS_TABLE_SQL, DEAL_LINES_INDEX_SQL, DEAL_LINES_TABLE_SQL, PORTFOLIO_RETURNS_TABLE_SQL,
+                      PORTFOLIO_WEIGHTS_INDEX_SQL, PORTFOLIO_WEIGHTS_TABLE_SQL, RETURNS_INDEX_SQL, RETURNS_TABLE_SQL,
+                      WATERMARKS_TABLE_SQL, connect, migrate_deal_lines_table, migrate_portfolio_weights_table,
+                      migrate_returns_table)
 from dicoo import tickers_brut, full_categories_dict
+from metrics import write_portfolio_returns
+from returns_matrix import snapshot_dir
 fake = Faker()
 db_file = "fund.db"
 from datetime import date, timedelta
@@ -12,7 +20,7 @@ import yfinance as yf
 # Création des tables dans l'ordre hiérarchique
 def create_tables():
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
         
         # Table Clients
@@ -65,13 +73,21 @@ def create_tables():
             high_yield_equity_only TEXT        
         );""")
 
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS Returns (
-            product_id INTEGER NOT NULL,
-            date DATE,
-            value REAL,
-            FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE
-        );""")
+        cursor.execute(RETURNS_TABLE_SQL.format(table="Returns"))
+        cursor.execute(RETURNS_INDEX_SQL)
+        cursor.execute(PORTFOLIO_WEIGHTS_TABLE_SQL)
+        for index_sql in PORTFOLIO_WEIGHTS_INDEX_SQL:
+            cursor.execute(index_sql)
+        cursor.execute(DEAL_LINES_TABLE_SQL)
+        cursor.execute(DEAL_LINES_INDEX_SQL)
+        cursor.execute(WATERMARKS_TABLE_SQL)
+        cursor.execute(DATA_VERSIONS_TABLE_SQL)
+        # PortfolioReturns est remplie dès sa création, pour ne jamais être lue vide à côté de portefeuilles existants
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'PortfolioReturns'")
+        materialized = cursor.fetchone() is not None
+        cursor.execute(PORTFOLIO_RETURNS_TABLE_SQL)
+        if not materialized:
+            write_portfolio_returns(conn)
         
         conn.commit()
         print("Tables créées avec succès.")
@@ -82,10 +98,79 @@ def create_tables():
         if conn:
             conn.close()
 
+# Migration d'une table Returns créée sans clé : suppression des doublons (product_id, date)
+# en conservant la dernière valeur insérée, puis création des index
+def migrate_returns():
+    try:
+        conn = connect(db_file)
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'Returns'")
+        if cursor.fetchone() is None:
+            print("Aucune table Returns à migrer.")
+            return
+
+        # Table sans clé reconstruite avec la clé (product_id, date) (voir database.migrate_returns_table)
+        migrate_returns_table(cursor)
+        cursor.execute(RETURNS_INDEX_SQL)
+        conn.commit()
+        print("Table Returns migrée avec succès.")
+
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite lors de la migration de la table Returns : {e}")
+    finally:
+        if conn:
+            conn.close()
+
+# Migration des poids stockés en JSON dans Portfolios.produits vers la table PortfolioWeights
+# (seuls les portefeuilles qui n'ont encore aucune ligne dans PortfolioWeights sont migrés)
+def migrate_portfolio_weights():
+    try:
+        conn = connect(db_file)
+        n_rows = migrate_portfolio_weights_table(conn.cursor())
+        conn.commit()
+        print(f"Poids des portefeuilles migrés avec succès : {n_rows} lignes.")
+
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite lors de la migration des poids des portefeuilles : {e}")
+    finally:
+        if conn:
+            conn.close()
+
+# Migration des deals stockés en JSON dans les colonnes de Deals vers la table DealLines
+# (seuls les couples (profil, date) qui n'ont encore aucune ligne dans DealLines sont migrés)
+def migrate_deal_lines():
+    try:
+        conn = connect(db_file)
+        n_rows = migrate_deal_lines_table(conn.cursor())
+        conn.commit()
+        print(f"Deals migrés avec succès : {n_rows} lignes.")
+
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite lors de la migration des deals : {e}")
+    finally:
+        if conn:
+            conn.close()
+
+# Recalcul complet de la table PortfolioReturns (après une migration ou un rattrapage d'historique)
+def rebuild_portfolio_returns():
+    try:
+        conn = connect(db_file)
+        conn.execute(PORTFOLIO_RETURNS_TABLE_SQL)
+        n_rows = write_portfolio_returns(conn)
+        conn.commit()
+        print(f"Rendements des portefeuilles recalculés avec succès : {n_rows} lignes.")
+
+    except sqlite3.Error as e:
+        print(f"Erreur SQLite lors du recalcul des rendements des portefeuilles : {e}")
+    finally:
+        if conn:
+            conn.close()
+
 # Création des portefeuillessous forme de JSON vide
 def create_initial_portfolios():
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
 
         # Insertion des 3 portefeuilles sous forme de liste JSON
@@ -110,7 +195,7 @@ def create_initial_portfolios():
 # Génération de clients avec un profil de risque assigné aléatoirement
 def generate_clients(n: int = 10):
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
         
         clients = []
@@ -148,7 +233,7 @@ def generate_clients(n: int = 10):
 # Génération de managers liés aux portefeuilles
 def generate_managers(n: int = 5):
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
         
         # Récupération des IDs de portefeuille
@@ -178,7 +263,7 @@ def generate_managers(n: int = 5):
  
 def generate_products():
     try:
-        conn = sqlite3.connect(db_file)
+        conn = connect(db_file)
         cursor = conn.cursor()
         
         # Insertion des produits
@@ -198,16 +283,43 @@ def generate_products():
 
 # Exécution du script
 if __name__ == "__main__":
-    conn = sqlite3.connect(db_file)
+    # --migrate : met à jour le schéma d'une base existante sans la recréer
+    # (seul chemin qui reconstruit des tables : les lecteurs ne font que vérifier le schéma, voir database.check_schema)
+    if "--migrate" in sys.argv:
+        migrate_returns()
+        migrate_portfolio_weights()
+        migrate_deal_lines()
+        create_tables()
+        rebuild_portfolio_returns()
+        sys.exit()
+
+    # --rebuild-portfolio-returns : recalcule la table PortfolioReturns (ex. après un rattrapage de rendements)
+    if "--rebuild-portfolio-returns" in sys.argv:
+        rebuild_portfolio_returns()
+        sys.exit()
+
+    conn = connect(db_file)
     cursor = conn.cursor()
    
+    # Les rendements, watermarks et versions portent sur les anciens product_id : ils sont supprimés avec les produits
     cursor.execute("DROP TABLE IF EXISTS Clients;")
+    cursor.execute("DROP TABLE IF EXISTS Deals;")
+    cursor.execute("DROP TABLE IF EXISTS PortfolioWeights;")
+    cursor.execute("DROP TABLE IF EXISTS DealLines;")
+    cursor.execute("DROP TABLE IF EXISTS PortfolioReturns;")
     cursor.execute("DROP TABLE IF EXISTS Portfolios;")
     cursor.execute("DROP TABLE IF EXISTS Managers;")
+    cursor.execute("DROP TABLE IF EXISTS Returns;")
+    cursor.execute("DROP TABLE IF EXISTS IngestionWatermarks;")
+    cursor.execute("DROP TABLE IF EXISTS DataVersions;")
     cursor.execute("DROP TABLE IF EXISTS Products;")
     conn.commit()
+    # Copie projetée en mémoire de l'ancienne table Returns (voir returns_matrix.snapshot_dir)
+    shutil.rmtree(snapshot_dir(db_file), ignore_errors=True)
     
     create_tables()
+    migrate_returns()
+    migrate_portfolio_weights()
     create_initial_portfolios()
     generate_clients(10)  
     generate_managers()
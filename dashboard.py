@@ -1,13 +1,15 @@
+import copy
+import threading
 import streamlit as st
 import pandas as pd
 import matplotlib.pyplot as plt
-import sqlite3
-from metrics import PortfolioMetrics
+from database import read_connection
+from metrics import PortfolioMetrics, batch_metrics, calculate_turnover, database_stamp, strategy_date_bounds
 from strategies import Strategies
 import numpy as np
 import matplotlib.ticker as mtick
 from datetime import datetime, timedelta
-from io import StringIO  # Ajout de l'import manquant
+from io import BytesIO
 
 # Configuration de la page Streamlit
 st.set_page_config(
@@ -20,16 +22,111 @@ st.set_page_config(
 st.title("Dashboard de Performance des Portefeuilles")
 
 
+DB_FILE = "fund.db"
+
+# Couche de données : chaque résultat est mis en cache avec l'état de la base (stamp, voir database_stamp)
+# dans sa clé ; un nouveau portefeuille, une ingestion de rendements ou de nouveaux deals invalident les caches concernés.
+
 # Fonction pour récupérer la liste des stratégies disponibles
-def get_available_strategies(db_file="fund.db"):
-    with sqlite3.connect(db_file) as conn:
+@st.cache_data
+def get_available_strategies(stamp, db_file=DB_FILE):
+    with read_connection(db_file) as conn:
         df = pd.read_sql_query(
-            "SELECT DISTINCT type FROM Portfolios WHERE produits IS NOT NULL", 
+            """SELECT DISTINCT type FROM Portfolios p
+            WHERE EXISTS (SELECT 1 FROM PortfolioWeights w WHERE w.portfolio_id = p.portfolio_id)""", 
             conn)
     return df['type'].tolist()
 
+# Bornes des dates disponibles pour une stratégie, par une requête sur les dates (sans calculer les rendements)
+@st.cache_data
+def get_strategy_dates(strategy, stamp, db_file=DB_FILE):
+    return strategy_date_bounds(strategy, db_file)
+
+# Instances de PortfolioMetrics partagées entre les sessions : {(base, stratégie): (stamp, instance)}, et un verrou
+# par (base, stratégie). Une instance publiée n'est plus modifiée, car d'autres sessions peuvent être en train de la lire :
+# la mise à jour incrémentale se fait sur une copie profonde (caches et accumulateurs propres à la copie), sous le verrou,
+# puis la copie remplace l'instance. Les caches d'indicateurs d'une instance publiée ont leur propre verrou (voir rolling).
+@st.cache_resource
+def _metrics_instances():
+    return {}, {}, threading.Lock()
+
+def get_metrics(strategy, stamp, db_file=DB_FILE):
+    instances, locks, registry_lock = _metrics_instances()
+    key = (db_file, strategy)
+    with registry_lock:
+        lock = locks.setdefault(key, threading.Lock())
+    with lock:
+        cached = instances.get(key)
+        if cached is None or cached[0][1] != stamp[1]:
+            # Nouvelle version de Returns : les rendements de tous les portefeuilles peuvent avoir changé
+            instances[key] = (stamp, PortfolioMetrics(strategy, db_file))
+        elif cached[0] != stamp:
+            # Seulement de nouveaux portefeuilles ou deals : mise à jour incrémentale d'une copie de l'instance
+            metrics = copy.deepcopy(cached[1])
+            metrics.refresh()
+            instances[key] = (stamp, metrics)
+        return instances[key][1]
+
+# Les graphiques sont mis en cache sous forme d'images PNG : une interaction n'a pas à les redessiner
+def _png(fig):
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches="tight")
+    plt.close(fig)
+    return buffer.getvalue()
+
+@st.cache_data(max_entries=64)
+def get_plot(strategy, plot_type, start_date, end_date, stamp, db_file=DB_FILE):
+    return _png(get_metrics(strategy, stamp, db_file).plot(plot_type=plot_type, start_date=start_date, end_date=end_date))
+
+@st.cache_data
+def get_rolling(strategy, start_date, end_date, stamp, db_file=DB_FILE):
+    rolling = get_metrics(strategy, stamp, db_file).rolling()
+    return rolling.loc[pd.to_datetime(start_date):pd.to_datetime(end_date)]
+
+# Rendements et indicateurs des stratégies comparées, calculés en une seule passe (voir batch_metrics)
+@st.cache_data
+def get_comparison(compared, start_date, end_date, stamp, db_file=DB_FILE):
+    compared_returns, compared_summary = batch_metrics(db_file, portfolio_types=list(compared))
+    return compared_returns.loc[pd.to_datetime(start_date):pd.to_datetime(end_date)], compared_summary
+
+@st.cache_data(max_entries=64)
+def get_comparison_plot(compared, start_date, end_date, stamp, db_file=DB_FILE):
+    compared_returns, _ = get_comparison(compared, start_date, end_date, stamp, db_file)
+    plt.figure(figsize=(12, 6))
+    for strategy in compared:
+        strategy_returns = compared_returns[strategy].dropna()
+        plt.plot(strategy_returns.index, (1 + strategy_returns).cumprod() - 1, label=strategy)
+    
+    plt.title("Comparaison des rendements cumulés")
+    plt.ylabel("Rendement cumulé")
+    plt.gca().yaxis.set_major_formatter(mtick.PercentFormatter(1.0))
+    plt.grid(alpha=0.3)
+    plt.legend()
+    plt.tight_layout()
+    return _png(plt.gcf())
+
+@st.cache_data
+def get_deals(strategy, stamp, db_file=DB_FILE):
+    with read_connection(db_file) as conn:
+        # Lignes des 5 derniers deals de la stratégie, en une seule requête sur l'index de DealLines
+        deals = pd.read_sql_query("""
+        SELECT date, product_id, delta_weight
+        FROM DealLines
+        WHERE profile = ? AND date IN (
+            SELECT DISTINCT date FROM DealLines WHERE profile = ? ORDER BY date DESC LIMIT 5)
+        ORDER BY date DESC, product_id
+        """, conn, params=(strategy, strategy))
+    return deals
+
+@st.cache_data
+def get_turnover(strategy, start_date, end_date, stamp, db_file=DB_FILE):
+    return calculate_turnover(strategy, db_file, start_date=start_date, end_date=end_date)
+
+# État de la base lu à chaque interaction (quelques lignes) : clé de tous les caches ci-dessus
+stamp = database_stamp(DB_FILE)
+
 # Récupération des stratégies disponibles
-strategies = get_available_strategies()
+strategies = get_available_strategies(stamp)
 
 # Sélection de la stratégie
 col1, col2 = st.columns([1, 2])
@@ -44,13 +141,7 @@ with col1:
     st.subheader("Période d'analyse")
     
     # Récupération des dates disponibles pour la stratégie sélectionnée
-    @st.cache_data
-    def get_strategy_dates(strategy, db_file="fund.db"):
-        metrics = PortfolioMetrics(strategy, db_file)
-        returns = metrics.returns()
-        return returns['date'].min(), returns['date'].max()
-    
-    min_date, max_date = get_strategy_dates(selected_strategy)
+    min_date, max_date = get_strategy_dates(selected_strategy, stamp)
     
     start_date = st.date_input(
         "Date de début",
@@ -76,7 +167,7 @@ with col1:
 
 
 with col2:
-    metrics = PortfolioMetrics(selected_strategy)
+    metrics = get_metrics(selected_strategy, stamp)
     
     # Affichage des métriques sélectionnées
     metrics_data = {}
@@ -99,13 +190,21 @@ with col2:
 
 # Visualisation des rendements cumulés
 st.header("Rendements cumulés")
-fig_returns = metrics.plot(plot_type='return', start_date=start_date, end_date=end_date)
-st.pyplot(fig_returns)
+fig_returns = get_plot(selected_strategy, 'return', start_date, end_date, stamp)
+st.image(fig_returns, use_container_width=True)
 
 # Visualisation de la volatilité
 st.header("Drawdown")
-fig_drawdown = metrics.plot(plot_type='drawdown', start_date=start_date, end_date=end_date)
-st.pyplot(fig_drawdown)
+fig_drawdown = get_plot(selected_strategy, 'drawdown', start_date, end_date, stamp)
+st.image(fig_drawdown, use_container_width=True)
+
+# Indicateurs glissants sur 1, 3 et 12 mois (calculés une seule fois puis gardés en cache par PortfolioMetrics)
+st.header("Analyse glissante")
+rolling_labels = {"Volatilité": "volatility", "Ratio de Sharpe": "sharpe_ratio", "Drawdown": "drawdown",
+                  "Taux de jours positifs": "hit_rate", "Rendement moyen": "mean_return"}
+rolling_choice = st.selectbox("Indicateur glissant", options=list(rolling_labels))
+rolling = get_rolling(selected_strategy, start_date, end_date, stamp)
+st.line_chart(rolling.xs(rolling_labels[rolling_choice], axis=1, level=1))
 
 # Comparaison des stratégies
 st.header("Comparaison des stratégies")
@@ -119,61 +218,24 @@ if compare:
     )
     
     if strategies_to_compare:
-        # Préparation des données pour la comparaison
-        plt.figure(figsize=(12, 6))
-        
-        # Tracé de la stratégie principale
-        main_metrics = PortfolioMetrics(selected_strategy)
-        main_returns = main_metrics.returns()
-        main_returns = main_returns[(main_returns['date'] >= pd.to_datetime(start_date)) & 
-                                   (main_returns['date'] <= pd.to_datetime(end_date))]
-        main_cumulative = (1 + main_returns['return']).cumprod() - 1
-        plt.plot(main_returns['date'], main_cumulative, label=selected_strategy)
-        
-        # Tracé des stratégies à comparer
-        for strategy in strategies_to_compare:
-            comp_metrics = PortfolioMetrics(strategy)
-            comp_returns = comp_metrics.returns()
-            comp_returns = comp_returns[(comp_returns['date'] >= pd.to_datetime(start_date)) & 
-                                       (comp_returns['date'] <= pd.to_datetime(end_date))]
-            comp_cumulative = (1 + comp_returns['return']).cumprod() - 1
-            plt.plot(comp_returns['date'], comp_cumulative, label=strategy)
-        
-        plt.title("Comparaison des rendements cumulés")
-        plt.ylabel("Rendement cumulé")
-        plt.gca().yaxis.set_major_formatter(mtick.PercentFormatter(1.0))
-        plt.grid(alpha=0.3)
-        plt.legend()
-        plt.tight_layout()
-        
-        st.pyplot(plt.gcf())
+        # Rendements et indicateurs de toutes les stratégies comparées, calculés en une seule passe
+        compared = [selected_strategy] + strategies_to_compare
+        _, compared_summary = get_comparison(tuple(compared), start_date, end_date, stamp)
+
+        # Tracé des rendements cumulés de chaque stratégie
+        st.image(get_comparison_plot(tuple(compared), start_date, end_date, stamp), use_container_width=True)
         
         # Tableau de comparaison des métriques
         comparison_data = []
-        
-        # Métriques pour la stratégie principale
-        main_data = {
-            "Stratégie": selected_strategy,
-            "Rendement moyen": f"{main_metrics.mean_return() * 100:.2f}%",
-            "Rendement total": f"{main_metrics.total_return() * 100:.2f}%",
-            "Volatilité": f"{main_metrics.volatility() * 100:.2f}%",
-            "Ratio de Sharpe": f"{main_metrics.sharpe_ratio():.2f}",
-            "Drawdown maximum": f"{main_metrics.max_drawdown() * 100:.2f}%"
-        }
-        comparison_data.append(main_data)
-        
-        # Métriques pour les stratégies à comparer
-        for strategy in strategies_to_compare:
-            comp_metrics = PortfolioMetrics(strategy)
-            comp_data = {
+        for strategy, row in compared_summary.iterrows():
+            comparison_data.append({
                 "Stratégie": strategy,
-                "Rendement moyen": f"{comp_metrics.mean_return() * 100:.2f}%",
-                "Rendement total": f"{comp_metrics.total_return() * 100:.2f}%",
-                "Volatilité": f"{comp_metrics.volatility() * 100:.2f}%",
-                "Ratio de Sharpe": f"{comp_metrics.sharpe_ratio():.2f}",
-                "Drawdown maximum": f"{comp_metrics.max_drawdown() * 100:.2f}%"
-            }
-            comparison_data.append(comp_data)
+                "Rendement moyen": f"{row['mean_return'] * 100:.2f}%",
+                "Rendement total": f"{row['total_return'] * 100:.2f}%",
+                "Volatilité": f"{row['volatility'] * 100:.2f}%",
+                "Ratio de Sharpe": f"{row['sharpe_ratio']:.2f}",
+                "Drawdown maximum": f"{row['max_drawdown'] * 100:.2f}%"
+            })
         
         st.dataframe(pd.DataFrame(comparison_data).set_index("Stratégie"))
 
@@ -210,35 +272,16 @@ elif selected_strategy == "high_yield_equity_only":
 # Section pour examiner les transactions (deals)
 st.header("Transactions récentes")
 
-@st.cache_data
-def get_deals(db_file="fund.db"):
-    with sqlite3.connect(db_file) as conn:
-        query = f"""
-        SELECT date, "{selected_strategy}" as deals
-        FROM Deals
-        WHERE "{selected_strategy}" IS NOT NULL
-        ORDER BY date DESC
-        LIMIT 5
-        """
-        deals = pd.read_sql_query(query, conn)
-    return deals
-
-deals = get_deals()
+deals = get_deals(selected_strategy, stamp)
 if not deals.empty:
-    for _, deal in deals.iterrows():
-        with st.expander(f"Transaction du {deal['date']}"):
-            try:
-                deals_json = deal['deals']
-                if deals_json:
-                    deals_data = pd.read_json(StringIO(deals_json), orient='index')
-                    st.dataframe(deals_data)
-                else:
-                    st.write("Aucune donnée disponible pour cette transaction.")
-            except:
-                st.write("Erreur lors du traitement des données de cette transaction.")
+    for deal_date, deals_data in deals.groupby("date", sort=False):
+        with st.expander(f"Transaction du {deal_date}"):
+            st.dataframe(deals_data.set_index("product_id")[["delta_weight"]])
 else:
     st.write("Aucune transaction récente trouvée pour cette stratégie.")
 
-
-
-
+# Rotation du portefeuille à chaque deal sur la période d'analyse
+turnover = get_turnover(selected_strategy, start_date, end_date, stamp)
+if not turnover.empty:
+    st.subheader("Rotation du portefeuille")
+    st.line_chart(turnover.set_index("date")["turnover"])
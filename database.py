@@ -0,0 +1,312 @@
+import json
+import os
+import sqlite3
+import threading
+
+# Réglages appliqués à chaque connexion ouverte par connect (surchargeables par connexion)
+PRAGMAS = {
+    # En WAL, NORMAL ne synchronise le disque qu'aux checkpoints : une coupure peut perdre les dernières
+    # transactions validées mais ne corrompt pas la base
+    "synchronous": "NORMAL",
+    # Cache de pages de 64 Mio (valeur négative : taille en Kio)
+    "cache_size": -65536,
+    # Les 256 premiers Mio du fichier sont lus par memory-map plutôt que par read()
+    "mmap_size": 268435456,
+    # Tris et index temporaires en mémoire
+    "temp_store": "MEMORY",
+}
+
+# Attente maximale (en secondes) d'un verrou d'écriture avant l'erreur "database is locked"
+BUSY_TIMEOUT = 30.0
+
+# Schéma des tables partagées par la création de la base, l'ingestion et les migrations (voir creation_db.py)
+
+# Table Returns : une seule ligne par (product_id, date).
+# La clé primaire sert d'index couvrant pour les lectures par produit (WITHOUT ROWID : la table est rangée selon la clé),
+# l'index idx_returns_date couvre les lectures par plage de dates.
+RETURNS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+    product_id INTEGER NOT NULL,
+    date DATE NOT NULL,
+    value REAL,
+    PRIMARY KEY (product_id, date),
+    FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE
+) WITHOUT ROWID;"""
+
+RETURNS_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_returns_date ON Returns (date, product_id, value);"
+
+# Table PortfolioWeights : une ligne par (portefeuille, produit), à la place du JSON de Portfolios.produits
+# (colonne conservée pour les anciens portefeuilles, voir migrate_portfolio_weights).
+# La clé primaire couvre la lecture des poids d'une suite de portefeuilles, idx_portfolios_type_date
+# la sélection des portefeuilles d'un profil sur une période.
+PORTFOLIO_WEIGHTS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS PortfolioWeights (
+    portfolio_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    weight REAL,
+    PRIMARY KEY (portfolio_id, product_id),
+    FOREIGN KEY (portfolio_id) REFERENCES Portfolios(portfolio_id) ON DELETE CASCADE,
+    FOREIGN KEY (product_id) REFERENCES Products(product_id)
+) WITHOUT ROWID;"""
+
+PORTFOLIO_WEIGHTS_INDEX_SQL = [
+    "CREATE INDEX IF NOT EXISTS idx_portfolios_type_date ON Portfolios (type, date_creation, portfolio_id);",
+    "CREATE INDEX IF NOT EXISTS idx_portfolio_weights_product ON PortfolioWeights (product_id);",
+]
+
+# Table DealLines : registre des deals au format long, une ligne par (profil, date, produit) dont le poids varie
+# (remplace les colonnes JSON de la table Deals, conservée pour les anciens deals, voir migrate_deal_lines).
+# La clé primaire couvre les agrégations par profil et par date (rotation, nombre de transactions).
+DEAL_LINES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS DealLines (
+    date DATE NOT NULL,
+    profile TEXT NOT NULL CHECK(profile IN ('low_risk', 'low_turnover', 'high_yield_equity_only')),
+    product_id INTEGER NOT NULL,
+    delta_weight REAL NOT NULL,
+    PRIMARY KEY (profile, date, product_id),
+    FOREIGN KEY (product_id) REFERENCES Products(product_id)
+) WITHOUT ROWID;"""
+
+DEAL_LINES_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_deal_lines_product ON DealLines (product_id, date);"
+
+# Table PortfolioReturns : rendements quotidiens matérialisés de chaque stratégie, tenus à jour à chaque écriture
+# de portefeuilles ou de rendements (voir metrics.write_portfolio_returns) ; la clé primaire couvre la lecture
+# de la série d'une stratégie par PortfolioMetrics.
+PORTFOLIO_RETURNS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS PortfolioReturns (
+    profile TEXT NOT NULL CHECK(profile IN ('low_risk', 'low_turnover', 'high_yield_equity_only')),
+    date DATE NOT NULL,
+    return REAL NOT NULL,
+    PRIMARY KEY (profile, date)
+) WITHOUT ROWID;"""
+
+# Table IngestionWatermarks : plage de dates [first_date, last_date) déjà téléchargée pour chaque produit
+# (utilisée par DataImporter.fill_returns pour ne demander que les dates manquantes)
+WATERMARKS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS IngestionWatermarks (
+    product_id INTEGER PRIMARY KEY,
+    first_date DATE NOT NULL,
+    last_date DATE NOT NULL,
+    FOREIGN KEY (product_id) REFERENCES Products(product_id) ON DELETE CASCADE
+);"""
+
+# Table DataVersions : numéro de version de chaque table, incrémenté à chaque écriture
+# (la copie projetée en mémoire de Returns est réexportée lorsque sa version est dépassée, voir returns_matrix.py ;
+# les caches du dashboard sont invalidés par les versions de Returns et DealLines)
+DATA_VERSIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS DataVersions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);"""
+
+# Connexions de lecture réutilisées, propres à chaque thread (un objet sqlite3.Connection ne se partage pas entre threads)
+_local = threading.local()
+
+
+def connect(db_file="fund.db", **pragmas):
+    """
+    Ouvre une connexion à db_file en mode WAL avec les réglages de PRAGMAS (pragmas permet d'en remplacer,
+    par exemple synchronous="FULL").
+
+    En WAL, les lecteurs ne bloquent pas l'écrivain et ne sont pas bloqués par lui : le dashboard lit pendant
+    qu'un backtest ou une ingestion écrit. Deux écritures simultanées s'attendent jusqu'à BUSY_TIMEOUT secondes.
+    Comme sqlite3.connect, utilisée dans un bloc with, la connexion valide la transaction à la sortie sans se fermer.
+    """
+    conn = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT)
+    # Le mode WAL est enregistré dans le fichier : la commande ne change réellement la base qu'à la première connexion
+    conn.execute("PRAGMA journal_mode = WAL")
+    for name, value in {**PRAGMAS, **pragmas}.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def data_version(conn, name):
+    """
+    Version de la table name (table DataVersions), incrémentée par chaque écriture dans cette table.
+    Renvoie None si la base n'a pas de table DataVersions (base non migrée, voir creation_db.py --migrate).
+    """
+    try:
+        row = conn.execute("SELECT version FROM DataVersions WHERE name = ?", (name,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else 0
+
+
+def bump_data_version(cursor, name):
+    """Incrémente la version de la table name dans la transaction en cours et renvoie la nouvelle version."""
+    cursor.execute("""
+    INSERT INTO DataVersions (name, version) VALUES (?, 1)
+    ON CONFLICT(name) DO UPDATE SET version = version + 1""", (name,))
+    return data_version(cursor, name)
+
+
+def _tables(conn):
+    return {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def _returns_has_key(conn):
+    return any(row[3] == "pk" for row in conn.execute("PRAGMA index_list(Returns)"))
+
+
+def migrate_returns_table(cursor):
+    """
+    Reconstruit une table Returns créée sans clé avec la clé (product_id, date) de RETURNS_TABLE_SQL : les doublons
+    sont supprimés en conservant la dernière valeur insérée. Renvoie True si la table a été reconstruite.
+    Le commit est laissé à l'appelant.
+    """
+    if "Returns" not in _tables(cursor) or _returns_has_key(cursor):
+        return False
+    cursor.execute("DROP TABLE IF EXISTS Returns_dedup;")
+    cursor.execute(RETURNS_TABLE_SQL.format(table="Returns_dedup"))
+    # Parcours dans l'ordre d'insertion : en cas de doublon la dernière valeur l'emporte
+    cursor.execute("""
+    INSERT INTO Returns_dedup (product_id, date, value)
+    SELECT product_id, date, value FROM Returns
+    WHERE date IS NOT NULL
+    ORDER BY rowid
+    ON CONFLICT(product_id, date) DO UPDATE SET value = excluded.value""")
+    cursor.execute("DROP TABLE Returns;")
+    cursor.execute("ALTER TABLE Returns_dedup RENAME TO Returns;")
+    cursor.execute(RETURNS_INDEX_SQL)
+    cursor.execute(DATA_VERSIONS_TABLE_SQL)
+    bump_data_version(cursor, "Returns")
+    return True
+
+
+def migrate_portfolio_weights_table(cursor):
+    """
+    Crée la table PortfolioWeights si besoin et y recopie les poids stockés en JSON dans Portfolios.produits
+    (seuls les portefeuilles qui n'ont encore aucune ligne dans PortfolioWeights sont migrés).
+    Renvoie le nombre de lignes insérées. Le commit est laissé à l'appelant.
+    """
+    cursor.execute(PORTFOLIO_WEIGHTS_TABLE_SQL)
+    for index_sql in PORTFOLIO_WEIGHTS_INDEX_SQL:
+        cursor.execute(index_sql)
+
+    rows = cursor.execute("""
+    SELECT portfolio_id, produits FROM Portfolios p
+    WHERE produits IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM PortfolioWeights w WHERE w.portfolio_id = p.portfolio_id)""").fetchall()
+    weights = []
+    for portfolio_id, produits in rows:
+        try:
+            data = json.loads(produits)
+        except ValueError:
+            print(f"Portefeuille {portfolio_id} : JSON illisible, ignoré.")
+            continue
+        if isinstance(data, dict):
+            weights.extend((portfolio_id, int(product_id), row.get("weight")) for product_id, row in data.items())
+
+    cursor.executemany("""
+    INSERT INTO PortfolioWeights (portfolio_id, product_id, weight)
+    VALUES (?, ?, ?)""", weights)
+    return len(weights)
+
+
+def migrate_deal_lines_table(cursor):
+    """
+    Crée la table DealLines si besoin et y recopie les deals stockés en JSON dans les colonnes de Deals
+    (seuls les couples (profil, date) qui n'ont encore aucune ligne dans DealLines sont migrés).
+    Renvoie le nombre de lignes insérées. Le commit est laissé à l'appelant.
+    """
+    cursor.execute(DEAL_LINES_TABLE_SQL)
+    cursor.execute(DEAL_LINES_INDEX_SQL)
+
+    migrated = set(cursor.execute("SELECT DISTINCT profile, date FROM DealLines").fetchall())
+    profiles = ["low_risk", "low_turnover", "high_yield_equity_only"]
+    lines = []
+    for date_deal, *deals in cursor.execute(f"SELECT date, {', '.join(profiles)} FROM Deals WHERE date IS NOT NULL").fetchall():
+        for profile, deal in zip(profiles, deals):
+            if not deal or (profile, date_deal) in migrated:
+                continue
+            try:
+                data = json.loads(deal)
+            except ValueError:
+                print(f"Deal {profile} du {date_deal} : JSON illisible, ignoré.")
+                continue
+            if isinstance(data, dict):
+                lines.extend((date_deal, profile, int(product_id), row["weight"]) for product_id, row in data.items()
+                             if row.get("weight"))
+
+    cursor.executemany("""
+    INSERT INTO DealLines (date, profile, product_id, delta_weight)
+    VALUES (?, ?, ?, ?)""", lines)
+    if lines:
+        cursor.execute(DATA_VERSIONS_TABLE_SQL)
+        bump_data_version(cursor, "DealLines")
+    return len(lines)
+
+
+def _needs_upgrade(conn):
+    """
+    Vrai si la base a encore des tables de l'ancien schéma : table Returns sans clé, portefeuilles dont les poids
+    ne sont qu'en JSON (Portfolios.produits), table Deals sans table DealLines.
+    """
+    tables = _tables(conn)
+    if "Returns" in tables and not _returns_has_key(conn):
+        return True
+    if "Portfolios" in tables:
+        if "PortfolioWeights" not in tables:
+            return True
+        # Ancien portefeuille (poids en JSON, non vide) sans ligne dans PortfolioWeights
+        if conn.execute("""SELECT 1 FROM Portfolios p WHERE produits LIKE '{"%'
+            AND NOT EXISTS (SELECT 1 FROM PortfolioWeights w WHERE w.portfolio_id = p.portfolio_id) LIMIT 1""").fetchone():
+            return True
+    return "Deals" in tables and "DealLines" not in tables
+
+
+class SchemaError(sqlite3.DatabaseError):
+    """Base créée par une version antérieure du schéma, à migrer par python creation_db.py --migrate."""
+
+
+def check_schema(conn, db_file="fund.db"):
+    """
+    Lève SchemaError si la base a encore des tables de l'ancien schéma (voir _needs_upgrade), sans rien modifier :
+    la migration reconstruit des tables et n'est lancée qu'explicitement (creation_db.py --migrate).
+    """
+    if _needs_upgrade(conn):
+        raise SchemaError(f"Schéma de la base {db_file} périmé : lancer python creation_db.py --migrate")
+
+
+def read_connection(db_file="fund.db"):
+    """
+    Renvoie la connexion de lecture réutilisée pour db_file dans ce thread et ce processus (ouverte par connect
+    au premier appel). Hors transaction explicite, chaque requête lit le dernier état validé de la base.
+
+    Une connexion est rouverte si le fichier a été remplacé (autre inode) ; les processus créés par fork
+    ouvrent leurs propres connexions. À l'ouverture, le schéma est vérifié (check_schema) : une base non migrée
+    lève SchemaError plutôt que de renvoyer des résultats incomplets.
+    """
+    path = os.path.abspath(db_file)
+    try:
+        inode = os.stat(path).st_ino
+    except OSError:
+        inode = None
+    key = (os.getpid(), path)
+
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    cached = connections.get(key)
+    if cached is not None and cached[0] == inode:
+        return cached[1]
+    if cached is not None:
+        cached[1].close()
+        del connections[key]
+    conn = connect(db_file)
+    try:
+        check_schema(conn, db_file)
+    except SchemaError:
+        conn.close()
+        raise
+    connections[key] = (os.stat(path).st_ino, conn)
+    return conn
+
+
+def close_connections():
+    """Ferme les connexions de lecture réutilisées du thread courant."""
+    connections = getattr(_local, "connections", None) or {}
+    for (pid, _), (_, conn) in connections.items():
+        if pid == os.getpid():
+            conn.close()
+    connections.clear()
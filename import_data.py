@@ -1,91 +1,201 @@
-import yfinance as yf
-
 import pandas as pd
 
-import sqlite3
-
-import os
 
-import time
 import numpy as np
+from database import DATA_VERSIONS_TABLE_SQL, WATERMARKS_TABLE_SQL, check_schema, connect
+from market_data import DownloadScheduler, YahooProvider
+from metrics import write_portfolio_returns
+from returns_matrix import bump_returns_version, get_returns_matrix
+
+# Jours calendaires téléchargés avant la plage manquante : au moins 5 séances pour calculer le premier rendement hebdomadaire
+LOOKBACK_DAYS = 14
 
 class DataImporter:
 
-    def __init__(self, db_file="fund.db"):
+    def __init__(self, db_file="fund.db", provider=None, chunk_size=100, max_workers=4, rate=None, retries=3, backoff=1.0):
 
         self.db_file = db_file
+        # Source des cours de clôture (Yahoo Finance par défaut, ou LocalPriceStore pour rejouer l'historique hors ligne)
+        self.provider = provider if provider is not None else YahooProvider()
+        # Téléchargement par lots en parallèle, avec limite de débit et nouvelles tentatives (voir DownloadScheduler)
+        self.scheduler = DownloadScheduler(self.provider, chunk_size=chunk_size, max_workers=max_workers,
+                                           rate=rate, retries=retries, backoff=backoff)
+
+    def _missing_ranges(self, products, watermarks, start_date, end_date):
+        """
+        Détermine pour chaque produit la plage [fetch_start, fetch_end) restant à télécharger, d'après son watermark
+        (plage [first_date, last_date) déjà couverte). Les produits déjà à jour sont exclus.
+        La plage est toujours contiguë à la plage couverte, pour que le watermark reste un simple intervalle.
+        """
+        ranges = products.merge(watermarks, on="product_id", how="left")
+        first, last = ranges["first_date"], ranges["last_date"]
+        known = first.notna()
+        before = known & (start_date < first)
+
+        fetch_start = pd.Series(start_date, index=ranges.index)
+        fetch_start[known & ~before] = last[known & ~before]
+        fetch_end = pd.Series(end_date, index=ranges.index)
+        # Complément vers le passé seulement : on s'arrête au début de la plage déjà couverte
+        backfill_only = before & (end_date <= last)
+        fetch_end[backfill_only] = first[backfill_only].clip(upper=end_date)
+
+        ranges["fetch_start"] = fetch_start
+        ranges["fetch_end"] = fetch_end
+        return ranges[ranges["fetch_start"] < ranges["fetch_end"]]
+
+    def _returns_from_closes(self, products, closes, keep_from):
+        """
+        Calcule les rendements hebdomadaires (5 séances) des produits à partir d'un DataFrame large de cours
+        et renvoie les tuples (product_id, date, rendement) finis datés de keep_from ou après.
+        """
+        # Une colonne de cours par produit (dans l'ordre de products)
+        closes = closes.reindex(columns=products["ticker"])
+        missing = closes.columns[closes.isna().all()].tolist()
+        if missing:
+            print(f"Pas de données pour les tickers {missing}")
+
+        # Cours cotés au format long (produit, date), rangés par produit puis par date
+        prices = closes.to_numpy(dtype=float)
+        dates_str = closes.index.to_numpy().astype("datetime64[D]").astype(str)
+        product_pos, date_pos = np.nonzero(np.isfinite(prices).T)
+        values = prices[date_pos, product_pos]
+
+        # Rendement de chaque séance par rapport à la 5e séance cotée précédente du même produit, pour tous les produits
+        # à la fois (comme closes[ticker].dropna().pct_change(5)) : calculé sur les seuls cours du produit,
+        # il ne dépend pas des autres produits du lot ni de leur calendrier de cotation
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weekly_returns = values[5:] / values[:-5] - 1
+        same_product = product_pos[5:] == product_pos[:-5]
+        product_pos, date_pos = product_pos[5:], date_pos[5:]
+        # Les séances de la période de rattrapage ne servent qu'au calcul du premier rendement
+        kept = same_product & np.isfinite(weekly_returns) & (dates_str[date_pos] >= keep_from)
+
+        return list(zip(products["product_id"].to_numpy()[product_pos[kept]].tolist(),
+                        dates_str[date_pos[kept]].tolist(),
+                        weekly_returns[kept].tolist()))
 
-    def fill_returns(self, start_date, end_date):
+    def _save_chunk(self, products, closes, fetch_start, fetch_end, today):
+        """
+        Enregistre, dans une seule transaction, les rendements d'un lot de produits et leurs watermarks,
+        puis complète la matrice de rendements partagée. Renvoie le nombre de rendements enregistrés.
+        """
+        closes = closes[closes.index < pd.to_datetime(fetch_end)]
+        returns_data = self._returns_from_closes(products, closes, fetch_start)
+
+        # Plage couverte : jusqu'à fetch_end si la période est échue, sinon jusqu'au dernier cours reçu
+        watermark_data = []
+        last_close = closes.reindex(columns=products["ticker"]).apply(lambda prices: prices.last_valid_index())
+        for row, last_seen in zip(products.itertuples(index=False), last_close.to_numpy()):
+            if pd.isna(last_seen):
+                continue
+            covered_end = fetch_end if fetch_end <= today else \
+                min(fetch_end, (pd.Timestamp(last_seen) + pd.Timedelta(days=1)).strftime("%Y-%m-%d"))
+            covered_start = fetch_start if pd.isna(row.first_date) or fetch_start < row.first_date else row.first_date
+            covered_end = covered_end if pd.isna(row.last_date) else max(covered_end, row.last_date)
+            watermark_data.append((row.product_id, covered_start, covered_end))
+
+        with connect(self.db_file) as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO Returns (product_id, date, value)
+                VALUES (?, ?, ?)
+                ON CONFLICT(product_id, date) DO UPDATE SET value = excluded.value
+                """, 
+                returns_data
+            )
+            cursor.executemany(
+                """
+                INSERT INTO IngestionWatermarks (product_id, first_date, last_date)
+                VALUES (?, ?, ?)
+                ON CONFLICT(product_id) DO UPDATE SET first_date = excluded.first_date, last_date = excluded.last_date
+                """,
+                watermark_data
+            )
+            # Nouvelle version de Returns : la copie projetée en mémoire de la table est périmée
+            version = bump_returns_version(cursor) if returns_data else None
+            # Rendements matérialisés des portefeuilles détenus aux dates reçues (table PortfolioReturns)
+            if returns_data:
+                dates = [date for _, date, _ in returns_data]
+                write_portfolio_returns(conn, min(dates), max(dates))
+            conn.commit()
+
+        if returns_data:
+            # Mise à jour sur place de la matrice des rendements partagée si elle est déjà chargée
+            # (elle ne prend la nouvelle version que si elle était à jour avant ce lot)
+            returns_matrix = get_returns_matrix(self.db_file, load=False)
+            if returns_matrix is not None:
+                returns_matrix.extend(*zip(*returns_data))
+                if returns_matrix.version == version - 1:
+                    returns_matrix.version = version
+        return len(returns_data)
+
+    def fill_returns(self, start_date, end_date, force=False):
         """
         Télécharge les données de prix et calcule les rendements hebdomadaires pour tous les produits.
         Gère les cas d'erreurs comme les rendements nuls ou extrêmes.
+
+        L'ingestion est incrémentale : la table IngestionWatermarks garde pour chaque produit la plage de dates
+        déjà téléchargée. Seule la partie manquante de [start_date, end_date) est demandée à la source de cours,
+        précédée de LOOKBACK_DAYS jours pour que le rendement sur 5 séances des premières dates soit calculable.
+        Les produits déjà à jour ne sont pas interrogés.
+
+        Les tickers sont téléchargés par lots en parallèle (self.scheduler) et chaque lot est enregistré dès sa
+        réception : un lot en échec n'empêche pas l'enregistrement des autres et sera repris au prochain appel
+        (son watermark n'avance pas). Avec force=True, toute la période est re-téléchargée et le watermark
+        des produits repart de cette période.
         """
-        
-        returns_data = []
+        start_date = pd.to_datetime(start_date).strftime("%Y-%m-%d")
+        end_date = pd.to_datetime(end_date).strftime("%Y-%m-%d")
+        today = pd.Timestamp.today().strftime("%Y-%m-%d")
+
         try:
-            # Chargement des produits depuis la table Products
-            with sqlite3.connect(self.db_file) as conn:
+            # Chargement des produits et des watermarks depuis la base
+            with connect(self.db_file) as conn:
+                check_schema(conn, self.db_file)
+                conn.execute(WATERMARKS_TABLE_SQL)
+                conn.execute(DATA_VERSIONS_TABLE_SQL)
                 products = pd.read_sql_query("SELECT product_id, ticker FROM Products", conn)
+                watermarks = pd.read_sql_query("SELECT product_id, first_date, last_date FROM IngestionWatermarks", conn)
             if products.empty:
                 print("Aucun produit trouvé dans la table Products.")
                 return
-            
-            # Télécharger les données pour tous les tickers en une seule fois
-            tickers = products["ticker"].tolist()
-            time.sleep(0.1)
-            data = yf.download(tickers, start=start_date, end=end_date, progress=False, group_by="ticker")
-
-            if data is None or data.empty:
-                print("Aucune donnée téléchargée depuis Yahoo Finance.")
+            if force:
+                watermarks = watermarks.iloc[0:0]
+
+            ranges = self._missing_ranges(products, watermarks, start_date, end_date)
+            if ranges.empty:
+                print(f"Rendements déjà à jour pour tous les produits entre {start_date} et {end_date}.")
                 return
 
-            # Pour chaque produit, on calcule les rendements 
-            for product_id, ticker in products[["product_id", "ticker"]].itertuples(index=False):
-                try:
-                    # Les données pour un ticker sont stockées dans data[ticker]
-                    ticker_data = data[ticker].copy() if isinstance(data, pd.DataFrame) and ticker in data else data.loc[:, (ticker, slice(None))].copy()
-                except Exception as e:
-                    print(f"Pas de données pour le ticker {ticker}: {e}")
-                    continue
-
-                # Assurons-nous que nous avons des données
-                if ticker_data.empty:
-                    print(f"Pas de données pour {ticker}")
-                    continue
-                
-                # Réinitialisation de l'index pour obtenir la date dans une colonne
-                ticker_data.reset_index(inplace=True)
-                
-                # Pour un calcul hebdomadaire simple, nous pouvons calculer les rendements
-                # sur une base de vendredi à vendredi ou de semaine à semaine
-                
-                # Méthode 1 (plus simple): calculer le rendement pour chaque jour par rapport à la semaine précédente (même jour)
-                ticker_data["weekly_return"] = ticker_data["Close"].pct_change(5, fill_method=None)
-              
-                ticker_data = ticker_data[np.isfinite(ticker_data["weekly_return"])]
-                
-
-
-                ticker_data["Date_str"] = ticker_data["Date"].dt.strftime("%Y-%m-%d")
-
-                # Préparation des tuples pour chaque ligne
-                returns = list(zip([product_id]*len(ticker_data), ticker_data["Date_str"], ticker_data["weekly_return"]))
-                returns_data.extend(returns)
-            
-            # Insertion des données dans la table Returns (uniquement si returns_data n'est pas vide)
-            if returns_data:
-                with sqlite3.connect(self.db_file) as conn:
-                    cursor = conn.cursor()
-                    cursor.executemany(
-                        """
-                        INSERT INTO Returns (product_id, date, value)
-                        VALUES (?, ?, ?)
-                        """, 
-                        returns_data
-                    )
-                    conn.commit()
-                print(f"Returns hebdomadaires ajoutés avec succès: {len(returns_data)} entrées.")
+            # Une série d'appels par plage manquante (en ingestion hebdomadaire, une seule plage commune) ;
+            # chaque lot de tickers est enregistré dès qu'il est téléchargé
+            inserted, failed = 0, []
+            for (fetch_start, fetch_end), group in ranges.groupby(["fetch_start", "fetch_end"], sort=True):
+                lookback_start = (pd.to_datetime(fetch_start) - pd.Timedelta(days=LOOKBACK_DAYS)).strftime("%Y-%m-%d")
+                tickers = group["ticker"].drop_duplicates().tolist()
+                for chunk, closes, error in self.scheduler.fetch(tickers, lookback_start, fetch_end):
+                    if error is not None:
+                        print(f"Échec du téléchargement de {len(chunk)} tickers entre {fetch_start} et {fetch_end} : {error}")
+                        failed.extend(chunk)
+                        continue
+                    if closes is None or closes.empty:
+                        print(f"Aucune donnée téléchargée depuis la source de cours entre {fetch_start} et {fetch_end}.")
+                        continue
+                    try:
+                        chunk_products = group[group["ticker"].isin(chunk)]
+                        inserted += self._save_chunk(chunk_products, closes, fetch_start, fetch_end, today)
+                    except Exception as e:
+                        print(f"Erreur lors de l'enregistrement des returns de {len(chunk)} tickers : {e}")
+                        failed.extend(chunk)
+
+            if inserted:
+                print(f"Returns hebdomadaires ajoutés avec succès: {inserted} entrées.")
+                # La copie projetée en mémoire n'est pas réécrite ici (coût proportionnel à tout l'historique) :
+                # elle est réexportée au prochain chargement qui la trouve périmée (voir refresh_snapshot)
             else:
                 print("Aucun return à insérer (les valeurs étaient NULL, inf ou données manquantes).")
+            if failed:
+                print(f"{len(failed)} tickers en échec, à reprendre au prochain appel : {failed}")
         except Exception as e:
             print(f"Erreur lors de la génération des returns : {e}")
@@ -0,0 +1,258 @@
+import argparse
+import os
+from abc import ABC, abstractmethod
+import threading
+import time
+import numpy as np
+import pandas as pd
+import yfinance as yf
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from database import read_connection
+
+class MarketDataProvider(ABC):
+    """
+    Source de cours de clôture utilisée par DataImporter.
+
+    Une source implémente get_closes(tickers, start_date, end_date) et renvoie un DataFrame large :
+    index = dates (DatetimeIndex trié), colonnes = tickers, valeurs = cours de clôture (NaN si absent).
+    Comme pour yf.download, start_date est inclus et end_date exclu.
+    Une erreur de téléchargement doit lever une exception, pour que DownloadScheduler puisse réessayer.
+
+    rate_limit : nombre maximal d'appels par seconde conseillé pour cette source (None : pas de limite)
+    """
+
+    rate_limit = None
+
+    @abstractmethod
+    def get_closes(self, tickers, start_date, end_date):
+        """Cours de clôture des tickers entre start_date (inclus) et end_date (exclu)."""
+
+
+class YahooProvider(MarketDataProvider):
+    """
+    Cours de clôture téléchargés depuis Yahoo Finance, un historique yf.Ticker par ticker.
+
+    Chaque appel ne travaille que sur ses propres objets Ticker (contrairement à yf.download, qui range ses résultats
+    dans des variables globales du module) : les lots de DownloadScheduler se téléchargent en parallèle.
+    Un ticker en échec donne une colonne vide ; si aucun ticker du lot n'a de cours, l'appel lève une exception
+    pour que le lot soit retenté.
+    """
+
+    rate_limit = 2.0
+
+    def __init__(self, pause=0.1):
+        # Pause de courtoisie avant chaque appel à Yahoo Finance
+        self.pause = pause
+
+    def get_closes(self, tickers, start_date, end_date):
+        tickers = list(tickers)
+        if self.pause:
+            time.sleep(self.pause)
+        series = {}
+        errors = []
+        for ticker in tickers:
+            try:
+                history = yf.Ticker(ticker).history(start=start_date, end=end_date)
+            except Exception as e:
+                errors.append(e)
+                continue
+            if history is None or "Close" not in history.columns or history["Close"].dropna().empty:
+                continue
+            close = history["Close"]
+            # Dates locales de la place de cotation, sans fuseau (les tickers d'un lot peuvent être sur des places différentes)
+            index = pd.to_datetime(close.index)
+            if index.tz is not None:
+                index = index.tz_localize(None)
+            series[ticker] = close.set_axis(index.normalize())
+
+        closes = pd.DataFrame(series)
+        if closes.empty:
+            detail = f" : {errors[0]}" if errors else ""
+            raise RuntimeError(f"Aucun cours reçu de Yahoo Finance pour les {len(tickers)} tickers du lot{detail}")
+
+        closes = closes.reindex(columns=tickers).astype(float)
+        closes.index.name = "Date"
+        return closes.sort_index()
+
+
+class LocalPriceStore(MarketDataProvider):
+    """
+    Cours de clôture lus depuis un stockage local, pour rejouer l'historique hors ligne à la vitesse du disque.
+
+    Formats pris en charge dans directory :
+      npz     : closes.npz (tableaux dates, tickers et closes [dates x tickers])
+      parquet : closes.parquet (DataFrame large, index = dates, colonnes = tickers)
+      csv     : un fichier <ticker>.csv par produit (colonnes Date, Close)
+
+    Le stockage est lu une seule fois puis gardé en mémoire ; chaque appel à get_closes n'est qu'une sélection.
+    """
+
+    FORMATS = ["npz", "parquet", "csv"]
+
+    def __init__(self, directory, format="npz"):
+        if format not in self.FORMATS:
+            raise ValueError(f"Format inconnu : {format}. Formats possibles : {self.FORMATS}")
+        self.directory = directory
+        self.format = format
+        self._dates = None
+        self._tickers = None
+        self._closes = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._closes is None:
+                self._read()
+
+    def _read(self):
+        if self.format == "npz":
+            with np.load(os.path.join(self.directory, "closes.npz")) as store:
+                self._dates = store["dates"].astype("datetime64[D]")
+                self._tickers = pd.Index(store["tickers"].astype(str))
+                self._closes = store["closes"].astype(float)
+            return
+
+        if self.format == "parquet":
+            closes = pd.read_parquet(os.path.join(self.directory, "closes.parquet"))
+        else:
+            series = {}
+            for file_name in sorted(os.listdir(self.directory)):
+                if file_name.endswith(".csv"):
+                    prices = pd.read_csv(os.path.join(self.directory, file_name), usecols=["Date", "Close"],
+                                         parse_dates=["Date"], index_col="Date", float_precision="round_trip")
+                    series[file_name[:-len(".csv")]] = prices["Close"]
+            closes = pd.DataFrame(series)
+        closes = closes.sort_index()
+        self._dates = pd.to_datetime(closes.index).to_numpy().astype("datetime64[D]")
+        self._tickers = pd.Index(closes.columns.astype(str))
+        self._closes = closes.to_numpy(dtype=float)
+
+    def get_closes(self, tickers, start_date, end_date):
+        self._load()
+        tickers = list(tickers)
+        lo = np.searchsorted(self._dates, np.datetime64(pd.to_datetime(start_date), "D"), side="left")
+        hi = np.searchsorted(self._dates, np.datetime64(pd.to_datetime(end_date), "D"), side="left")
+
+        cols = self._tickers.get_indexer(tickers)
+        known = cols >= 0
+        closes = np.full((hi - lo, len(tickers)), np.nan)
+        closes[:, known] = self._closes[lo:hi, cols[known]]
+        # On ne garde que les dates où au moins un des tickers demandés a un cours (comme yf.download)
+        traded = ~np.isnan(closes).all(axis=1)
+        index = pd.DatetimeIndex(self._dates[lo:hi][traded].astype("datetime64[ns]"), name="Date")
+        return pd.DataFrame(closes[traded], index=index, columns=tickers)
+
+    def write(self, closes):
+        """Écrit un DataFrame large de cours (index = dates, colonnes = tickers) au format du stockage."""
+        os.makedirs(self.directory, exist_ok=True)
+        closes = closes.sort_index()
+        if self.format == "npz":
+            np.savez(os.path.join(self.directory, "closes.npz"),
+                     dates=pd.to_datetime(closes.index).to_numpy().astype("datetime64[D]"),
+                     tickers=np.asarray(closes.columns, dtype=str), closes=closes.to_numpy(dtype=float))
+        elif self.format == "parquet":
+            closes.to_parquet(os.path.join(self.directory, "closes.parquet"))
+        else:
+            for ticker in closes.columns:
+                prices = closes[ticker].dropna().rename("Close").rename_axis("Date")
+                prices.to_csv(os.path.join(self.directory, f"{ticker}.csv"), float_format="%.17g")
+        self._closes = None
+
+
+class TokenBucket:
+    """
+    Limiteur de débit partagé entre threads : rate jetons par seconde, au plus capacity jetons en réserve.
+    acquire() consomme un jeton et attend si la réserve est vide.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class DownloadScheduler:
+    """
+    Découpe une liste de tickers en lots et les télécharge en parallèle auprès d'une source de cours.
+
+    Paramètres :
+      provider    : source de cours (MarketDataProvider)
+      chunk_size  : nombre de tickers par appel à la source
+      max_workers : nombre de téléchargements simultanés
+      rate        : nombre maximal d'appels par seconde (par défaut provider.rate_limit ; None : pas de limite)
+      burst       : nombre d'appels pouvant partir d'un coup (capacité du token bucket)
+      retries     : nombre de nouvelles tentatives pour un lot en échec
+      backoff     : attente (en secondes) avant la première nouvelle tentative, doublée à chaque échec
+    """
+
+    def __init__(self, provider, chunk_size=100, max_workers=4, rate=None, burst=None, retries=3, backoff=1.0):
+        self.provider = provider
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        rate = rate if rate is not None else provider.rate_limit
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+
+    def _fetch_chunk(self, tickers, start_date, end_date):
+        for attempt in range(self.retries + 1):
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                return self.provider.get_closes(tickers, start_date, end_date)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print(f"Échec du lot {tickers[0]}..{tickers[-1]} ({e}), nouvelle tentative dans {self.backoff * 2 ** attempt:.1f} s")
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def fetch(self, tickers, start_date, end_date):
+        """
+        Télécharge les cours des tickers par lots et renvoie les lots au fur et à mesure qu'ils se terminent,
+        sous forme de triplets (tickers du lot, DataFrame des cours, exception ou None si le lot a réussi).
+        """
+        tickers = list(tickers)
+        chunks = [tickers[i:i + self.chunk_size] for i in range(0, len(tickers), self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._fetch_chunk, chunk, start_date, end_date): chunk for chunk in chunks}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    yield futures[future], None, e
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copie les cours Yahoo Finance des produits dans un stockage local.")
+    parser.add_argument("directory")
+    parser.add_argument("--start", default="2019-01-01")
+    parser.add_argument("--end", default="2022-12-25")
+    parser.add_argument("--db", default="fund.db")
+    parser.add_argument("--format", default="npz", choices=LocalPriceStore.FORMATS)
+    args = parser.parse_args()
+
+    with read_connection(args.db) as conn:
+        tickers = pd.read_sql_query("SELECT ticker FROM Products", conn)["ticker"].tolist()
+    frames = []
+    for chunk, chunk_closes, error in DownloadScheduler(YahooProvider()).fetch(tickers, args.start, args.end):
+        if error is not None:
+            print(f"Échec du téléchargement des tickers {chunk} : {error}")
+        else:
+            frames.append(chunk_closes)
+    closes = pd.concat(frames, axis=1).sort_index()
+    LocalPriceStore(args.directory, format=args.format).write(closes)
+    print(f"{closes.shape[1]} tickers et {closes.shape[0]} dates écrits dans {args.directory}")
@@ -1,133 +1,498 @@
-import sqlite3
 import pandas as pd
 import numpy as np
+from scipy import sparse
+from scipy.ndimage import maximum_filter1d
 from datetime import datetime, timedelta
-from io import StringIO
 import matplotlib.pyplot as plt
 import matplotlib.ticker as mtick
 import logging
+import threading
+from database import read_connection
+from returns_matrix import data_version, get_returns_matrix
 
 # Configuration du logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
+def _returns_block(conn, universe, start, end):
+    """Charge en une seule requête la matrice dense des rendements (date x produit de universe) entre start et end."""
+    #on récupère en une seule requête les rendements de toute la période
+    returns_data = pd.read_sql_query(
+        "SELECT product_id, date, value FROM Returns WHERE date BETWEEN ? AND ?",
+        conn, params=(str(start), str(end)))
+    values = pd.to_numeric(returns_data['value'], errors='coerce').to_numpy(dtype=float)
+    returned_ids = returns_data['product_id'].to_numpy()
+    held = np.isin(returned_ids, universe) & np.isfinite(values)
+
+    unique_dates, date_row = np.unique(returns_data['date'].to_numpy()[held].astype(str), return_inverse=True)
+    dates = unique_dates.astype('datetime64[D]')
+    returns_block = np.full((len(dates), len(universe)), np.nan)
+    returns_block[date_row.ravel(), np.searchsorted(universe, returned_ids[held])] = values[held]
+    return dates, returns_block
+
+
+def _portfolio_daily_returns(conn, weights, returns_matrix=None):
+    """
+    Calcule les rendements quotidiens pondérés d'une suite de portefeuilles hebdomadaires.
+
+    Chaque portefeuille est détenu du jour de sa création jusqu'à 6 jours plus tard.
+    Les poids sont rangés dans une matrice creuse (portefeuille x produit), les rendements de toute
+    la période sont chargés en une seule requête, puis le rendement de chaque couple
+    (portefeuille, date) est obtenu par un unique produit pondéré aligné sur cette matrice.
+
+    Paramètres :
+      conn           : connexion SQLite ouverte (inutilisée si returns_matrix est fourni)
+      weights        : poids au format long (portfolio_id, date_creation, product_id, weight), trié par
+                       date_creation puis portfolio_id (voir _load_weights)
+      returns_matrix : ReturnsMatrix à utiliser à la place de la table Returns (ex. backtest en mémoire)
+
+    Retourne un DataFrame (date, return) dans l'ordre des portefeuilles puis des dates,
+    indexé par la position du portefeuille d'origine dans la suite des portefeuilles de weights.
+    """
+    if weights.empty:
+        return pd.DataFrame({'date': np.array([], dtype='datetime64[ns]'), 'return': np.array([], dtype=float)})
+
+    # Numéro de chaque portefeuille dans l'ordre des lignes (les lignes d'un portefeuille sont contiguës)
+    codes, _ = pd.factorize(weights['portfolio_id'].to_numpy())
+    n_portfolios = codes.max() + 1
+    first_rows = np.r_[0, np.flatnonzero(np.diff(codes)) + 1]
+    creation_dates = pd.to_datetime(weights['date_creation'].to_numpy()[first_rows]).to_numpy().astype('datetime64[D]')
+    values = weights['weight'].to_numpy(dtype=float)
+    product_ids = weights['product_id'].to_numpy()
+
+    # Vérification et normalisation des poids
+    weights_sums = np.bincount(codes, weights=values, minlength=n_portfolios)
+    scale = np.ones(n_portfolios)
+    kept = np.ones(n_portfolios, dtype=bool)
+    for position in np.flatnonzero(~np.isclose(weights_sums, 1.0, atol=1e-5)):
+        start_date, weights_sum = creation_dates[position], weights_sums[position]
+        logger.warning(f"Portefeuille du {start_date}: Somme des poids = {weights_sum:.4f}, normalisation appliquée")
+
+        # Normalisation des poids pour qu'ils s'additionnent à 1
+        if weights_sum > 0:  # Éviter division par zéro
+            scale[position] = weights_sum
+        else:
+            logger.error(f"Portefeuille du {start_date}: Somme des poids = {weights_sum:.4f}, impossible de normaliser")
+            kept[position] = False
+
+    positions = np.flatnonzero(kept)
+    if len(positions) == 0:
+        return pd.DataFrame({'date': np.array([], dtype='datetime64[ns]'), 'return': np.array([], dtype=float)})
+    held_rows = kept[codes]
+    # Ligne de chaque portefeuille conservé dans la matrice des poids
+    rows = (np.cumsum(kept) - 1)[codes[held_rows]]
+    product_ids = product_ids[held_rows]
+    values = values[held_rows] / scale[codes[held_rows]]
+    starts = creation_dates[positions]
+
+    # Matrice creuse des poids : une ligne par portefeuille, une colonne par produit
+    universe = np.unique(product_ids)
+    weight_matrix = sparse.csr_matrix(
+        (values, (rows, np.searchsorted(universe, product_ids))),
+        shape=(len(starts), len(universe)))
+
+    ends = starts + np.timedelta64(6, 'D')
+
+    if returns_matrix is not None:
+        dates, returns_block = returns_matrix.block(universe, starts.min(), ends.max())
+    else:
+        dates, returns_block = _returns_block(conn, universe, starts.min(), ends.max())
+
+    # Couples (portefeuille, date) : chaque portefeuille couvre les dates de sa semaine de détention
+    lo = np.searchsorted(dates, starts, side='left')
+    hi = np.searchsorted(dates, ends, side='right')
+    lengths = hi - lo
+    pair_portfolio = np.repeat(np.arange(len(starts)), lengths)
+    pair_date = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(lo, lengths)
+
+    # Produit aligné : poids du portefeuille de chaque couple x rendements de la date du couple
+    pair_weights = weight_matrix[pair_portfolio].tocoo()
+    pair_returns = returns_block[pair_date[pair_weights.row], pair_weights.col]
+    observed = ~np.isnan(pair_returns)
+    daily_returns = np.bincount(pair_weights.row[observed], weights=pair_weights.data[observed] * pair_returns[observed],
+                                minlength=len(pair_date))
+    has_returns = np.bincount(pair_weights.row[observed], minlength=len(pair_date)) > 0
+
+    logger.info(f"{len(starts)} portefeuilles, {int(has_returns.sum())} jours de rendements")
+
+    return pd.DataFrame({'date': dates[pair_date[has_returns]].astype('datetime64[ns]'),
+                         'return': daily_returns[has_returns]},
+                        index=positions[pair_portfolio[has_returns]])
+
+
+def _load_weights(conn, portfolio_type, after_id=0, include_id=None):
+    """
+    Charge en une seule requête les poids des portefeuilles d'un profil (table PortfolioWeights), au format long
+    (portfolio_id, date_creation, product_id, weight) trié par date_creation puis portfolio_id.
+    Seuls les portefeuilles d'identifiant supérieur à after_id (ou égal à include_id) sont chargés.
+    """
+    return pd.read_sql_query(
+        """SELECT p.portfolio_id, p.date_creation, w.product_id, w.weight
+        FROM Portfolios p JOIN PortfolioWeights w ON w.portfolio_id = p.portfolio_id
+        WHERE p.type = ? AND (p.portfolio_id > ? OR p.portfolio_id = ?)
+        ORDER BY p.date_creation ASC, p.portfolio_id ASC""",
+        conn, params=(portfolio_type, after_id, include_id))
+
+
+def _load_all_weights(conn, portfolio_types=None, created_from=None, created_before=None):
+    """
+    Comme _load_weights, pour tous les profils (ou ceux de portfolio_types) en une seule requête :
+    poids au format long (portfolio_id, type, date_creation, product_id, weight) trié par date_creation puis portfolio_id.
+    created_from et created_before limitent les portefeuilles à ceux créés dans [created_from, created_before).
+    """
+    conditions = []
+    params = []
+    if portfolio_types is not None:
+        conditions.append(f"p.type IN ({', '.join('?' * len(portfolio_types))})")
+        params.extend(portfolio_types)
+    if created_from is not None:
+        conditions.append("p.date_creation >= ?")
+        params.append(str(created_from))
+    if created_before is not None:
+        conditions.append("p.date_creation < ?")
+        params.append(str(created_before))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return pd.read_sql_query(
+        f"""SELECT p.portfolio_id, p.type, p.date_creation, w.product_id, w.weight
+        FROM Portfolios p JOIN PortfolioWeights w ON w.portfolio_id = p.portfolio_id
+        {where}
+        ORDER BY p.date_creation ASC, p.portfolio_id ASC""",
+        conn, params=params)
+
+
+def _daily_returns_by_type(weights, daily):
+    """
+    Ajoute à des rendements calculés par _portfolio_daily_returns la stratégie (colonne type) de leur portefeuille,
+    puis les trie par date (tri stable : à date égale, l'ordre des portefeuilles est conservé).
+    """
+    # Stratégie de chaque portefeuille, dans l'ordre des positions utilisé par _portfolio_daily_returns
+    first_rows = ~weights['portfolio_id'].duplicated().to_numpy()
+    types_by_position = weights['type'].to_numpy()[first_rows]
+    daily = daily.assign(type=types_by_position[daily.index.to_numpy()] if len(daily) else [])
+    return daily.sort_values('date', kind='stable')
+
+
+def _latest_returns(daily, by=()):
+    """
+    Ne garde, pour chaque date (et chaque valeur des colonnes by), que le rendement du portefeuille le plus récent :
+    un portefeuille remplace le précédent dès sa création, même si la semaine de détention de celui-ci n'est pas finie.
+    Règle commune aux rendements calculés (_portfolio_daily_returns) et matérialisés (PortfolioReturns).
+    Les rendements doivent être dans l'ordre des portefeuilles ; le résultat est trié par date.
+    """
+    return daily.sort_values('date', kind='stable').drop_duplicates([*by, 'date'], keep='last')
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def write_portfolio_returns(conn, start_date=None, end_date=None, profiles=None):
+    """
+    Recalcule dans la table PortfolioReturns les rendements quotidiens des profils (tous par défaut) entre start_date
+    et end_date inclus (toute l'histoire par défaut), à partir des portefeuilles dont la semaine de détention recoupe
+    cette période. Les lignes existantes de la période sont remplacées ; le commit est laissé à l'appelant.
+
+    Appelée à chaque écriture de portefeuilles (update_portfolio, Backtester.flush) et de rendements
+    (DataImporter.fill_returns), dans la même transaction. Ne fait rien si la table n'existe pas.
+    Si deux portefeuilles d'un profil couvrent la même date, le rendement du plus récent est retenu (_latest_returns).
+    Renvoie le nombre de lignes écrites.
+    """
+    if not _has_table(conn, 'PortfolioReturns'):
+        return 0
+    start = pd.to_datetime(start_date) if start_date is not None else None
+    end = pd.to_datetime(end_date) if end_date is not None else None
+
+    # Portefeuilles détenus pendant la période : créés entre start - 6 jours et end
+    weights = _load_all_weights(
+        conn, profiles,
+        created_from=(start - timedelta(days=6)).strftime('%Y-%m-%d') if start is not None else None,
+        created_before=(end + timedelta(days=1)).strftime('%Y-%m-%d') if end is not None else None)
+    daily = _daily_returns_by_type(weights, _portfolio_daily_returns(conn, weights))
+    if start is not None:
+        daily = daily[daily['date'] >= start]
+    if end is not None:
+        daily = daily[daily['date'] <= end]
+    daily = _latest_returns(daily, by=['type'])
+
+    bounds = (start.strftime('%Y-%m-%d') if start is not None else '0000-01-01',
+              end.strftime('%Y-%m-%d') if end is not None else '9999-12-31')
+    if profiles is None:
+        conn.execute("DELETE FROM PortfolioReturns WHERE date BETWEEN ? AND ?", bounds)
+    else:
+        conn.executemany("DELETE FROM PortfolioReturns WHERE profile = ? AND date BETWEEN ? AND ?",
+                         [(profile,) + bounds for profile in profiles])
+    conn.executemany("INSERT INTO PortfolioReturns (profile, date, return) VALUES (?, ?, ?)",
+                     zip(daily['type'].tolist(), daily['date'].dt.strftime('%Y-%m-%d').tolist(),
+                         daily['return'].tolist()))
+    return len(daily)
+
+
+def _materialized(conn, portfolio_type):
+    """
+    Vrai si les rendements de la stratégie sont lus dans PortfolioReturns : la table existe et contient des lignes
+    pour cette stratégie. Sinon (base non migrée, table créée mais pas encore remplie par
+    creation_db.rebuild_portfolio_returns), les rendements sont calculés à partir des poids.
+    """
+    return (_has_table(conn, 'PortfolioReturns') and
+            conn.execute("SELECT 1 FROM PortfolioReturns WHERE profile = ? LIMIT 1", (portfolio_type,)).fetchone() is not None)
+
+
+def _load_portfolio_returns(conn, portfolio_types=None):
+    """Lit les rendements matérialisés (profile, date, return) de PortfolioReturns, triés par date."""
+    type_filter = ""
+    if portfolio_types is not None:
+        type_filter = f"WHERE profile IN ({', '.join('?' * len(portfolio_types))})"
+    return pd.read_sql_query(
+        f"SELECT profile AS type, date, return FROM PortfolioReturns {type_filter} ORDER BY date, profile",
+        conn, params=list(portfolio_types or []), parse_dates=['date'])
+
+
+def _weights_frame(allocations):
+    """Met au format de _load_weights une suite d'allocations en mémoire [(date, DataFrame des poids), ...]."""
+    frames = [pd.DataFrame({'portfolio_id': portfolio_id, 'date_creation': date,
+                            'product_id': weight_df.index.astype(int), 'weight': weight_df['weight'].to_numpy(dtype=float)})
+              for portfolio_id, (date, weight_df) in enumerate(allocations, start=1)]
+    if not frames:
+        return pd.DataFrame(columns=['portfolio_id', 'date_creation', 'product_id', 'weight'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def _merge_stats(stats, values):
+    """
+    Met à jour les accumulateurs d'une série de rendements avec de nouvelles valeurs (dans l'ordre chronologique).
+
+    Les accumulateurs sont : nombre d'observations, moyenne et somme des carrés des écarts (fusion de Chan/Welford),
+    valeur cumulée (produit des 1 + r), plus haut de la valeur cumulée et drawdown maximum.
+    Le coût est proportionnel au nombre de nouvelles valeurs.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return stats
+
+    n = stats['n'] + len(values)
+    batch_mean = values.mean()
+    delta = batch_mean - stats['mean']
+    mean = stats['mean'] + delta * len(values) / n
+    m2 = stats['m2'] + ((values - batch_mean) ** 2).sum() + delta ** 2 * stats['n'] * len(values) / n
+
+    cumulative = stats['growth'] * np.cumprod(1 + values)
+    running_max = np.maximum.accumulate(np.maximum(cumulative, stats['peak']))
+    drawdown = ((cumulative - running_max) / running_max).min()
+
+    return {'n': n, 'mean': mean, 'm2': m2, 'growth': cumulative[-1], 'peak': running_max[-1],
+            'max_drawdown': np.fmin(stats['max_drawdown'], drawdown)}
+
+
+_EMPTY_STATS = {'n': 0, 'mean': 0.0, 'm2': 0.0, 'growth': 1.0, 'peak': -np.inf, 'max_drawdown': np.nan}
+
+# Fenêtres glissantes usuelles, en nombre de jours de rendement
+ROLLING_WINDOWS = {'1M': 21, '3M': 63, '12M': 252}
+ROLLING_METRICS = ['mean_return', 'volatility', 'sharpe_ratio', 'drawdown', 'hit_rate']
+
+
+def _rolling_windows(windows):
+    """Met les fenêtres demandées au format {libellé: nombre de jours} (libellés de ROLLING_WINDOWS ou entiers)."""
+    if windows is None:
+        return dict(ROLLING_WINDOWS)
+    if isinstance(windows, dict):
+        return dict(windows)
+    if isinstance(windows, (str, int)):
+        windows = [windows]
+    return {str(window): ROLLING_WINDOWS[window] if window in ROLLING_WINDOWS else int(window) for window in windows}
+
+
+def rolling_metrics(returns, windows=None, risk_free_rate=0):
+    """
+    Indicateurs glissants d'une série de rendements quotidiens (dans l'ordre chronologique) pour plusieurs fenêtres.
+
+    Les sommes cumulées (rendements, carrés, jours positifs) et la valeur cumulée sont calculées une seule fois ;
+    chaque fenêtre n'est ensuite qu'une différence de sommes cumulées, et le plus haut glissant de la valeur
+    cumulée un filtre maximum linéaire (maximum_filter1d) : le coût est O(n) par fenêtre, sans boucle Python.
+
+    Pour chaque fenêtre de w jours (les w - 1 premières valeurs valent NaN) :
+      mean_return  : rendement moyen
+      volatility   : écart-type (ddof=1, comme PortfolioMetrics.volatility)
+      sharpe_ratio : (mean_return - risk_free_rate) / volatility
+      drawdown     : baisse de la valeur cumulée par rapport à son plus haut sur la fenêtre
+      hit_rate     : part des jours de rendement positif
+
+    Retourne un DataFrame (une ligne par rendement) dont les colonnes sont indexées par (fenêtre, indicateur).
+    """
+    windows = _rolling_windows(windows)
+    returns = np.asarray(returns, dtype=float)
+    n = len(returns)
+
+    # Rendements centrés sur leur moyenne : limite les erreurs d'arrondi de la variance par sommes cumulées
+    offset = returns.mean() if n else 0.0
+    sums = np.concatenate([[0.0], np.cumsum(returns - offset)])
+    squares = np.concatenate([[0.0], np.cumsum((returns - offset) ** 2)])
+    hits = np.concatenate([[0], np.cumsum(returns > 0)])
+    growth = np.concatenate([[1.0], np.cumprod(1 + returns)])
+
+    frames = {}
+    for label, size in windows.items():
+        values = np.full((n, len(ROLLING_METRICS)), np.nan)
+        if 1 <= size <= n:
+            end = np.arange(size, n + 1)
+            window_sum = sums[end] - sums[end - size]
+            mean = window_sum / size + offset
+            variance = np.maximum(squares[end] - squares[end - size] - window_sum ** 2 / size, 0) / (size - 1) \
+                if size > 1 else np.full(len(end), np.nan)
+            volatility = np.sqrt(variance)
+            # Plus haut de la valeur cumulée sur la fenêtre, valeur de départ comprise (size + 1 points)
+            peak = maximum_filter1d(growth, size + 1, origin=size // 2, mode='nearest')[end]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values[size - 1:] = np.column_stack([
+                    mean, volatility, (mean - risk_free_rate) / volatility,
+                    (growth[end] - peak) / peak, (hits[end] - hits[end - size]) / size])
+        frames[label] = pd.DataFrame(values, columns=ROLLING_METRICS)
+    if not frames:
+        return pd.DataFrame(index=range(n))
+    return pd.concat(frames, axis=1)
+
+
 class PortfolioMetrics:
     def __init__(self, portfolio_type, db_file="fund.db"):
         self.db_file = db_file
         self.portfolio_type = portfolio_type
+        # Protège les caches dérivés (_rolling, _growth), remplis à la demande par des lecteurs concurrents
+        self._cache_lock = threading.Lock()
+        self._reset()
         self._load_returns()
-        
+
+    def __getstate__(self):
+        # Le verrou n'est ni copié ni sérialisé : chaque copie (copy.deepcopy, pickle) a le sien
+        state = self.__dict__.copy()
+        del state['_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cache_lock = threading.Lock()
+
+    def _reset(self):
+        # Rendements des portefeuilles "clos" et accumulateurs associés
+        self._closed_returns = pd.DataFrame({'date': np.array([], dtype='datetime64[ns]'), 'return': np.array([], dtype=float)})
+        self._closed_stats = _EMPTY_STATS
+        # Le dernier portefeuille traité reste "ouvert" : sa semaine peut encore recevoir des rendements
+        self._open_returns = self._closed_returns
+        self._open_portfolio_id = None
+        # Marqueur du plus grand portfolio_id déjà traité
+        self._last_portfolio_id = 0
+        # Origine des rendements chargés : None, 'computed' (poids des portefeuilles) ou 'materialized' (PortfolioReturns)
+        self._source = None
+        # Rendements matérialisés : dernière date close et (nombre, somme) des lignes closes lus dans la table
+        self._closed_until = None
+        self._closed_check = None
+
+    def refresh(self):
+        """
+        Met à jour les rendements avec les portefeuilles créés depuis le dernier chargement.
+        Seuls les nouveaux portefeuilles (et la semaine du dernier portefeuille traité) sont recalculés ;
+        si la table PortfolioReturns contient les rendements de la stratégie, seules les lignes postérieures
+        aux rendements clos (et la dernière semaine) sont relues.
+        """
+        self._load_returns()
+
     def _load_returns(self):
         """Charge les rendements du portefeuille depuis la base de données."""
-        with sqlite3.connect(self.db_file) as conn:
-            #on récupère les données de la table portfolios
-            portfolios = pd.read_sql_query(
-                """SELECT date_creation, produits FROM Portfolios 
-                WHERE type = ? AND produits IS NOT NULL ORDER BY date_creation ASC""", 
-                conn, params=(self.portfolio_type,))
-            
-            portfolios['date_creation'] = pd.to_datetime(portfolios['date_creation'])
+        with read_connection(self.db_file) as conn:
+            # Rendements matérialisés (table PortfolioReturns) : lecture sur la clé (profile, date)
+            if _materialized(conn, self.portfolio_type):
+                self._load_materialized(conn)
+                return
+            if self._source == 'materialized':
+                self._reset()
+            self._source = 'computed'
 
-            #on initialise les vecteurs de rendements et de dates
-            all_returns = []
-            all_dates = []
-            
-            for _, portfolio in portfolios.iterrows():
-                start_date = portfolio['date_creation']
-                end_date = start_date + timedelta(days=6)
-                
-                #on récupère les poids
-                weights = pd.read_json(StringIO(portfolio['produits']), orient='index')
-                
-                # Vérification et normalisation des poids
-                weights_sum = weights['weight'].sum()
-                if not np.isclose(weights_sum, 1.0, atol=1e-5):
-                    logger.warning(f"Portefeuille du {start_date.strftime('%Y-%m-%d')}: Somme des poids = {weights_sum:.4f}, normalisation appliquée")
-                    
-                    # Normalisation des poids pour qu'ils s'additionnent à 1
-                    if weights_sum > 0:  # Éviter division par zéro
-                        weights['weight'] = weights['weight'] / weights_sum
-                    else:
-                        logger.error(f"Portefeuille du {start_date.strftime('%Y-%m-%d')}: Somme des poids = {weights_sum:.4f}, impossible de normaliser")
-                        continue  # Skip this portfolio
-                
-                product_ids = weights.index.tolist()
-                
-                if not product_ids:  # Skip if no products in portfolio
-                    continue
-                    
-                #on récupère les rendements
-                product_id_list = ", ".join(f"'{id}'" for id in product_ids)  # Utilisation de guillemets pour éviter les problèmes de type
-                query = f"""
-                    SELECT product_id, date, value 
-                    FROM Returns 
-                    WHERE product_id IN ({product_id_list}) 
-                    AND date BETWEEN '{start_date.strftime('%Y-%m-%d')}' AND '{end_date.strftime('%Y-%m-%d')}'
-                """
-
-                #on exécute la requête pour récupérer les rendements
-                returns_data = pd.read_sql_query(query, conn)
-                returns_data['date'] = pd.to_datetime(returns_data['date'])
-                # Filtrer les valeurs infinies dans 'value'
-                returns_data['value'] = pd.to_numeric(returns_data['value'], errors='coerce')
-                returns_data = returns_data.replace([np.inf, -np.inf], np.nan).dropna(subset=['value'])
-                
-                if returns_data.empty:  # Skip if no returns data found
-                    continue
-                    
-                returns_data['date'] = pd.to_datetime(returns_data['date'])
-                
-                # Création d'un DataFrame pour les rendements quotidiens de ce portefeuille
-                date_range = pd.date_range(start=start_date, end=end_date)
-                portfolio_returns = pd.DataFrame(index=date_range, columns=['return'])
-                
-                for date, group in returns_data.groupby('date'):
-                    # S'assurer que les types de product_id sont cohérents pour le merge
-                    product_id_col = group['product_id'].astype(str)
-                    weight_index = weights.index.astype(str)
-                    
-                    # Créer un dataframe temporaire avec les poids pour faciliter le merge
-                    weights_df = pd.DataFrame({'weight': weights['weight']})
-                    weights_df.index = weight_index
-                    
-                    # Merge des rendements avec les poids
-                    merged = pd.DataFrame({'product_id': product_id_col, 'value': group['value']})
-                    merged = merged.merge(weights_df, left_on='product_id', right_index=True, how='inner')
-                    
-                    # Calculer le rendement pondéré
-                    if not merged.empty:
-                        daily_return = (merged['value'] * merged['weight']).sum()
-                        portfolio_returns.loc[date, 'return'] = daily_return
-                
-                # Ajouter les rendements non-nuls aux listes globales
-                valid_returns = portfolio_returns.dropna()
-                for date, row in valid_returns.iterrows():
-                    all_returns.append(row['return'])
-                    all_dates.append(date)
-                
-                # Logging des informations utiles pour le débogage
-                logger.info(f"Portefeuille du {start_date.strftime('%Y-%m-%d')}: {len(product_ids)} produits, {valid_returns.shape[0]} jours de rendements")
-            
-            self._returns = pd.DataFrame({'date': all_dates, 'return': all_returns})
-            self._returns.sort_values('date', inplace=True)
-            
-            # Si aucun rendement n'a été calculé, créer un DataFrame vide avec les bonnes colonnes
-            if self._returns.empty:
-                self._returns = pd.DataFrame(columns=['date', 'return'])
+            #on récupère les poids des portefeuilles postérieurs au marqueur, plus ceux du dernier portefeuille traité
+            weights = _load_weights(conn, self.portfolio_type, self._last_portfolio_id, self._open_portfolio_id)
+
+            if weights.empty:
+                self._update_returns()
+                return
+
+            # Un portefeuille antérieur aux rendements déjà clos invalide les accumulateurs : rechargement complet
+            if (self._last_portfolio_id and not self._closed_returns.empty
+                    and pd.to_datetime(weights['date_creation']).min() <= self._closed_returns['date'].max()):
+                self._reset()
+                self._load_returns()
+                return
+
+            new_returns = _latest_returns(
+                _portfolio_daily_returns(conn, weights, returns_matrix=get_returns_matrix(self.db_file)))
+
+        is_open = new_returns.index == weights['portfolio_id'].nunique() - 1
+        closed = new_returns[~is_open]
+        self._closed_stats = _merge_stats(self._closed_stats, closed['return'].to_numpy())
+        self._closed_returns = pd.concat([self._closed_returns, closed], ignore_index=True)
+        self._open_returns = new_returns[is_open].reset_index(drop=True)
+        self._open_portfolio_id = int(weights['portfolio_id'].iloc[-1])
+        self._last_portfolio_id = max(self._last_portfolio_id, int(weights['portfolio_id'].max()))
+        self._update_returns()
+
+    def _closed_aggregate(self, conn, until):
+        """(nombre, somme) des rendements matérialisés de la stratégie jusqu'à until inclus."""
+        return conn.execute("SELECT COUNT(*), TOTAL(return) FROM PortfolioReturns WHERE profile = ? AND date <= ?",
+                            (self.portfolio_type, until)).fetchone()
+
+    def _load_materialized(self, conn):
+        """
+        Met à jour les rendements à partir de la table PortfolioReturns, en ne lisant que les lignes postérieures à
+        la dernière date close. Les 7 derniers jours de rendements restent "ouverts" (ils sont relus à chaque appel :
+        un nouveau portefeuille ou de nouveaux rendements peuvent encore les modifier). Si les lignes closes ont changé
+        depuis (nombre ou somme différents : portefeuille antidaté, rendements recalculés), tout est relu.
+        """
+        if self._source != 'materialized' or self._closed_aggregate(conn, self._closed_until) != self._closed_check:
+            self._reset()
+            self._source = 'materialized'
+        returns = pd.read_sql_query(
+            "SELECT date, return FROM PortfolioReturns WHERE profile = ? AND date > ? ORDER BY date",
+            conn, params=(self.portfolio_type, self._closed_until or '0000-01-01'), parse_dates=['date'])
+
+        if not returns.empty:
+            closed_until = (returns['date'].iloc[-1] - timedelta(days=7)).strftime('%Y-%m-%d')
+            is_closed = returns['date'] <= closed_until
+            if is_closed.any():
+                closed = returns[is_closed]
+                self._closed_stats = _merge_stats(self._closed_stats, closed['return'].to_numpy())
+                self._closed_returns = pd.concat([self._closed_returns, closed], ignore_index=True) \
+                    if not self._closed_returns.empty else closed.reset_index(drop=True)
+                self._closed_until = closed_until
+                self._closed_check = self._closed_aggregate(conn, closed_until)
+            self._open_returns = returns[~is_closed].reset_index(drop=True)
+        else:
+            self._open_returns = returns
+        if self._closed_check is None:
+            self._closed_check = self._closed_aggregate(conn, self._closed_until)
+        self._update_returns()
+
+    def _update_returns(self):
+        self._returns = pd.concat([self._closed_returns, self._open_returns], ignore_index=True)
+        self._returns.sort_values('date', inplace=True)
+        self._stats = _merge_stats(self._closed_stats, self._open_returns['return'].to_numpy())
+
+        # Si aucun rendement n'a été calculé, créer un DataFrame vide avec les bonnes colonnes
+        if self._returns.empty:
+            self._returns = pd.DataFrame(columns=['date', 'return'])
+
+        # Caches dérivés des rendements (indicateurs glissants, valeur cumulée), recalculés à la demande
+        self._rolling = {}
+        self._growth = None
 
     
     def returns(self):
         return self._returns
     
     def mean_return(self):
-        return self._returns['return'].mean()
+        return self._stats['mean'] if self._stats['n'] else np.nan
     
     def total_return(self):
-        return (1 + self._returns['return']).prod() - 1
+        return self._stats['growth'] - 1
     
     def volatility(self):
-        return self._returns['return'].std()
+        return np.sqrt(self._stats['m2'] / (self._stats['n'] - 1)) if self._stats['n'] > 1 else np.nan
     
     def sharpe_ratio(self, risk_free_rate=0):
         mean = self.mean_return()
@@ -135,50 +500,186 @@ class PortfolioMetrics:
         return (mean - risk_free_rate) / vol
     
     def max_drawdown(self):
-        cumulative = (1 + self._returns['return']).cumprod()
-        running_max = cumulative.cummax()
-        drawdown = (cumulative - running_max) / running_max
-        return drawdown.min()
+        return self._stats['max_drawdown']
+
+    def rolling(self, windows=None, risk_free_rate=0):
+        """
+        Indicateurs glissants (voir rolling_metrics) pour les fenêtres demandées (par défaut 1M, 3M et 12M),
+        indexés par date. Chaque fenêtre est calculée une seule fois puis gardée en cache jusqu'au prochain refresh.
+        """
+        windows = _rolling_windows(windows)
+        with self._cache_lock:
+            missing = {label: size for label, size in windows.items() if (label, size, risk_free_rate) not in self._rolling}
+            if missing:
+                computed = rolling_metrics(self._returns['return'].to_numpy(dtype=float), missing, risk_free_rate)
+                for label, size in missing.items():
+                    self._rolling[(label, size, risk_free_rate)] = computed[label].set_axis(
+                        pd.DatetimeIndex(self._returns['date'], name='date'))
+            frames = {label: self._rolling[(label, size, risk_free_rate)] for label, size in windows.items()}
+        if not frames:
+            return pd.DataFrame(index=pd.DatetimeIndex(self._returns['date'], name='date'))
+        return pd.concat(frames, axis=1)
+
+    def _cumulative_growth(self):
+        # Valeur cumulée (1, 1 + r1, (1 + r1)(1 + r2), ...), calculée une seule fois jusqu'au prochain refresh
+        with self._cache_lock:
+            if self._growth is None:
+                self._growth = np.concatenate([[1.0], np.cumprod(1 + self._returns['return'].to_numpy(dtype=float))])
+            return self._growth
     
     def plot(self, plot_type='return', start_date=None, end_date=None):
-        
-        df = self._returns.copy()
-        if start_date: 
-            df = df[df['date'] >= pd.to_datetime(start_date)]
-        if end_date:
-            df = df[df['date'] <= pd.to_datetime(end_date)]
-        
-        df = df.sort_values('date')
+        """
+        Trace le rendement cumulé ('return'), le drawdown ('drawdown') ou un indicateur glissant sur les fenêtres
+        de ROLLING_WINDOWS ('rolling_volatility', 'rolling_sharpe_ratio', 'rolling_drawdown', 'rolling_hit_rate'...).
+        Les valeurs cumulées et les indicateurs glissants sont repris du cache de l'instance.
+        """
+        dates = pd.to_datetime(self._returns['date']).to_numpy()
+        lo = np.searchsorted(dates, np.datetime64(pd.to_datetime(start_date)), side='left') if start_date else 0
+        hi = np.searchsorted(dates, np.datetime64(pd.to_datetime(end_date)), side='right') if end_date else len(dates)
+        dates = dates[lo:hi]
+        # Valeur cumulée depuis le début de la période affichée
+        growth = self._cumulative_growth()
+        cum_return = growth[lo + 1:hi + 1] / growth[lo]
     
         plt.figure(figsize=(10, 5))
         
         if plot_type == 'return':
-            dates = df['date'].values
-            cum_return = (1 + df['return']).cumprod().values - 1
-            
-
-            plt.plot(dates, cum_return) # on trace le graphique
+            plt.plot(dates, cum_return - 1) # on trace le graphique
             plt.title(f'Rendement cumulé - {self.portfolio_type}')
             plt.ylabel('Rendement')
             
         elif plot_type == 'drawdown':
-            dates = df['date'].values
-            cum_return = (1 + df['return']).cumprod().values
             running_max = np.maximum.accumulate(cum_return)
             drawdown = (cum_return / running_max) - 1
             
             plt.fill_between(dates, drawdown, 0, color='red', alpha=0.3)
             plt.title(f'Drawdown - {self.portfolio_type}')
             plt.ylabel('Drawdown')
+
+        elif plot_type.startswith('rolling_'):
+            metric = plot_type[len('rolling_'):]
+            rolling = self.rolling().iloc[lo:hi]
+            for label in ROLLING_WINDOWS:
+                plt.plot(dates, rolling[(label, metric)].to_numpy(), label=label)
+            plt.title(f'{metric} glissant - {self.portfolio_type}')
+            plt.ylabel(metric)
+            plt.legend()
         
         #Formatage axe y
-        plt.gca().yaxis.set_major_formatter(mtick.PercentFormatter(1.0))
+        if plot_type != 'rolling_sharpe_ratio':
+            plt.gca().yaxis.set_major_formatter(mtick.PercentFormatter(1.0))
         plt.grid(alpha=0.3)
         plt.tight_layout()
         
         return plt.gcf()
 
 
+def returns_summary(returns, risk_free_rate=0):
+    """Indicateurs d'une série de rendements quotidiens (dans l'ordre chronologique), calculés comme dans PortfolioMetrics."""
+    stats = _merge_stats(_EMPTY_STATS, returns)
+    n = stats['n']
+    mean = stats['mean'] if n else np.nan
+    vol = np.sqrt(stats['m2'] / (n - 1)) if n > 1 else np.nan
+    return {'mean_return': mean, 'total_return': stats['growth'] - 1, 'volatility': vol,
+            'sharpe_ratio': (mean - risk_free_rate) / vol, 'max_drawdown': stats['max_drawdown']}
+
+
+def batch_metrics(db_file="fund.db", portfolio_types=None, risk_free_rate=0):
+    """
+    Calcule en une seule passe les rendements quotidiens et les indicateurs de toutes les stratégies
+    (tous les Portfolios.type, ou ceux de portfolio_types).
+
+    Les rendements sont lus dans la table PortfolioReturns pour les stratégies qui y ont des lignes ; pour les autres,
+    les poids de tous leurs portefeuilles sont chargés en une requête et rangés dans une seule matrice creuse, alignée sur un seul bloc de rendements
+    (voir _portfolio_daily_returns). Dans les deux cas, le coût ne dépend pas du nombre de stratégies comparées.
+    Les indicateurs sont ceux de PortfolioMetrics.
+
+    Retourne un couple (returns, summary) :
+      returns : DataFrame large des rendements quotidiens, indexé par date, une colonne par stratégie
+                (NaN lorsqu'une stratégie n'a pas de rendement à cette date ; si deux portefeuilles d'une
+                stratégie couvrent la même date, le rendement du plus récent est retenu, dans les rendements
+                comme dans les indicateurs)
+      summary : DataFrame indexé par stratégie (mean_return, total_return, volatility, sharpe_ratio, max_drawdown)
+    """
+    with read_connection(db_file) as conn:
+        # Rendements matérialisés : une seule lecture de la table PortfolioReturns
+        if _has_table(conn, 'PortfolioReturns'):
+            daily = _load_portfolio_returns(conn, portfolio_types)
+        else:
+            daily = pd.DataFrame({'type': [], 'date': np.array([], dtype='datetime64[ns]'), 'return': []})
+        # Stratégies absentes de la table (table non remplie ou absente) : rendements calculés à partir des poids
+        requested = portfolio_types if portfolio_types is not None else \
+            [row[0] for row in conn.execute("SELECT DISTINCT type FROM Portfolios WHERE type IS NOT NULL")]
+        computed = [portfolio_type for portfolio_type in requested if not (daily['type'] == portfolio_type).any()]
+        if computed:
+            weights = _load_all_weights(conn, computed)
+            computed_daily = _latest_returns(_daily_returns_by_type(
+                weights, _portfolio_daily_returns(conn, weights, returns_matrix=get_returns_matrix(db_file))), by=['type'])
+            if daily.empty:
+                daily = computed_daily[['type', 'date', 'return']]
+            elif not computed_daily.empty:
+                daily = pd.concat([daily, computed_daily[['type', 'date', 'return']]], ignore_index=True)
+                daily = daily.sort_values('date', kind='stable')
+    types = list(portfolio_types) if portfolio_types is not None else sorted(set(daily['type']))
+
+    summary = pd.DataFrame(
+        [returns_summary(daily.loc[daily['type'] == portfolio_type, 'return'].to_numpy(), risk_free_rate)
+         for portfolio_type in types],
+        index=pd.Index(types, name='type'))
+    returns = daily.pivot_table(index='date', columns='type', values='return', aggfunc='last')
+    returns = returns.reindex(columns=pd.Index(types, name='type'))
+    return returns, summary
+
+
+def calculate_turnover(portfolio_type, db_file="fund.db", start_date=None, end_date=None):
+    """
+    Rotation du portefeuille à chaque deal, agrégée directement dans la base (table DealLines) :
+    turnover (moitié de la somme des variations de poids en valeur absolue), nombre de transactions,
+    d'achats et de ventes par date.
+    """
+    with read_connection(db_file) as conn:
+        return pd.read_sql_query(
+            """SELECT date, 0.5 * SUM(ABS(delta_weight)) AS turnover, COUNT(*) AS n_trades,
+            SUM(delta_weight > 0) AS n_buys, SUM(delta_weight < 0) AS n_sells
+            FROM DealLines
+            WHERE profile = ? AND date BETWEEN ? AND ?
+            GROUP BY date ORDER BY date""",
+            conn, params=(portfolio_type, str(start_date or "0000-01-01"), str(end_date or "9999-12-31")),
+            parse_dates=["date"])
+
+
+def database_stamp(db_file="fund.db"):
+    """
+    État de la base, utilisé comme clé de cache (voir dashboard.py) : (plus grand portfolio_id, version de Returns,
+    version de DealLines). Ne lit que la clé primaire de Portfolios et la table DataVersions.
+    """
+    with read_connection(db_file) as conn:
+        last_portfolio_id = conn.execute("SELECT MAX(portfolio_id) FROM Portfolios").fetchone()[0]
+        return last_portfolio_id, data_version(conn, "Returns"), data_version(conn, "DealLines")
+
+
+def strategy_date_bounds(portfolio_type, db_file="fund.db"):
+    """
+    Première et dernière date de rendement d'une stratégie, sans calculer ses rendements : période couverte par ses
+    portefeuilles (création du premier, fin de la semaine de détention du dernier portefeuille antérieur aux derniers
+    rendements connus) ramenée aux dates de Returns. Renvoie (NaT, NaT) si la stratégie n'a aucun portefeuille.
+    """
+    with read_connection(db_file) as conn:
+        first, last = conn.execute(
+            """SELECT MIN(date_creation), MAX(date_creation) FROM Portfolios p
+            WHERE type = ? AND date_creation <= (SELECT MAX(date) FROM Returns)
+            AND EXISTS (SELECT 1 FROM PortfolioWeights w WHERE w.portfolio_id = p.portfolio_id)""",
+            (portfolio_type,)).fetchone()
+        if first is None:
+            return pd.NaT, pd.NaT
+        last_held = (pd.to_datetime(last) + timedelta(days=6)).strftime('%Y-%m-%d')
+        start, end = conn.execute(
+            "SELECT (SELECT MIN(date) FROM Returns WHERE date >= ?), (SELECT MAX(date) FROM Returns WHERE date <= ?)",
+            (str(first)[:10], last_held)).fetchone()
+    return pd.Timestamp(start) if start else pd.NaT, pd.Timestamp(end) if end else pd.NaT
+
+
 def calculate_portfolio_returns(portfolio_type, db_file="fund.db"):
     metrics = PortfolioMetrics(portfolio_type, db_file)
-    return metrics.returns()
\ No newline at end of file
+    return metrics.returns()
+
@@ -1,38 +1,49 @@
-import sqlite3
 import pandas as pd
 import numpy as np
 import pickle
+import time
+import tracemalloc
 from sklearn.linear_model import LinearRegression
+from returns_matrix import get_returns_matrix
 
-def fit_model(start_date, end_date, db_file="fund.db", window_size=10, model_path="model.pkl"):
-    """
-    Fonction qui entraîne un modèle de régression linéaire sur les rendements de la table Returns
-    de start_date à end_date.
 
-    Le modèle utilise une fenêtre glissante de 'window_size' observations comme features pour prédire le rendement suivant.
+def _training_set(df, window_size):
+    """
+    Construit les features (X) et cibles (y) à partir d'une fenêtre glissante pour chaque produit.
 
-    Paramètres:
-        start_date : date de début de la période de formation
-        end_date   : date de fin de la période de formation
-        db_file    : chemin vers la base de données
-        window_size: nombre d'observations à utiliser pour la prédiction
-        model_path : chemin de sauvegarde du modèle entraîné
+    Les séries de tous les produits sont mises bout à bout (triées par produit puis par date) et les fenêtres
+    de window_size + 1 valeurs sont des vues glissantes sur ce tableau : aucune liste intermédiaire n'est créée.
+    Une fenêtre est retenue si elle ne chevauche pas deux produits et ne contient que des valeurs finies.
     """
-    # Récupération des rendements depuis la table Returns
-    with sqlite3.connect(db_file) as conn:
-        query = "SELECT product_id, date, value FROM Returns WHERE date BETWEEN ? AND ? ORDER BY date ASC"
-        df = pd.read_sql_query(query, conn, params=(start_date, end_date))
-    df['date'] = pd.to_datetime(df['date'])
-    
-    # Génération des features (X) et cibles (y) à partir d'une fenêtre glissante pour chaque produit
+    df = df.sort_values(["product_id", "date"], kind="stable")
+    values = df["value"].to_numpy(dtype=float)
+    codes = df["product_id"].to_numpy()
+    if len(values) <= window_size:
+        return np.empty((0, window_size)), np.empty(0)
+
+    # Fenêtres (features + cible) sous forme de vue, sans copie
+    windows = np.lib.stride_tricks.sliding_window_view(values, window_size + 1)
+
+    # Même produit au début et à la fin de la fenêtre (les données étant triées par produit)
+    valid = codes[:-window_size] == codes[window_size:]
+
+    # Nombre de valeurs non finies dans chaque fenêtre via une somme cumulée
+    bad = np.concatenate([[0], np.cumsum(~np.isfinite(values))])
+    valid &= (bad[window_size + 1:] - bad[:-window_size - 1]) == 0
+
+    selected = windows[valid]
+    return selected[:, :window_size], selected[:, window_size]
+
+
+def _training_set_loop(df, window_size):
+    """Ancienne construction par double boucle Python, conservée pour comparaison (voir benchmark_training_set)."""
     X_list = []
     y_list = []
-    
+
     for ticker, group in df.groupby("product_id"):
         group = group.sort_values("date")
         values = group['value'].values
         if len(values) > window_size:
-            # Pour chaque position possible, on prend window_size valeurs comme features et la valeur suivante comme cible
             for i in range(len(values) - window_size):
                 feature_window = values[i:i+window_size]
                 target = values[i+window_size]
@@ -40,21 +51,56 @@ def fit_model(start_date, end_date, db_file="fund.db", window_size=10, model_pat
                     continue
                 X_list.append(feature_window)
                 y_list.append(target)
-    
+
     if not X_list:
-        print("Pas suffisamment de données pour entraîner le modèle.")
-        return None
-    
+        return np.empty((0, window_size)), np.empty(0)
+
     X = np.array(X_list)
     y = np.array(y_list)
-    
-    # Nettoyage des données pour enlever les valeurs infinies ou trop grandes
     finite = np.all(np.isfinite(X), axis=1) & np.isfinite(y)
-    X = X[finite]
-    y = y[finite]
+    return X[finite], y[finite]
+
+
+def _load_training_returns(start_date, end_date, db_file):
+    # Rendements de la période lus dans la matrice projetée en mémoire (voir returns_matrix.load_returns_matrix),
+    # remis au format long (product_id, date, value) trié par date.
+    # Les cellules vides entre la première et la dernière observation d'un produit sont gardées (valeur NaN) :
+    # comme les rendements NULL de l'ancienne requête, elles écartent les fenêtres qui les contiennent
+    # au lieu de les faire enjamber le trou
+    matrix = get_returns_matrix(db_file)
+    dates, block = matrix.block(matrix.product_ids, start_date, end_date)
+    observed = ~np.isnan(block)
+    first = np.argmax(observed, axis=0)
+    last = len(dates) - 1 - np.argmax(observed[::-1], axis=0)
+    rows = np.arange(len(dates))[:, None]
+    date_pos, product_pos = np.nonzero(observed.any(axis=0) & (rows >= first) & (rows <= last))
+    return pd.DataFrame({'product_id': matrix.product_ids[product_pos],
+                         'date': dates[date_pos].astype('datetime64[ns]'),
+                         'value': block[date_pos, product_pos]})
+
+
+def fit_model(start_date, end_date, db_file="fund.db", window_size=10, model_path="model.pkl"):
+    """
+    Fonction qui entraîne un modèle de régression linéaire sur les rendements de la table Returns
+    de start_date à end_date.
+
+    Le modèle utilise une fenêtre glissante de 'window_size' observations comme features pour prédire le rendement suivant.
+
+    Paramètres:
+        start_date : date de début de la période de formation
+        end_date   : date de fin de la période de formation
+        db_file    : chemin vers la base de données
+        window_size: nombre d'observations à utiliser pour la prédiction
+        model_path : chemin de sauvegarde du modèle entraîné
+    """
+    # Récupération des rendements depuis la table Returns
+    df = _load_training_returns(start_date, end_date, db_file)
+    
+    # Génération des features (X) et cibles (y) à partir d'une fenêtre glissante pour chaque produit
+    X, y = _training_set(df, window_size)
     
     if len(X) == 0:
-        print("Aucune donnée valide après nettoyage.")
+        print("Pas suffisamment de données pour entraîner le modèle.")
         return None
     
     # Entraînement du modèle de régression linéaire
@@ -68,5 +114,29 @@ def fit_model(start_date, end_date, db_file="fund.db", window_size=10, model_pat
     print("Le modèle a été entraîné et sauvegardé dans", model_path)
     return model
 
+def benchmark_training_set(start_date, end_date, db_file="fund.db", window_size=10):
+    """
+    Compare la construction vectorisée du jeu d'entraînement à l'ancienne double boucle :
+    durée et pic mémoire (tracemalloc) de chaque méthode, et vérification que X et y sont identiques.
+    """
+    df = _load_training_returns(start_date, end_date, db_file)
+
+    results = {}
+    outputs = {}
+    for name, builder in [("loop", _training_set_loop), ("vectorized", _training_set)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        outputs[name] = builder(df, window_size)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = {"seconds": elapsed, "peak_mb": peak / 1e6, "samples": len(outputs[name][1])}
+        print(f"{name}: {elapsed:.3f} s, pic mémoire {peak / 1e6:.1f} Mo, {len(outputs[name][1])} échantillons")
+
+    (X_loop, y_loop), (X_vec, y_vec) = outputs["loop"], outputs["vectorized"]
+    results["identical"] = bool(np.array_equal(X_loop, X_vec) and np.array_equal(y_loop, y_vec))
+    print("Jeux d'entraînement identiques :", results["identical"])
+    return results
+
 if __name__ == "__main__":
     fit_ml_model(start_date="2019-01-01", end_date="2022-12-31")
\ No newline at end of file
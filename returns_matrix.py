@@ -0,0 +1,437 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from database import bump_data_version, data_version, read_connection
+
+
+class ReturnsMatrix:
+    """
+    Matrice dense des rendements (dates x product_id) gardée en mémoire.
+
+    Les lignes correspondent aux dates triées par ordre chronologique, les colonnes aux produits.
+    Une observation absente vaut NaN. La matrice est chargée une seule fois depuis la table Returns
+    puis complétée sur place à chaque ajout de nouvelles lignes (voir DataImporter.fill_returns),
+    de sorte que le coût d'une mise à jour ne dépend que du nombre de nouvelles lignes.
+
+    La matrice peut aussi être écrite sur disque (save) puis projetée en mémoire (open) : c'est la copie de la table
+    Returns tenue à jour par refresh_snapshot, que load_returns_matrix ouvre sans requête SQL.
+    version est la version de la table Returns (voir returns_version) dont la matrice est la copie.
+    history_version est incrémenté chaque fois que des lignes déjà visibles changent (valeur remplacée, date insérée
+    au milieu de l'historique, retour en arrière d'advance) : un calcul incrémental qui n'a vu que des ajouts
+    de lignes en fin de matrice reste valable tant qu'il ne change pas (voir covariance.RollingCovariance).
+    """
+
+    def __init__(self):
+        # Buffers avec capacité de réserve pour pouvoir ajouter des dates sans tout recopier
+        self._dates = np.array([], dtype="datetime64[D]")
+        self._values = np.empty((0, 0))
+        self._n_rows = 0
+
+        self.product_ids = np.array([], dtype=np.int64)
+        self._product_index = pd.Index(self.product_ids)
+
+        # Nombre d'observations et indice de la dernière observation par produit
+        self._counts = np.array([], dtype=np.int64)
+        self._last_row = np.array([], dtype=np.int64)
+        self._read_only = False
+        self.version = None
+        self.history_version = 0
+
+    @classmethod
+    def from_db(cls, db_file="fund.db"):
+        """Charge l'intégralité de la table Returns en une seule requête."""
+        with read_connection(db_file) as conn:
+            # Version et rendements lus dans la même transaction : la version décrit exactement les lignes lues
+            conn.execute("BEGIN")
+            version = returns_version(conn)
+            df = pd.read_sql_query("SELECT product_id, date, value FROM Returns", conn)
+        matrix = cls()
+        matrix.extend(df["product_id"].values, df["date"].values, df["value"].values)
+        matrix.version = version
+        return matrix
+
+    @classmethod
+    def from_dense(cls, dates, product_ids, values, n_rows=None):
+        """
+        Construit une matrice sur un tableau dense déjà rempli (date x produit), sans copie.
+        Seules les n_rows premières lignes sont visibles (toutes par défaut) ; advance() en rend d'autres visibles.
+        La matrice obtenue est en lecture seule.
+        """
+        matrix = cls()
+        matrix._dates = np.asarray(dates, dtype="datetime64[D]")
+        matrix._values = values
+        matrix.product_ids = np.asarray(product_ids, dtype=np.int64)
+        matrix._product_index = pd.Index(matrix.product_ids)
+        matrix._counts = np.zeros(len(matrix.product_ids), dtype=np.int64)
+        matrix._last_row = np.full(len(matrix.product_ids), -1, dtype=np.int64)
+        matrix._read_only = True
+        matrix.advance(len(matrix._dates) if n_rows is None else n_rows)
+        return matrix
+
+    def advance(self, n_rows):
+        """Rend visibles les n_rows premières lignes d'une matrice dense, en O(lignes ajoutées)."""
+        if n_rows < self._n_rows:
+            self.history_version += 1
+            self._counts[:] = 0
+            self._last_row[:] = -1
+            self._n_rows = 0
+        if n_rows == self._n_rows:
+            return
+        observed = ~np.isnan(self._values[self._n_rows:n_rows])
+        self._counts += observed.sum(axis=0)
+        last = n_rows - 1 - np.argmax(observed[::-1], axis=0)
+        self._last_row = np.where(observed.any(axis=0), last, self._last_row)
+        self._n_rows = n_rows
+
+    def advance_to(self, date):
+        """Rend visibles toutes les lignes d'une matrice dense datées strictement avant date."""
+        self.advance(int(np.searchsorted(self._dates, np.datetime64(pd.to_datetime(date), "D"), side="left")))
+
+    def save(self, directory):
+        """
+        Écrit la matrice sous forme de tableaux NumPy (values.npy, dates.npy, product_ids.npy) dans un
+        sous-répertoire propre à cette écriture, puis la publie en remplaçant d'un seul coup (os.replace) le fichier
+        directory/manifest.json (sous-répertoire, version, dimensions).
+
+        Un lecteur voit donc toujours les trois tableaux d'une même version. Les sous-répertoires sont nommés dans
+        l'ordre des écritures : les versions antérieures à celle publiée sont ensuite supprimées (un processus qui les a
+        déjà projetées en mémoire continue de les lire sans erreur), et une écriture dépassée par une écriture
+        concurrente plus récente n'est pas publiée.
+        """
+        os.makedirs(directory, exist_ok=True)
+        version_dir = tempfile.mkdtemp(prefix=f"v{time.time_ns():020d}-", dir=directory)
+        name = os.path.basename(version_dir)
+        manifest = os.path.join(directory, "manifest.json")
+        try:
+            for array_name, array in [("values", np.ascontiguousarray(self.values)), ("dates", self.dates),
+                                      ("product_ids", self.product_ids)]:
+                with open(os.path.join(version_dir, f"{array_name}.npy"), "wb") as f:
+                    np.save(f, array)
+            published = _published_path(directory)
+            if published is not None and published > name:
+                shutil.rmtree(version_dir, ignore_errors=True)
+                return
+            with open(f"{manifest}.{os.getpid()}.tmp", "w") as f:
+                json.dump({"path": name, "version": self.version, "n_rows": len(self),
+                           "n_products": len(self.product_ids)}, f)
+            os.replace(f"{manifest}.{os.getpid()}.tmp", manifest)
+        except FileNotFoundError:
+            # Sous-répertoire supprimé par une écriture concurrente plus récente, déjà publiée
+            return
+
+        for other in os.listdir(directory):
+            path = os.path.join(directory, other)
+            if other.startswith("v") and other < name and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif other in ("values.npy", "dates.npy", "product_ids.npy"):
+                # Tableaux d'une copie écrite avant les sous-répertoires de version
+                os.remove(path)
+
+    @classmethod
+    def open(cls, directory, n_rows=None, retries=5):
+        """
+        Ouvre une matrice écrite par save() : les rendements sont projetés en mémoire (memory-map), sans copie.
+        Les dimensions des tableaux sont vérifiées par rapport au manifeste ; si une écriture concurrente a remplacé
+        la version entre-temps (tableaux supprimés ou incohérents), la lecture est reprise jusqu'à retries fois.
+        """
+        for attempt in range(retries + 1):
+            try:
+                with open(os.path.join(directory, "manifest.json")) as f:
+                    manifest = json.load(f)
+                # Copie écrite avant les sous-répertoires de version : tableaux directement dans directory
+                version_dir = os.path.join(directory, manifest.get("path", ""))
+                values = np.load(os.path.join(version_dir, "values.npy"), mmap_mode="r")
+                dates = np.load(os.path.join(version_dir, "dates.npy"))
+                product_ids = np.load(os.path.join(version_dir, "product_ids.npy"))
+            except (OSError, ValueError):
+                if attempt == retries:
+                    raise
+            else:
+                shape = (manifest["n_rows"], manifest["n_products"])
+                if values.shape == shape and dates.shape == shape[:1] and product_ids.shape == shape[1:]:
+                    matrix = cls.from_dense(dates, product_ids, values, n_rows)
+                    matrix.version = manifest["version"]
+                    return matrix
+                if attempt == retries:
+                    raise ValueError(f"Copie de Returns incohérente dans {directory} : dimensions {values.shape}, "
+                                     f"{dates.shape}, {product_ids.shape} au lieu de {shape}.")
+            time.sleep(0.05 * (attempt + 1))
+
+    @property
+    def dates(self):
+        return self._dates[:self._n_rows]
+
+    @property
+    def values(self):
+        return self._values[:self._n_rows]
+
+    def __len__(self):
+        return self._n_rows
+
+    def extend(self, product_ids, dates, values):
+        """
+        Ajoute (ou remplace) des observations dans la matrice.
+
+        Paramètres :
+          product_ids : identifiants des produits
+          dates       : dates des observations (chaînes 'YYYY-MM-DD' ou datetime64)
+          values      : rendements associés (les valeurs non finies sont ignorées)
+        """
+        if self._read_only:
+            if self._n_rows < len(self._dates):
+                raise ValueError("Matrice de rendements en lecture seule : utiliser advance() ou reconstruire la matrice.")
+            # Matrice complète projetée en mémoire : copie en mémoire vive avant la première modification
+            self._values = np.array(self._values)
+            self._dates = np.array(self._dates)
+            self._read_only = False
+        values = np.asarray(values, dtype=float)
+        finite = np.isfinite(values)
+        product_ids = np.asarray(product_ids, dtype=np.int64)[finite]
+        values = values[finite]
+        if len(values) == 0:
+            return
+
+        # Conversion des dates : on ne parse que les dates distinctes
+        unique_dates, inverse = np.unique(np.asarray(dates)[finite], return_inverse=True)
+        days = unique_dates.astype("datetime64[D]")[inverse.ravel()]
+
+        visible_rows = self._n_rows
+        self._add_products(np.unique(product_ids))
+        self._add_dates(np.unique(days))
+
+        rows = np.searchsorted(self.dates, days)
+        if (rows < visible_rows).any():
+            self.history_version += 1
+        cols = self._product_index.get_indexer(product_ids)
+
+        # En cas de doublon (produit, date) dans le lot, la dernière valeur l'emporte
+        keys = rows * len(self.product_ids) + cols
+        _, last = np.unique(keys[::-1], return_index=True)
+        last = len(keys) - 1 - last
+        rows, cols, values = rows[last], cols[last], values[last]
+
+        new_cells = np.isnan(self._values[rows, cols])
+        np.add.at(self._counts, cols[new_cells], 1)
+        np.maximum.at(self._last_row, cols, rows)
+        self._values[rows, cols] = values
+
+    def _add_products(self, product_ids):
+        new_ids = product_ids[self._product_index.get_indexer(product_ids) < 0]
+        if len(new_ids) == 0:
+            return
+        padding = np.full((self._values.shape[0], len(new_ids)), np.nan)
+        self._values = np.hstack([self._values, padding])
+        self.product_ids = np.concatenate([self.product_ids, new_ids])
+        self._product_index = pd.Index(self.product_ids)
+        self._counts = np.concatenate([self._counts, np.zeros(len(new_ids), dtype=np.int64)])
+        self._last_row = np.concatenate([self._last_row, np.full(len(new_ids), -1, dtype=np.int64)])
+
+    def _add_dates(self, days):
+        current = self.dates
+        pos = np.searchsorted(current, days)
+        known = (pos < len(current)) & (current[np.minimum(pos, len(current) - 1)] == days) if len(current) else np.zeros(len(days), bool)
+        new_days = days[~known]
+        if len(new_days) == 0:
+            return
+
+        n_new = self._n_rows + len(new_days)
+        if self._n_rows == 0 or new_days[0] > current[-1]:
+            # Cas courant : dates postérieures à la dernière date connue, ajout en fin de matrice
+            if n_new > self._values.shape[0]:
+                capacity = max(n_new, 2 * self._values.shape[0], 64)
+                values = np.full((capacity, len(self.product_ids)), np.nan)
+                values[:self._n_rows] = self.values
+                dates = np.empty(capacity, dtype="datetime64[D]")
+                dates[:self._n_rows] = current
+                self._values, self._dates = values, dates
+            self._dates[self._n_rows:n_new] = new_days
+        else:
+            # Dates insérées au milieu de l'historique : on reconstruit l'index (cas rare)
+            self.history_version += 1
+            all_dates = np.union1d(current, new_days)
+            old_pos = np.searchsorted(all_dates, current)
+            capacity = max(n_new, self._values.shape[0])
+            values = np.full((capacity, len(self.product_ids)), np.nan)
+            values[old_pos] = self.values
+            dates = np.empty(capacity, dtype="datetime64[D]")
+            dates[:n_new] = all_dates
+            self._values, self._dates = values, dates
+            has_obs = self._last_row >= 0
+            self._last_row[has_obs] = old_pos[self._last_row[has_obs]]
+        self._n_rows = n_new
+
+    def _columns(self, product_ids):
+        if product_ids is None:
+            return np.arange(len(self.product_ids))
+        cols = self._product_index.get_indexer(np.asarray(product_ids, dtype=np.int64))
+        return cols[cols >= 0]
+
+    def block(self, product_ids, start, end):
+        """
+        Renvoie les rendements des produits demandés entre start et end (inclus).
+
+        Retourne un couple (dates, bloc) où bloc est un tableau (nb_dates x len(product_ids)) dont les colonnes
+        suivent l'ordre de product_ids ; un produit absent de la matrice donne une colonne de NaN.
+        """
+        lo = int(np.searchsorted(self.dates, np.datetime64(pd.to_datetime(start), "D"), side="left"))
+        hi = int(np.searchsorted(self.dates, np.datetime64(pd.to_datetime(end), "D"), side="right"))
+        cols = self._product_index.get_indexer(np.asarray(product_ids, dtype=np.int64))
+        known = cols >= 0
+        block = np.full((hi - lo, len(cols)), np.nan)
+        block[:, known] = self._values[lo:hi, cols[known]]
+        return self.dates[lo:hi], block
+
+    def last_observations(self, n, product_ids=None, before=None):
+        """
+        Renvoie les n dernières observations de chaque produit qui en possède au moins n.
+
+        Paramètres :
+          n           : nombre d'observations par produit
+          product_ids : produits à considérer (par défaut tous)
+          before      : si renseignée, seules les observations strictement antérieures à cette date sont utilisées
+
+        Retourne un couple (product_ids, bloc) où bloc est un tableau (n x nb_produits)
+        trié chronologiquement, les colonnes étant triées par product_id.
+        """
+        end = self._n_rows
+        if before is not None:
+            end = int(np.searchsorted(self.dates, np.datetime64(pd.to_datetime(before), "D"), side="left"))
+
+        cols = self._columns(product_ids)
+        counts = self._counts[cols]
+        if end < self._n_rows:
+            counts = counts - (~np.isnan(self._values[end:self._n_rows, cols])).sum(axis=0)
+        cols = cols[counts >= n]
+
+        # On élargit le bloc de lignes jusqu'à ce que chaque produit y ait n observations
+        size = n
+        while True:
+            start = max(end - size, 0)
+            block = self._values[start:end, cols]
+            observed = ~np.isnan(block)
+            if start == 0 or (observed.sum(axis=0) >= n).all():
+                break
+            size *= 2
+
+        # Tri stable : les NaN passent en tête, les observations gardent leur ordre chronologique
+        order = np.argsort(observed, axis=0, kind="stable")
+        block = np.take_along_axis(block, order, axis=0)[block.shape[0] - n:]
+
+        ids = self.product_ids[cols]
+        by_id = np.argsort(ids, kind="stable")
+        return ids[by_id], block[:, by_id]
+
+    def recent_means(self, days, product_ids=None):
+        """
+        Renvoie le rendement moyen de chaque produit sur les 'days' jours précédant sa dernière observation.
+
+        Retourne un couple (product_ids, moyennes) trié par product_id.
+        """
+        cols = self._columns(product_ids)
+        cols = cols[self._last_row[cols] >= 0]
+        if len(cols) == 0:
+            return self.product_ids[cols], np.array([])
+
+        lower = self.dates[self._last_row[cols]] - np.timedelta64(days, "D")
+        start = int(np.searchsorted(self.dates, lower.min(), side="left"))
+        block = self._values[start:self._n_rows, cols]
+        in_window = self.dates[start:, None] >= lower[None, :]
+        means = np.nanmean(np.where(in_window, block, np.nan), axis=0)
+
+        ids = self.product_ids[cols]
+        by_id = np.argsort(ids, kind="stable")
+        return ids[by_id], means[by_id]
+
+
+def returns_version(conn):
+    """Version de la table Returns (voir data_version)."""
+    return data_version(conn, "Returns")
+
+
+def bump_returns_version(cursor):
+    """Incrémente la version de la table Returns (voir bump_data_version)."""
+    return bump_data_version(cursor, "Returns")
+
+
+def snapshot_dir(db_file="fund.db"):
+    """Répertoire de la copie projetée en mémoire de la table Returns de db_file (fund.db -> fund_returns)."""
+    return os.path.splitext(os.path.abspath(db_file))[0] + "_returns"
+
+
+def _published_path(directory):
+    """Sous-répertoire de la version publiée dans directory (None si aucune version n'est publiée)."""
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            return json.load(f).get("path")
+    except (OSError, ValueError):
+        return None
+
+
+def snapshot_version(directory):
+    """Version de la table Returns copiée dans directory, ou None si la copie est absente ou inachevée."""
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            return json.load(f)["version"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def refresh_snapshot(db_file="fund.db", directory=None, force=False):
+    """
+    Exporte la table Returns dans directory (par défaut snapshot_dir(db_file)) si la copie est absente
+    ou antérieure à la dernière écriture dans Returns, puis renvoie le répertoire.
+    Sur une base sans table DataVersions, la copie ne peut pas être datée et est réexportée à chaque appel.
+    """
+    directory = directory or snapshot_dir(db_file)
+    with read_connection(db_file) as conn:
+        version = returns_version(conn)
+    if force or version is None or snapshot_version(directory) != version:
+        ReturnsMatrix.from_db(db_file).save(directory)
+    return directory
+
+
+def load_returns_matrix(db_file="fund.db", directory=None, n_rows=None):
+    """
+    Ouvre la copie à jour de la table Returns (réexportée si nécessaire, voir refresh_snapshot).
+    Les rendements sont projetés en mémoire : un démarrage à froid ne coûte que la lecture des pages du fichier.
+    """
+    return ReturnsMatrix.open(refresh_snapshot(db_file, directory), n_rows)
+
+
+# Matrices partagées par base de données, pour que Strategies et DataImporter travaillent sur la même instance
+_shared_matrices = {}
+
+
+def get_returns_matrix(db_file="fund.db", load=True):
+    """
+    Renvoie la matrice de rendements partagée associée à db_file, rechargée si Returns a été modifiée depuis
+    (par un autre processus). Si load vaut False, renvoie la matrice telle quelle, ou None si elle n'est pas chargée.
+    """
+    key = os.path.abspath(db_file)
+    matrix = _shared_matrices.get(key)
+    if not load:
+        return matrix
+    if matrix is not None:
+        with read_connection(db_file) as conn:
+            if returns_version(conn) == matrix.version:
+                return matrix
+    _shared_matrices[key] = load_returns_matrix(db_file)
+    return _shared_matrices[key]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exporte la table Returns en matrice projetable en mémoire.")
+    parser.add_argument("--db", default="fund.db")
+    parser.add_argument("--dir", default=None, help="répertoire de la copie (par défaut <base>_returns)")
+    parser.add_argument("--force", action="store_true", help="réexporte même si la copie est à jour")
+    args = parser.parse_args()
+
+    directory = refresh_snapshot(args.db, args.dir, force=args.force)
+    matrix = ReturnsMatrix.open(directory)
+    print(f"Copie de Returns (version {matrix.version}) : {len(matrix)} dates x {len(matrix.product_ids)} produits "
+          f"dans {directory}")
@@ -1,15 +1,133 @@
-import sqlite3
 import pandas as pd
 import numpy as np
 import pickle
-from scipy.optimize import minimize
+import os
+import time
+from collections import deque
+from scipy.optimize import minimize, linprog
 from scipy.stats import kurtosis
+from base_update import latest_weights
+from database import read_connection
+from covariance import RollingCovariance
+from returns_matrix import get_returns_matrix
+
+
+def _max_linear_weights(mu):
+    """
+    Solution exacte de max mu.w sous sum(w) = 1 et -1 <= w <= 1.
+    L'optimum est un sommet : +1 sur les actifs de meilleur rendement, -1 sur les autres,
+    et un actif intermédiaire à 0 (n pair) ou +1 (n impair) pour que la somme fasse 1.
+    """
+    n = len(mu)
+    order = np.argsort(-mu, kind="stable")
+    k = n // 2
+    weights = np.full(n, -1.0)
+    weights[order[:k]] = 1.0
+    weights[order[k]] = n - 2 * k
+    return weights
+
+
+def _max_linear_weights_lp(mu, group_caps=None):
+    """
+    Même problème résolu par programmation linéaire (HiGHS), avec des contraintes supplémentaires optionnelles.
+
+    group_caps : liste de couples (masque ou indices des actifs du groupe, poids maximal du groupe),
+                 par exemple un plafond par secteur
+    """
+    n = len(mu)
+    A_ub, b_ub = None, None
+    if group_caps:
+        A_ub = np.zeros((len(group_caps), n))
+        b_ub = np.zeros(len(group_caps))
+        for i, (members, cap) in enumerate(group_caps):
+            A_ub[i, members] = 1.0
+            b_ub[i] = cap
+    return linprog(-mu, A_ub=A_ub, b_ub=b_ub, A_eq=np.ones((1, n)), b_eq=[1.0],
+                   bounds=[(-1, 1)] * n, method="highs")
+
+# Modèles déjà chargés : {chemin absolu: (date de modification du fichier, modèle)}
+_model_cache = {}
+
+
+def _load_model(model_path):
+    """Charge le modèle pickle en le gardant en mémoire tant que le fichier n'a pas été modifié."""
+    key = os.path.abspath(model_path)
+    mtime = os.path.getmtime(key)
+    cached = _model_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        with open(key, "rb") as f:
+            _model_cache[key] = (mtime, pickle.load(f))
+    return _model_cache[key][1]
+
+
+def _predict(model, features):
+    """Prédictions pour toutes les lignes de features ; calcul direct X @ coef + intercept pour un modèle linéaire."""
+    coef = getattr(model, "coef_", None)
+    if coef is not None and np.ndim(coef) == 1:
+        return features @ coef + getattr(model, "intercept_", 0.0)
+    return np.asarray(model.predict(features), dtype=float).ravel()
+
+
+def _aligned_weights(weights, product_ids):
+    """
+    Aligne des poids (DataFrame avec une colonne "weight" ou Series indexée par product_id) sur product_ids
+    pour servir de point de départ à l'optimisation : poids ramenés dans [0, 1] puis renormalisés.
+    Renvoie None si aucun poids exploitable.
+    """
+    if weights is None:
+        return None
+    if isinstance(weights, pd.DataFrame):
+        weights = weights["weight"]
+    aligned = weights.reindex(product_ids).fillna(0.0).clip(0, 1).to_numpy(dtype=float)
+    total = aligned.sum()
+    if not np.isfinite(total) or total <= 0:
+        return None
+    return aligned / total
+
+
+# Nombre d'appels aux optimiseurs dont les statistiques de résolution sont conservées (les plus récents)
+SOLVE_STATS_MAXLEN = 1000
+
 
 class Strategies:
 
-    def __init__(self, db_file="fund.db"):
+    def __init__(self, db_file="fund.db", returns_matrix=None):
 
         self.db_file = db_file
+        self._returns_matrix = returns_matrix
+        self._products = None
+        self._covariance = None
+        # Statistiques de résolution (durée, itérations...) des SOLVE_STATS_MAXLEN derniers appels à un optimiseur
+        self.solve_stats = deque(maxlen=SOLVE_STATS_MAXLEN)
+
+    def _previous_weights(self, risk_profile):
+        """Poids du dernier portefeuille enregistré pour risk_profile (Series indexée par product_id), ou None."""
+        with read_connection(self.db_file) as conn:
+            weights = latest_weights(conn, risk_profile)
+        return None if weights is None else weights["weight"]
+
+    @property
+    def products(self):
+        # Table Products (product_id, category), chargée une seule fois
+        if self._products is None:
+            with read_connection(self.db_file) as conn:
+                self._products = pd.read_sql_query("SELECT product_id, category FROM Products", conn)
+        return self._products
+
+    @property
+    def returns_matrix(self):
+        # Matrice injectée (backtest : matrice projetée en mémoire, avancée semaine par semaine), sinon la matrice
+        # partagée de la base, rechargée par get_returns_matrix si Returns a changé depuis (autre processus)
+        if self._returns_matrix is not None:
+            return self._returns_matrix
+        return get_returns_matrix(self.db_file)
+
+    @property
+    def covariance(self):
+        # Covariance glissante des 252 dernières observations de chaque produit, tenue à jour au fil des ajouts de lignes
+        if self._covariance is None or self._covariance.returns_matrix is not self.returns_matrix:
+            self._covariance = RollingCovariance(self.returns_matrix, window=252)
+        return self._covariance
 
     # Fonction permettant de calculer les portefeuilles optimaux pour le profil "low_risk"
     # en minimisant la volatilité du portefeuille à 10% par an
@@ -17,73 +135,78 @@ class Strategies:
     # - La somme des poids doit être égale à 1
     # - La somme des poids attribués aux actifs de la catégorie "bond" doit être >= 0.6
     # - La vente à découvert est interdite
+    # Avec optimizer="analytic" (par défaut), la covariance annualisée est calculée une seule fois en NumPy,
+    # les gradients de l'objectif et des contraintes sont fournis à SLSQP et l'optimisation part des poids
+    # du portefeuille précédent (ou de initial_weights) ; optimizer="slsqp" conserve l'ancienne optimisation.
+    # shrinkage (None par défaut) rétrécit la covariance vers une matrice diagonale (voir RollingCovariance.covariance).
 
-    def low_risk(self, target_volatility=0.10):
-
-        # Chargement des returns historiques depuis la table Returns
-        with sqlite3.connect(self.db_file) as conn:
-            df = pd.read_sql_query("SELECT product_id, date, value FROM Returns ORDER BY date DESC", conn)
-        df['date'] = pd.to_datetime(df['date'])
-
-
-
-        # Pour chaque produit, on récupère les 252 dernières valeurs (les dates les plus récentes)
-        series_list = []
-        product_ids = []
-        for prod_id, grp in df.groupby("product_id"):
+    def low_risk(self, target_volatility=0.10, optimizer="analytic", initial_weights=None, shrinkage=None):
 
-            if len(grp) >= 252:
+        # Covariance des 252 dernières valeurs de chaque produit (les dates les plus récentes),
+        # mise à jour de façon incrémentale avec les lignes ajoutées à la matrice des rendements depuis le dernier appel
+        product_ids, cov_matrix = self.covariance.covariance(shrinkage)
+        product_ids = product_ids.tolist()
 
-                # Récupération des 252 observations les plus récentes et remise en ordre chronologique
-                s = grp.sort_values("date", ascending=False).head(252)
-                s = s.sort_values("date", ascending=True)
-                s = s['value'].reset_index(drop=True)
-                series_list.append(s)
-                product_ids.append(prod_id)
-
-        if not series_list:
+        if not product_ids:
             print("Aucun actif avec 252 retours disponibles.")
             return None
 
-        # Création d'un DataFrame où chaque colonne correspond aux 252 retours d'un actif
-        returns_data = pd.concat(series_list, axis=1)
-        returns_data.columns = product_ids
-
-        # Calcul de la matrice de covariance des rendements et annualisation par 252 jours
-        cov_matrix = returns_data.cov()
-
-        # Fonction objectif : minimiser l'écart entre la volatilité annualisée du portefeuille et target_volatility
-        def objective(weights):
-            port_vol = np.sqrt(np.dot(weights.T, np.dot(cov_matrix * 252, weights)))
-            return (port_vol - target_volatility) ** 2
-
         n = len(product_ids)
-        # Contrainte : la somme des poids doit être égale à 1
-        constraints = [{'type': 'eq', 'fun': lambda w: np.sum(w) - 1}]
 
-        # Chargement de la table Products pour définir le masque (bond)
-        with sqlite3.connect(self.db_file) as conn:
-            products_df = pd.read_sql_query("SELECT product_id, category FROM Products", conn)
+        # Table Products pour définir le masque (bond)
+        products_df = self.products
 
         # Détection si l'actif est de la catégorie "bond"
-        bond = []
-        for prod_id in product_ids:
-            row = products_df[products_df["product_id"] == prod_id]
-            if not row.empty:
-                is_bond = "bond" in row["category"].iloc[0].lower()
-                bond.append(1.0 if is_bond else 0.0)
-            else:
-                bond.append(0.0)
-        bond = np.array(bond)
-
-        # Contrainte : la somme des poids attribués aux bonds doit être >= 0.6
-        constraints.append({'type': 'ineq', 'fun': lambda w: np.dot(bond, w) - 0.6})
+        bond_ids = products_df.loc[products_df["category"].str.lower().str.contains("bond", na=False), "product_id"]
+        bond = np.isin(product_ids, bond_ids).astype(float)
 
         # Bornes des poids : entre 0 et 1 (vente à découvert interdite)
         bounds = [(0, 1)] * n
-        # Répartition initiale égale
-        initial_guess = np.array([1/n] * n)
-        result = minimize(objective, initial_guess, method='SLSQP', bounds=bounds, constraints=constraints)
+
+        if optimizer == "slsqp":
+            # Fonction objectif : minimiser l'écart entre la volatilité annualisée du portefeuille et target_volatility
+            def objective(weights):
+                port_vol = np.sqrt(np.dot(weights.T, np.dot(cov_matrix * 252, weights)))
+                return (port_vol - target_volatility) ** 2
+
+            # Contrainte : la somme des poids doit être égale à 1
+            constraints = [{'type': 'eq', 'fun': lambda w: np.sum(w) - 1}]
+            # Contrainte : la somme des poids attribués aux bonds doit être >= 0.6
+            constraints.append({'type': 'ineq', 'fun': lambda w: np.dot(bond, w) - 0.6})
+            # Répartition initiale égale
+            initial_guess = np.array([1/n] * n)
+            warm_start = False
+            jac = None
+        else:
+            annual_cov = cov_matrix * 252
+
+            # Objectif et gradient calculés ensemble : d/dw (vol - cible)^2 = 2 (vol - cible) * Σw / vol
+            def objective(weights):
+                cov_w = annual_cov @ weights
+                port_vol = np.sqrt(max(weights @ cov_w, 0.0))
+                gap = port_vol - target_volatility
+                gradient = 2 * gap * cov_w / port_vol if port_vol > 0 else np.zeros(n)
+                return gap ** 2, gradient
+
+            ones = np.ones(n)
+            constraints = [{'type': 'eq', 'fun': lambda w: np.sum(w) - 1, 'jac': lambda w: ones},
+                           {'type': 'ineq', 'fun': lambda w: np.dot(bond, w) - 0.6, 'jac': lambda w: bond}]
+
+            # Démarrage à partir des poids précédents, à défaut répartition initiale égale
+            if initial_weights is None:
+                initial_weights = self._previous_weights("low_risk")
+            initial_guess = _aligned_weights(initial_weights, product_ids)
+            warm_start = initial_guess is not None
+            if not warm_start:
+                initial_guess = np.array([1/n] * n)
+            jac = True
+
+        start = time.perf_counter()
+        result = minimize(objective, initial_guess, method='SLSQP', jac=jac, bounds=bounds, constraints=constraints)
+        self.solve_stats.append({"strategy": "low_risk", "optimizer": optimizer, "n_assets": n,
+                                 "seconds": time.perf_counter() - start, "iterations": result.nit,
+                                 "function_evaluations": result.nfev, "warm_start": warm_start,
+                                 "success": bool(result.success)})
 
         if not result.success:
             print("Échec de l'optimisation:", result.message)
@@ -115,56 +238,41 @@ class Strategies:
 
         target_date = pd.to_datetime(target_date)
 
-        # Chargement du modèle pré-entraîné
+        # Chargement du modèle pré-entraîné (mis en cache tant que le fichier n'est pas modifié)
         try:
-            with open(model_path, "rb") as f:
-                model_path = pickle.load(f)
+            model = _load_model(model_path)
         except Exception as e:
             print("Erreur lors du chargement du modèle :", e)
             return None
 
-        # Chargement des rendements depuis la table Returns
-        with sqlite3.connect(self.db_file) as conn:
-            df = pd.read_sql_query("SELECT product_id, date, value FROM Returns ORDER BY date DESC", conn)
-        df['date'] = pd.to_datetime(df['date'])
-
-        predictions = {}
-
-        # Pour chaque actif, on récupère les window_size dernières valeurs antérieures à target_date
-        for prod_id, group in df.groupby("product_id"):
-            group = group[group['date'] < target_date]
-            if len(group) < window_size:
-                continue
-            # Récupération des 'window_size' retours (les plus récents) et tri chronologique
-            features = group.sort_values("date", ascending=False).head(window_size)
-            features = features.sort_values("date", ascending=True)['value'].values
-            features = features.reshape(1, -1)
-            try:
-                pred = model_path.predict(features)[0]
-            except Exception as e:
-                print(f"Erreur lors de la prédiction pour le produit {prod_id} :", e)
-                continue
-            predictions[prod_id] = pred
-
-        if not predictions:
+        # Matrice des features (nb_produits x window_size) : les window_size dernières valeurs antérieures à target_date
+        product_ids, block = self.returns_matrix.last_observations(window_size, before=target_date)
+        if len(product_ids) == 0:
             print("Aucun actif avec suffisamment d'observations pour la prédiction.")
             return None
+
+        # Une seule prédiction pour tous les actifs (produit matriciel direct pour un modèle linéaire)
+        try:
+            predictions = _predict(model, block.T)
+        except Exception as e:
+            print("Erreur lors de la prédiction :", e)
+            return None
         
         # Calcul de la somme des valeurs absolues des rendements prédits
-        total_pred = sum(abs(pred) for pred in predictions.values())
+        total_pred = np.abs(predictions).sum()
         mean_abs_pred = total_pred / len(predictions)   
         if total_pred == 0:
             print("La somme des valeurs absolues des rendements prédits est égale à zéro, impossible de normaliser.")
             return None
         # Calcul des parts à investir pour chaque actif : on conserve le signe de la prédiction
         if mean_abs_pred >0.0025:
-            weights = {prod_id: pred / total_pred for prod_id, pred in predictions.items()}
+            weights = predictions / total_pred
             #print(mean_abs_pred)
         else:
             print("La moyenne des rendements prédits est trop faible pour investir")
             return None
 
-        return pd.DataFrame.from_dict(weights, orient='index', columns=["weight"])
+        return pd.DataFrame(weights, index=product_ids.tolist(), columns=["weight"])
 
 ######################################################################################################################
 
@@ -174,12 +282,14 @@ class Strategies:
     # - La somme des poids doit être égale à 1
     # - La vente à découvert est autorisée
     # - seuls les actifs de la catégorie "equity" sont considérés
+    # L'objectif étant linéaire, le solveur par défaut ("sort") donne directement la solution exacte par tri des rendements ;
+    # "lp" passe par un programme linéaire (utilisé automatiquement si des plafonds par groupe sont fournis),
+    # "slsqp" conserve l'ancienne optimisation itérative.
 
-    def high_yield(self, days=14):
+    def high_yield(self, days=14, solver="sort", group_caps=None):
 
-        # Chargement de la table Products et récupération uniquement des produits "equity"
-        with sqlite3.connect(self.db_file) as conn:
-            products_df = pd.read_sql_query("SELECT product_id, category FROM Products", conn)
+        # Table Products et récupération uniquement des produits "equity"
+        products_df = self.products.copy()
         products_df['category'] = products_df['category'].str.lower()
         equity_ids = products_df.loc[products_df['category'] == 'equity', 'product_id'].tolist()
 
@@ -187,35 +297,32 @@ class Strategies:
             print("Aucun produit de catégorie equity trouvé.")
             return None
 
-        # Chargement des rendements historiques pour les produits equity
-        with sqlite3.connect(self.db_file) as conn:
-            query = ("SELECT product_id, date, value FROM Returns WHERE product_id IN ("
-                    + ",".join(map(str, equity_ids)) + ") ORDER BY date DESC")
-            df = pd.read_sql_query(query, conn)
-        df['date'] = pd.to_datetime(df['date'])
-
-        # Pour chaque produit, on récupère les rendements des deux dernières semaines
-        series_list = []
-        product_ids = []
-
-        for prod_id, group in df.groupby("product_id"):
-            latest_date = group['date'].max()
-            days_ago = latest_date - pd.Timedelta(days=days)
-            group_days = group[group['date'] >= days_ago]
-            if group_days.empty:
-                continue
-            s = group_days.sort_values("date", ascending=True)['value'].reset_index(drop=True)
-            series_list.append(s)
-            product_ids.append(prod_id)
-
-        if not series_list:
+        # Moyenne des rendements des deux dernières semaines pour chaque produit equity
+        product_ids, mu = self.returns_matrix.recent_means(days, equity_ids)
+        product_ids = product_ids.tolist()
+
+        if not product_ids:
             print("Aucun actif avec des retours sur les deux dernières semaines disponibles.")
             return None
 
-        # Calcul de la moyenne des rendements pour chaque actif
-        mu = np.array([s.mean() for s in series_list])
         n = len(mu) 
 
+        # Plafonds par groupe : {nom: (liste de product_id, poids maximal)}
+        caps = None
+        if group_caps:
+            caps = [(np.isin(product_ids, ids), cap) for ids, cap in group_caps.values()]
+            solver = "lp"
+
+        if solver == "sort":
+            return pd.DataFrame(_max_linear_weights(mu), index=product_ids, columns=["weight"])
+
+        if solver == "lp":
+            result = _max_linear_weights_lp(mu, caps)
+            if not result.success:
+                print("Échec de l'optimisation:", result.message)
+                return None
+            return pd.DataFrame(result.x, index=product_ids, columns=["weight"])
+
         # Objectif : maximiser le rendement moyen (équivalent à minimiser l'opposé)
         def objective(weights):
             return -np.dot(mu, weights)
@@ -0,0 +1,147 @@
+import argparse
+import itertools
+import os
+import shutil
+import tempfile
+import time
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+from backtester import Backtester, PROFILES
+from database import connect
+from metrics import _latest_returns, _portfolio_daily_returns, _weights_frame, returns_summary
+from model import fit_model
+from returns_matrix import ReturnsMatrix, refresh_snapshot
+
+# Paramètres du backtest qu'une grille peut faire varier
+SWEEP_PARAMETERS = ["target_volatility", "days", "window_size", "max_deals_per_month"]
+
+# État de chaque processus de calcul : répertoire de la matrice partagée, vue complète et paramètres communs
+_worker = {}
+
+
+def _init_worker(snapshot_dir, db_file, start, end, models):
+    """Initialise un processus : un seul thread BLAS (un backtest par cœur) et vue complète de la matrice partagée."""
+    threadpool_limits(1)
+    _worker.update(snapshot_dir=snapshot_dir, db_file=db_file, start=start, end=end, models=models,
+                   matrix=ReturnsMatrix.open(snapshot_dir))
+
+
+def _turnover(lines, profile, n_allocations):
+    """Rotation moyenne par rebalancement (moitié de la somme des variations de poids en valeur absolue)."""
+    if not n_allocations:
+        return float("nan")
+    return 0.5 * lines.loc[lines["profile"] == profile, "delta_weight"].abs().sum() / n_allocations
+
+
+def _run_point(run_id, params):
+    """Exécute le backtest d'un point de la grille et renvoie une ligne d'indicateurs par profil."""
+    started = time.perf_counter()
+    kwargs = dict(params)
+    window_size = kwargs.get("window_size", 10)
+    backtester = Backtester(_worker["start"], _worker["end"], db_file=_worker["db_file"],
+                            model_path=_worker["models"][window_size], write=False,
+                            returns_snapshot=_worker["snapshot_dir"], **kwargs)
+    backtester.run()
+    seconds = time.perf_counter() - started
+
+    lines = backtester.deal_lines()
+    rows = []
+    for profile in PROFILES:
+        allocations = [(date, weights) for date, name, weights in backtester.portfolios if name == profile]
+        daily = _latest_returns(_portfolio_daily_returns(None, _weights_frame(allocations), returns_matrix=_worker["matrix"]))
+        summary = returns_summary(daily["return"].to_numpy())
+        rows.append({"run_id": run_id, **params, "profile": profile, "n_portfolios": len(allocations),
+                     "sharpe_ratio": summary["sharpe_ratio"], "max_drawdown": summary["max_drawdown"],
+                     "turnover": _turnover(lines, profile, len(allocations)), "total_return": summary["total_return"],
+                     "volatility": summary["volatility"], "seconds": seconds})
+    return rows
+
+
+def parameter_grid(grid):
+    """Développe un dictionnaire {paramètre: liste de valeurs} en liste de combinaisons (produit cartésien)."""
+    if isinstance(grid, dict):
+        names = list(grid)
+        return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+    return [dict(params) for params in grid]
+
+
+def run_sweep(grid, start, end, db_file="fund.db", workers=None, model_path="model.pkl",
+              train_start=None, train_end=None, results_db=None):
+    """
+    Lance un backtest indépendant pour chaque point d'une grille de paramètres, sur un pool de processus.
+
+    Tous les processus projettent en mémoire, en lecture seule, la même copie de la table Returns
+    (voir refresh_snapshot, réexportée seulement si elle est périmée). Les backtests ne modifient pas la base : les portefeuilles
+    restent en mémoire et seuls les indicateurs sont renvoyés.
+
+    Paramètres :
+      grid        : dictionnaire {paramètre: valeurs} ou liste de dictionnaires (voir SWEEP_PARAMETERS)
+      start, end  : bornes du calendrier hebdomadaire
+      db_file     : chemin vers la base de données SQLite (lue uniquement)
+      workers     : nombre de processus (par défaut, le nombre de cœurs)
+      model_path  : modèle de linear_strategy utilisé lorsque le modèle n'est pas ré-entraîné
+      train_start, train_end : si renseignées, un modèle est entraîné pour chaque window_size de la grille
+      results_db  : base SQLite (distincte de la base de production) où enregistrer les résultats (table SweepResults)
+
+    Retourne un DataFrame avec une ligne par (point de la grille, profil) : run_id, paramètres, profile,
+    n_portfolios, sharpe_ratio, max_drawdown, turnover, total_return, volatility et seconds.
+    """
+    points = parameter_grid(grid)
+    for params in points:
+        unknown = set(params) - set(SWEEP_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Paramètres inconnus : {sorted(unknown)}. Paramètres possibles : {SWEEP_PARAMETERS}")
+    if results_db is not None and os.path.abspath(results_db) == os.path.abspath(db_file):
+        raise ValueError("results_db doit être distincte de la base de production.")
+
+    work_dir = tempfile.mkdtemp(prefix="sweep_")
+    try:
+        snapshot_dir = refresh_snapshot(db_file)
+
+        # Un modèle par taille de fenêtre : ré-entraîné si une période d'entraînement est fournie
+        window_sizes = sorted({params.get("window_size", 10) for params in points})
+        models = {}
+        for window_size in window_sizes:
+            if train_start is not None and train_end is not None:
+                models[window_size] = os.path.join(work_dir, f"model_{window_size}.pkl")
+                fit_model(train_start, train_end, db_file=db_file, window_size=window_size,
+                          model_path=models[window_size])
+            else:
+                models[window_size] = model_path
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(snapshot_dir, db_file, start, end, models)) as executor:
+            futures = [executor.submit(_run_point, run_id, params) for run_id, params in enumerate(points)]
+            rows = [row for future in futures for row in future.result()]
+        print(f"{len(points)} backtests terminés en {time.perf_counter() - started:.2f} s.")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = pd.DataFrame(rows)
+    if results_db is not None:
+        with connect(results_db) as conn:
+            results.assign(start=str(start), end=str(end)).to_sql("SweepResults", conn, if_exists="append", index=False)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Balayage de paramètres des stratégies sur un pool de processus.")
+    parser.add_argument("--start", default="2023-01-02")
+    parser.add_argument("--end", default="2024-12-12")
+    parser.add_argument("--db", default="fund.db")
+    parser.add_argument("--model", default="model.pkl")
+    parser.add_argument("--target-volatility", type=float, nargs="+", default=[0.10])
+    parser.add_argument("--days", type=int, nargs="+", default=[14])
+    parser.add_argument("--window-size", type=int, nargs="+", default=[10])
+    parser.add_argument("--train-start", default=None, help="début de la période d'entraînement des modèles")
+    parser.add_argument("--train-end", default=None, help="fin de la période d'entraînement des modèles")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--results-db", default=None, help="base où enregistrer les résultats (table SweepResults)")
+    args = parser.parse_args()
+
+    grid = {"target_volatility": args.target_volatility, "days": args.days, "window_size": args.window_size}
+    results = run_sweep(grid, args.start, args.end, db_file=args.db, workers=args.workers, model_path=args.model,
+                        train_start=args.train_start, train_end=args.train_end, results_db=args.results_db)
+    print(results.to_string(index=False))
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+# Les modules du projet sont à la racine du dépôt
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import creation_db
+from database import close_connections, connect
+
+
+@pytest.fixture
+def db_file(tmp_path, monkeypatch):
+    """Base vide (toutes les tables, schéma à jour) dans un répertoire temporaire."""
+    path = str(tmp_path / "fund.db")
+    monkeypatch.setattr(creation_db, "db_file", path)
+    creation_db.create_tables()
+    yield path
+    close_connections()
+
+
+def insert_products(db_file, tickers, category="Action"):
+    """Enregistre les tickers dans Products et renvoie leurs product_id dans le même ordre."""
+    with connect(db_file) as conn:
+        conn.executemany("INSERT INTO Products (ticker, category) VALUES (?, ?)", [(t, category) for t in tickers])
+        conn.commit()
+        return [conn.execute("SELECT product_id FROM Products WHERE ticker = ?", (t,)).fetchone()[0] for t in tickers]
@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+
+from base_update import PortfolioWriter, deal_lines, latest_weights
+from conftest import insert_products
+from database import connect
+
+
+def _weights(weights):
+    return pd.DataFrame({"weight": list(weights.values())}, index=list(weights.keys()))
+
+
+def _deals(db_file, date_str):
+    with connect(db_file) as conn:
+        deals = pd.read_sql_query("SELECT product_id, delta_weight FROM DealLines WHERE profile = 'low_risk' AND date = ?",
+                                  conn, params=(date_str,), index_col="product_id")
+    return deals["delta_weight"].to_dict()
+
+
+def test_same_date_allocations_keep_the_last_one(db_file):
+    product_ids = insert_products(db_file, ["AAA", "BBB", "CCC"])
+    first = _weights({product_ids[0]: 0.6, product_ids[1]: 0.4})
+    replaced = _weights({product_ids[0]: 1.0})
+    last = _weights({product_ids[1]: 0.5, product_ids[2]: 0.5})
+    later = _weights({product_ids[2]: 1.0})
+
+    with PortfolioWriter(db_file) as writer:
+        writer.add("2024-01-01", "low_risk", first)
+        writer.add("2024-01-08", "low_risk", replaced)
+        writer.add("2024-01-08", "low_risk", last)
+        writer.add("2024-01-15", "low_risk", later)
+
+    # Le deal du 8 janvier et celui du 15 partent de la dernière allocation du 8
+    assert _deals(db_file, "2024-01-08") == pytest.approx({product_ids[0]: -0.6, product_ids[1]: 0.1, product_ids[2]: 0.5})
+    assert _deals(db_file, "2024-01-15") == pytest.approx({product_ids[1]: -0.5, product_ids[2]: 0.5})
+    with connect(db_file) as conn:
+        pd.testing.assert_frame_equal(latest_weights(conn, "low_risk", before="2024-01-15"), last, check_names=False)
+
+
+def test_deal_lines_same_date_with_shared_products():
+    allocations = pd.DataFrame({"profile": "low_risk", "date": ["2024-01-08"] * 4,
+                                "product_id": [1, 2, 1, 2], "weight": [0.5, 0.5, 0.2, 0.8],
+                                "allocation": [0, 0, 1, 1]})
+
+    lines = deal_lines(allocations, {"low_risk": _weights({1: 1.0})})
+
+    assert lines[["product_id", "delta_weight"]].to_dict("list") == {"product_id": [1, 2], "delta_weight": [-0.8, 0.8]}
@@ -0,0 +1,144 @@
+import pandas as pd
+import pytest
+
+import market_data
+from benchmark import synthetic_closes
+from conftest import insert_products
+from database import connect
+from import_data import DataImporter
+from market_data import DownloadScheduler, LocalPriceStore, MarketDataProvider
+
+TICKERS = ["AAA", "BBB", "CCC", "DDD"]
+
+
+class FlakyProvider(MarketDataProvider):
+    """
+    Source de test : lit les cours dans un LocalPriceStore, mais échoue pour certains tickers.
+    failures[ticker] = nombre d'appels en échec avant de répondre (None : échec permanent).
+    """
+
+    def __init__(self, store, failures=None):
+        self.store = store
+        self.failures = dict(failures or {})
+        self.calls = []
+
+    def get_closes(self, tickers, start_date, end_date):
+        tickers = list(tickers)
+        self.calls.append(tickers)
+        failing = [t for t in tickers if t in self.failures and self.failures[t] != 0]
+        for ticker in failing:
+            if self.failures[ticker] is not None:
+                self.failures[ticker] -= 1
+        if failing:
+            raise ConnectionError(f"source indisponible pour {failing}")
+        return self.store.get_closes(tickers, start_date, end_date)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = LocalPriceStore(str(tmp_path / "prices"))
+    store.write(synthetic_closes(TICKERS, years=0.5))
+    return store
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Remplace time.sleep par un enregistrement des attentes demandées."""
+    recorded = []
+    monkeypatch.setattr(market_data.time, "sleep", recorded.append)
+    return recorded
+
+
+def test_retry_with_exponential_backoff(store, sleeps):
+    provider = FlakyProvider(store, failures={"AAA": 2})
+    scheduler = DownloadScheduler(provider, chunk_size=len(TICKERS), max_workers=1, retries=3, backoff=0.5)
+
+    results = list(scheduler.fetch(TICKERS, "2024-10-01", "2024-12-01"))
+
+    assert len(provider.calls) == 3
+    assert sleeps == [0.5, 1.0]
+    [(chunk, closes, error)] = results
+    assert error is None
+    pd.testing.assert_frame_equal(closes, store.get_closes(TICKERS, "2024-10-01", "2024-12-01"))
+
+
+def test_failed_chunk_is_reported_after_retries(store, sleeps):
+    provider = FlakyProvider(store, failures={"CCC": None})
+    scheduler = DownloadScheduler(provider, chunk_size=2, max_workers=2, retries=2, backoff=1.0)
+
+    results = {tuple(chunk): (closes, error) for chunk, closes, error in scheduler.fetch(TICKERS, "2024-10-01", "2024-12-01")}
+
+    assert set(results) == {("AAA", "BBB"), ("CCC", "DDD")}
+    assert results[("AAA", "BBB")][1] is None
+    closes, error = results[("CCC", "DDD")]
+    assert closes is None
+    assert isinstance(error, ConnectionError)
+    # Une première tentative et deux nouvelles tentatives pour le lot en échec
+    assert sum(call == ["CCC", "DDD"] for call in provider.calls) == 3
+    assert sorted(sleeps) == [1.0, 2.0]
+
+
+def _watermarks(db_file):
+    with connect(db_file) as conn:
+        return pd.read_sql_query("""
+            SELECT p.ticker, w.first_date, w.last_date
+            FROM IngestionWatermarks w JOIN Products p ON p.product_id = w.product_id
+            ORDER BY p.ticker""", conn).set_index("ticker")
+
+
+def _returns_tickers(db_file):
+    with connect(db_file) as conn:
+        return set(pd.read_sql_query("""
+            SELECT DISTINCT p.ticker FROM Returns r JOIN Products p ON p.product_id = r.product_id""", conn)["ticker"])
+
+
+def test_watermarks_advance_only_for_successful_tickers(db_file, store, sleeps, capsys):
+    insert_products(db_file, TICKERS)
+    provider = FlakyProvider(store, failures={"CCC": None})
+    importer = DataImporter(db_file, provider=provider, chunk_size=2, max_workers=2, retries=1, backoff=0.1)
+
+    importer.fill_returns("2024-09-02", "2024-12-02")
+
+    output = capsys.readouterr().out
+    assert "2 tickers en échec" in output
+    assert "'CCC'" in output and "'DDD'" in output
+    watermarks = _watermarks(db_file)
+    assert sorted(watermarks.index) == ["AAA", "BBB"]
+    assert (watermarks["first_date"] == "2024-09-02").all()
+    assert (watermarks["last_date"] == "2024-12-02").all()
+    assert _returns_tickers(db_file) == {"AAA", "BBB"}
+
+    # La source est rétablie : seuls les tickers en échec sont redemandés
+    provider.failures.clear()
+    provider.calls.clear()
+    importer.fill_returns("2024-09-02", "2024-12-02")
+
+    assert provider.calls == [["CCC", "DDD"]]
+    watermarks = _watermarks(db_file)
+    assert sorted(watermarks.index) == TICKERS
+    assert (watermarks["last_date"] == "2024-12-02").all()
+    assert _returns_tickers(db_file) == set(TICKERS)
+
+
+def test_yahoo_provider_marks_empty_tickers_as_missing(store, monkeypatch):
+    class FakeTicker:
+        def __init__(self, ticker):
+            self.ticker = ticker
+
+        def history(self, start, end):
+            if self.ticker not in TICKERS:
+                return pd.DataFrame()
+            closes = store.get_closes([self.ticker], start, end)[self.ticker]
+            return closes.tz_localize("America/New_York").rename("Close").to_frame()
+
+    monkeypatch.setattr(market_data.yf, "Ticker", FakeTicker)
+    provider = market_data.YahooProvider(pause=0)
+
+    closes = provider.get_closes(["AAA", "ZZZ"], "2024-10-01", "2024-12-01")
+    assert list(closes.columns) == ["AAA", "ZZZ"]
+    assert closes["ZZZ"].isna().all()
+    pd.testing.assert_series_equal(closes["AAA"], store.get_closes(["AAA"], "2024-10-01", "2024-12-01")["AAA"],
+                                  check_freq=False)
+
+    with pytest.raises(RuntimeError):
+        provider.get_closes(["YYY", "ZZZ"], "2024-10-01", "2024-12-01")
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import insert_products
+from database import connect
+from model import _load_training_returns, _training_set, _training_set_loop
+
+WINDOW_SIZE = 4
+
+
+def _returns_with_nulls(seed=0):
+    """Rendements hebdomadaires de trois produits, avec des NULL isolés, un produit coté plus tard et un inf."""
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2024-01-05", periods=30, freq="W-FRI")
+    frames = []
+    for product_id, first in [(1, 0), (2, 0), (3, 12)]:
+        values = rng.normal(0, 0.02, len(dates) - first)
+        frames.append(pd.DataFrame({"product_id": product_id, "date": dates[first:], "value": values}))
+    df = pd.concat(frames, ignore_index=True)
+    df.loc[(df["product_id"] == 1) & df["date"].isin(dates[[7, 19]]), "value"] = np.nan
+    df.loc[(df["product_id"] == 2) & (df["date"] == dates[3]), "value"] = np.inf
+    df.loc[(df["product_id"] == 3) & (df["date"] == dates[20]), "value"] = np.nan
+    return df.sort_values("date", kind="stable").reset_index(drop=True)
+
+
+def test_training_set_matches_loop_with_nulls():
+    df = _returns_with_nulls()
+
+    X_vec, y_vec = _training_set(df, WINDOW_SIZE)
+    X_loop, y_loop = _training_set_loop(df, WINDOW_SIZE)
+
+    assert len(y_loop) > 0
+    np.testing.assert_array_equal(X_vec, X_loop)
+    np.testing.assert_array_equal(y_vec, y_loop)
+    assert np.isfinite(X_vec).all() and np.isfinite(y_vec).all()
+
+
+@pytest.mark.parametrize("start_date, end_date", [("2024-01-01", "2024-12-31"), ("2024-02-01", "2024-06-30")])
+def test_training_returns_keep_null_gaps(db_file, start_date, end_date):
+    df = _returns_with_nulls()
+    insert_products(db_file, ["AAA", "BBB", "CCC"])
+    with connect(db_file) as conn:
+        conn.executemany("INSERT INTO Returns (product_id, date, value) VALUES (?, ?, ?)",
+                         [(int(row.product_id), row.date.strftime("%Y-%m-%d"), None if np.isnan(row.value) else row.value)
+                          for row in df.itertuples()])
+        conn.commit()
+        # Requête de l'ancienne version de fit_model : les rendements NULL restent des lignes NaN
+        expected = pd.read_sql_query("SELECT product_id, date, value FROM Returns WHERE date BETWEEN ? AND ? ORDER BY date ASC",
+                                     conn, params=(start_date, end_date))
+    expected["date"] = pd.to_datetime(expected["date"])
+
+    X, y = _training_set(_load_training_returns(start_date, end_date, db_file), WINDOW_SIZE)
+    X_expected, y_expected = _training_set_loop(expected, WINDOW_SIZE)
+
+    assert len(y_expected) > 0
+    np.testing.assert_array_equal(X, X_expected)
+    np.testing.assert_array_equal(y, y_expected)